@@ -6,10 +6,12 @@ import sys
 
 import cv2
 
-from flask import Flask
+from flask import Flask, Response, request, abort
 from flask_sock import Sock
 
 from utils.MocapSystem import MocapSystem
+from utils.MocapPublisher import MocapPublisher
+from utils.PreviewPublisher import PreviewPublisher
 from utils.VideoStreamWidget import VideoStreamWidget
 from utils.constants import constants as C
 
@@ -17,80 +19,82 @@ app = Flask(__name__)
 sock = Sock(app)
 
 @app.route("/show_frames")
-def hello_world():
-    while True:
+def show_frames():
+    # A page with a thumbnail of every camera, each linking to its full size
+    # preview. Works from any browser, not just the computer running this
+    thumbnails = "".join([
+        '<a href="/preview/%d"><img src="/preview/%d?thumbnail=1" title="camera %d"></a>'
+        % (camera_id, camera_id, camera_id)
+        for camera_id in previewer.get_camera_ids()
+    ])
+    return "<html><body>" + thumbnails + "</body></html>"
+
+@app.route("/preview/<int:camera_id>")
+def preview(camera_id):
+    # A multipart MJPEG stream of the camera's annotated frames, which an
+    # <img> tag plays. Clients can ask for a smaller picture and fewer frames
+    # with /preview/1?thumbnail=1&fps=2. The frames are encoded once by the
+    # previewer for every viewer.
+    if camera_id not in previewer.get_camera_ids():
+        abort(404)
+    thumbnail = request.args.get("thumbnail", "0") == "1"
+    fps = min(request.args.get("fps", C.PREVIEW_FRAME_RATE, type=float), C.PREVIEW_FRAME_RATE)
+    if not fps > 0:
+        abort(400)
+
+    def stream():
+        previewer.subscribe(camera_id, thumbnail)
         try:
-            for v in m.active_video_streams:
-                v.show_frame()
-        except AttributeError:
-            pass
-    return("hello world")
-
-def get_client_value(camera_value, scale, translation, rounding_amount):
-    val = scale * (camera_value - translation)
-    rounded_val = round(val / rounding_amount) * rounding_amount
-    return rounded_val
+            frame_count = 0
+            next_time = time.monotonic()
+            while True:
+                # Cap this viewer's frame rate without holding up the others
+                sleep_time = next_time - time.monotonic()
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+                frame_count, jpeg = previewer.wait_for_frame(camera_id, thumbnail, frame_count)
+                if jpeg is None:
+                    continue
+                next_time = time.monotonic() + 1. / fps
+                yield (
+                    b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                    + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n"
+                )
+        finally:
+            previewer.unsubscribe(camera_id, thumbnail)
+
+    return Response(stream(), mimetype="multipart/x-mixed-replace; boundary=frame")
+
+@app.route("/stats")
+def stats():
+    stats = m.get_fusion_stats()
+    stats["subscribers"] = publisher.num_subscribers
+    stats["preview_viewers"] = previewer.get_stats()
+    return stats
 
 @sock.route("/echo")
 def echo(sock):
     print("Connected!")
-    # update these with student points from webcam
-    data = {}
-    prev = 0
-    scale_x = abs(m.bounds[0] - m.bounds[1]) / abs(C.DEFAULT_BOUNDS[0] - C.DEFAULT_BOUNDS[1])
-    scale_y = abs(m.bounds[2] - m.bounds[3]) / abs(C.DEFAULT_BOUNDS[2] - C.DEFAULT_BOUNDS[3])
-    translate_x = m.origin[0]
-    translate_y = m.origin[1]
-    translate_z = m.origin[2]
-    while True:
-        # send the data of the points over the websocket
-        # print(data)
-        time_elapsed = time.time() - prev # time.time() returns seconds
-        if time_elapsed >= 1./C.MOCAP_OUT_FRAME_RATE:
-            prev = time.time()
-            sock.send(data)
-            avg_aruco_poses_dict = m.get_average_detected_markers()
-            # print(avg_aruco_poses_dict)
-            if avg_aruco_poses_dict:
-                for aruco_marker in avg_aruco_poses_dict:
-                    point_key = str(aruco_marker)
-                    rounded_x = get_client_value(
-                        avg_aruco_poses_dict[aruco_marker][0],
-                        scale_x,
-                        translate_x,
-                        m.rounding_amount
-                    )
-                    rounded_y = get_client_value(
-                        avg_aruco_poses_dict[aruco_marker][1],
-                        scale_y,
-                        translate_y,
-                        m.rounding_amount
-                    )
-                    rounded_z = get_client_value(
-                        avg_aruco_poses_dict[aruco_marker][2],
-                        scale_y,
-                        translate_z,
-                        m.rounding_amount
-                    )
-                    if point_key in list(data):
-                        if m.mode == 0:
-                            data[point_key]["x"] = rounded_x
-                            data[point_key]["y"] = rounded_y
-                        else:
-                            data[point_key]["x"] = rounded_x
-                            data[point_key]["y"] = rounded_z
-
-                    else:
-                        if m.mode == 0:
-                            data[point_key] = {
-                                "x": rounded_x,
-                                "y": rounded_y
-                            }
-                        else:
-                            data[point_key] = {
-                                "x": rounded_x,
-                                "y": rounded_z
-                            }
+    # Clients pick the wire format with /echo?format=json|binary&delta=0|1
+    # See utils/WireFrame.py for the protocol.
+    wire_format = request.args.get("format", "json")
+    use_delta = request.args.get("delta", "0") == "1"
+    # The publisher computes the student points once per tick for every
+    # client, so all we do here is send each new frame
+    publisher.subscribe()
+    try:
+        frame_count = 0
+        sent_seq = None
+        while True:
+            frame_count, wire_frame = publisher.wait_for_frame(frame_count)
+            if wire_frame is None:
+                continue
+            # A delta only makes sense if this client got the frame before it
+            delta = use_delta and sent_seq == wire_frame.seq - 1
+            sock.send(wire_frame.get_payload(wire_format, delta))
+            sent_seq = wire_frame.seq
+    finally:
+        publisher.unsubscribe()
 
 @app.teardown_appcontext
 def teardown(exception):
@@ -123,6 +127,18 @@ if __name__ == "__main__":
     parser.add_argument("-r", "--round",
         help="Increment you want to round by (default 10)",
     )
+    parser.add_argument("-m", "--multiprocess",
+        help="Include to run each camera in its own process",
+        action="store_true"
+    )
+    parser.add_argument("-d", "--dump-raw",
+        help="Include with --save to record raw frames, and encode them later with encode_recording.py",
+        action="store_true"
+    )
+    parser.add_argument("-a", "--reassign-cameras",
+        help="Include to ask for every camera's number again instead of using camera_profile.json",
+        action="store_true"
+    )
     args = parser.parse_args()
     if args.mode == "xy":
         mode = 0
@@ -166,8 +182,8 @@ if __name__ == "__main__":
     origin = args.origin if args.origin else C.DEFAULT_ORIGIN
 
     if old_video_path is not None:
-        # This function is current depricated, since I have no way of recording
-        # all four video streams at the same time.
+        # Plays the videos back in real time for the clients. To reprocess a
+        # recorded session faster than real time, use replay_session.py
         if os.path.exists(old_video_path + "1.avi"):
             m = MocapSystem(
                 NUMBER_OF_CAMERAS_IN_SYSTEM=C.NUM_CAMERAS,
@@ -190,10 +206,15 @@ if __name__ == "__main__":
             MODE=mode,
             ROUNDING_AMOUNT=round_by,
             BOUNDS=bounds,
-            ORIGIN=origin
+            ORIGIN=origin,
+            USE_PROCESSES=args.multiprocess,
+            REASSIGN_CAMERAS=args.reassign_cameras,
+            RECORD_RAW=args.dump_raw
         )
     if m.save_video:
         print("NOTE: Saving video stream.")
     else:
         print("NOTE: Not Saving video stream.")
+    publisher = MocapPublisher(m)
+    previewer = PreviewPublisher(m)
     app.run()
@@ -0,0 +1,378 @@
+import argparse
+
+import numpy as np
+
+from utils.MarkerTracker import MarkerTracker
+from utils.PoseHistoryWriter import load_pose_history
+from utils.constants import constants as C
+
+# Compares the latency and jitter of the old moving average (PoseStore)
+# against the MarkerTracker. Positions are pushed in at the times they were
+# detected, and the expected poses are read out at C.MOCAP_OUT_FRAME_RATE.
+#   - latency: how far behind the reference path the output is, in ms
+#   - jitter: cm, how far the output is from the reference path once the
+#       latency is taken out
+#   - error: cm, how far the output is from where the marker really is
+# With a pose history file, the reference path is a centered moving average
+# of its positions. Otherwise students walking between random points are
+# simulated, and the reference path is the true path.
+# Examples:
+#   python benchmark_tracker.py                             (simulated students)
+#   python benchmark_tracker.py -n 8 -o 0.05                (noisier, more outliers)
+#   python benchmark_tracker.py -f collected_data_from_cameras/pose_history/2022_2_9/2022_2_9_12_59_pose_history.csv -n 5
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-f", "--file",
+    help="Pose history file to use instead of simulated students"
+)
+parser.add_argument("-m", "--markers",
+    help="How many students to simulate (default 10)",
+    type=int,
+    default=10
+)
+parser.add_argument("-s", "--seconds",
+    help="How many seconds to simulate (default 60)",
+    type=float,
+    default=60
+)
+parser.add_argument("-n", "--noise",
+    help="cm of noise to add to every position (default 5, 0 for a file)",
+    type=float
+)
+parser.add_argument("-o", "--outliers",
+    help="Fraction of positions which are 1 m off (default 0.02, 0 for a file)",
+    type=float
+)
+parser.add_argument("-w", "--window",
+    help="Seconds of the centered moving average of a file's reference path (default 0.3)",
+    type=float,
+    default=0.3
+)
+args = parser.parse_args()
+
+# How many positions of each marker the old moving average used to average
+POSE_QUEUE_LENGTH = 10
+
+
+class PoseStore(object):
+    """
+        The moving average MocapSystem used before the MarkerTracker, kept
+        here only as the baseline to compare against. It keeps the recent
+        pose history of every aruco marker in one set of arrays, indexed by
+        aruco id, and averages the recent poses of every id at once.
+
+        - num_ids <int>: how many aruco ids we can store (1000 for DICT_6X6_1000)
+
+        - MAX_QUEUE_LENGTH <int>: how many values we store per aruco id
+
+        - MAX_POSE_AGE <float>: How many seconds a value stays in the store
+            before it is cleared
+
+        - pose_history <np.array(num_ids, MAX_QUEUE_LENGTH, 4)>: A circular buffer
+            of positions for every aruco id. Each row is [timestamp, x, y, z].
+
+        - start <np.array(num_ids)>: Index of the oldest value of each aruco id
+
+        - length <np.array(num_ids)>: How many values each aruco id has
+
+        - pose_sum <np.array(num_ids, 3)>: Running sum of the x, y, z values
+            of each aruco id
+    """
+    def __init__(self, num_ids=C.NUM_ARUCO_IDS, max_queue_length=POSE_QUEUE_LENGTH):
+        self.num_ids = num_ids
+        self.MAX_QUEUE_LENGTH = max_queue_length
+        self.MAX_POSE_AGE = 3
+
+        self.pose_history = np.zeros((num_ids, self.MAX_QUEUE_LENGTH, 4))
+        self.start = np.zeros(num_ids, dtype=np.int64)
+        self.length = np.zeros(num_ids, dtype=np.int64)
+        self.pose_sum = np.zeros((num_ids, 3))
+
+
+    def push_many(self, aruco_ids, tvecs, timestamp):
+        """
+            Pushes the detections of one frame into the store. If an aruco id
+            already has MAX_QUEUE_LENGTH values, its oldest value is overwritten.
+
+            Inputs:
+                - aruco_ids <np.array(n)>: the detected aruco ids. Each id
+                    should only show up once.
+                - tvecs <np.array(n, 3)>: the x, y, z of each detected id
+                - timestamp <float>: when the positions were detected
+
+            Returns: None
+        """
+        aruco_ids = np.asarray(aruco_ids, dtype=np.int64).reshape(-1)
+        tvecs = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3)
+
+        # Ignore ids that aren't in the dictionary, and only keep the first
+        # detection of any repeated id so the fancy indexing below is safe
+        in_range = (aruco_ids >= 0) & (aruco_ids < self.num_ids)
+        aruco_ids = aruco_ids[in_range]
+        tvecs = tvecs[in_range]
+        aruco_ids, first = np.unique(aruco_ids, return_index=True)
+        tvecs = tvecs[first]
+        if len(aruco_ids) == 0:
+            return
+
+        # Make room in any full buffers by dropping their oldest value
+        full_ids = aruco_ids[self.length[aruco_ids] >= self.MAX_QUEUE_LENGTH]
+        oldest = self.start[full_ids]
+        self.pose_sum[full_ids] -= self.pose_history[full_ids, oldest, 1:4]
+        self.start[full_ids] = (oldest + 1) % self.MAX_QUEUE_LENGTH
+        self.length[full_ids] -= 1
+
+        end = (self.start[aruco_ids] + self.length[aruco_ids]) % self.MAX_QUEUE_LENGTH
+        self.pose_history[aruco_ids, end, 0] = timestamp
+        self.pose_history[aruco_ids, end, 1:4] = tvecs
+        self.pose_sum[aruco_ids] += tvecs
+        self.length[aruco_ids] += 1
+
+
+    def clear_old_values(self, now):
+        """
+            Clears every value older than MAX_POSE_AGE seconds, for all aruco
+            ids at once. Values are kept oldest first, so we only clear from
+            the front of each buffer.
+
+            Inputs:
+                - now <float>: time to compare the timestamps to
+
+            Returns: None
+        """
+        live_ids = np.flatnonzero(self.length)
+        if len(live_ids) == 0:
+            return
+
+        # Put each live id's buffer in oldest to newest order
+        offsets = np.arange(self.MAX_QUEUE_LENGTH)
+        order = (self.start[live_ids, None] + offsets) % self.MAX_QUEUE_LENGTH
+        ordered = self.pose_history[live_ids[:, None], order]
+        in_use = offsets < self.length[live_ids, None]
+        expired = in_use & (ordered[:, :, 0] + self.MAX_POSE_AGE <= now)
+        # Only clear the run of expired values at the front of each buffer
+        expired = np.cumprod(expired, axis=1).astype(bool)
+        num_expired = expired.sum(axis=1)
+        if not num_expired.any():
+            return
+
+        self.pose_sum[live_ids] -= (ordered[:, :, 1:4] * expired[:, :, None]).sum(axis=1)
+        self.start[live_ids] = (self.start[live_ids] + num_expired) % self.MAX_QUEUE_LENGTH
+        self.length[live_ids] -= num_expired
+        # Start fresh so floating point error doesn't build up in the sums
+        self.pose_sum[self.length == 0] = 0
+
+
+    def get_expected_poses(self, now):
+        """
+            Calculates the Expected Value for each x, y, z of every live aruco
+            id, using the running average of its values.
+
+            Inputs:
+                - now <float>: time used to clear old values
+
+            Returns:
+                - aruco_ids <np.array(n)>: the aruco ids that have recent values
+                - expected_poses <np.array(n, 3)>: [x, y, z] values of where we
+                    expect each of those aruco markers to be
+        """
+        self.clear_old_values(now)
+        aruco_ids = np.flatnonzero(self.length)
+        expected_poses = self.pose_sum[aruco_ids] / self.length[aruco_ids, None]
+        return aruco_ids, expected_poses
+
+
+def simulate_students(num_markers, seconds, rng):
+    """
+        Simulates students walking between random points in C.DEFAULT_BOUNDS at
+        up to 150 cm/s, stopping for a moment at each point.
+
+        Returns:
+            - path_dict <dict>: aruco id: (times <np.array(k)>, poses <np.array(k, 3)>)
+                of the true path, every 10 ms
+    """
+    path_dict = {}
+    times = np.arange(0, seconds, 0.01)
+    for aruco_id in range(1, num_markers + 1):
+        position = np.array([
+            rng.uniform(C.DEFAULT_BOUNDS[0], C.DEFAULT_BOUNDS[1]),
+            rng.uniform(C.DEFAULT_BOUNDS[2], C.DEFAULT_BOUNDS[3]),
+            100.
+        ])
+        goal = position.copy()
+        speed = 0.
+        wait_until = 0.
+        poses = np.zeros((len(times), 3))
+        for i, t in enumerate(times):
+            offset = goal - position
+            distance = np.linalg.norm(offset)
+            if distance < 1. and t >= wait_until:
+                goal = np.array([
+                    rng.uniform(C.DEFAULT_BOUNDS[0], C.DEFAULT_BOUNDS[1]),
+                    rng.uniform(C.DEFAULT_BOUNDS[2], C.DEFAULT_BOUNDS[3]),
+                    100.
+                ])
+                speed = rng.uniform(50, 150)
+                wait_until = t + rng.uniform(0.5, 2)
+            elif distance >= 1.:
+                position = position + offset * min(1., speed * 0.01 / distance)
+                wait_until = t + rng.uniform(0.5, 2)
+            poses[i] = position
+        path_dict[aruco_id] = (times, poses)
+    return path_dict
+
+
+def get_measurements(path_dict, rate, noise, outliers, rng):
+    """
+        Samples the detected positions of every marker from its path, with
+        noise and outliers.
+
+        Returns:
+            - measurements <list<tuple>>: (timestamp, aruco_ids, poses) in time order
+    """
+    measurements = []
+    for aruco_id in path_dict:
+        times, poses = path_dict[aruco_id]
+        # Each marker is detected at slightly different times
+        sample_times = np.arange(rng.uniform(0, 1. / rate), times[-1], 1. / rate)
+        samples = np.stack([
+            np.interp(sample_times, times, poses[:, axis]) for axis in range(0, 3)
+        ], axis=1)
+        samples = samples + rng.normal(0, 1, samples.shape) * noise
+        is_outlier = rng.random(len(sample_times)) < outliers
+        directions = rng.normal(0, 1, (len(sample_times), 3))
+        directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+        samples[is_outlier] = samples[is_outlier] + 100 * directions[is_outlier]
+        for i, t in enumerate(sample_times):
+            measurements.append((t, [aruco_id], samples[i:i + 1]))
+    measurements.sort(key=lambda measurement: measurement[0])
+    return measurements
+
+
+def load_measurements(file_name, noise, outliers, window, rng):
+    """
+        Reads the positions of a pose history file as detections, and makes the
+        reference path of each marker with a centered moving average.
+
+        Returns:
+            - path_dict <dict>: see simulate_students()
+            - measurements <list<tuple>>: see get_measurements()
+    """
+    pose_history = load_pose_history(file_name)
+    timestamps = pose_history["timestamp"]
+    # Old pose histories were saved in ms
+    if len(timestamps) > 0 and timestamps.max() > 1e11:
+        timestamps = timestamps / 1000.
+    timestamps = timestamps - timestamps.min()
+    poses = np.stack([pose_history["x"], pose_history["y"], pose_history["z"]], axis=1)
+
+    path_dict = {}
+    measurements = []
+    for aruco_id in np.unique(pose_history["id"]):
+        mask = pose_history["id"] == aruco_id
+        times = timestamps[mask]
+        order = np.argsort(times)
+        times = times[order]
+        marker_poses = poses[mask][order].astype(np.float64)
+        reference = np.array([
+            marker_poses[np.abs(times - t) <= window / 2].mean(axis=0) for t in times
+        ])
+        path_dict[int(aruco_id)] = (times, reference)
+
+        samples = marker_poses + rng.normal(0, 1, marker_poses.shape) * noise
+        is_outlier = rng.random(len(times)) < outliers
+        samples[is_outlier] = samples[is_outlier] + 100
+        for i, t in enumerate(times):
+            measurements.append((t, [int(aruco_id)], samples[i:i + 1]))
+    measurements.sort(key=lambda measurement: measurement[0])
+    return path_dict, measurements
+
+
+def run_filter(pose_filter, measurements, frame_rate):
+    """
+        Pushes the measurements into a PoseStore or MarkerTracker and reads the
+        expected poses every 1/frame_rate seconds.
+
+        Returns:
+            - output_dict <dict>: aruco id: (times <list>, poses <list>)
+    """
+    output_dict = {}
+    i = 0
+    end = measurements[-1][0]
+    for tick in np.arange(0, end, 1. / frame_rate):
+        while i < len(measurements) and measurements[i][0] <= tick:
+            pose_filter.push_many(measurements[i][1], measurements[i][2], measurements[i][0])
+            i = i + 1
+        aruco_ids, poses = pose_filter.get_expected_poses(now=tick)
+        for j, aruco_id in enumerate(aruco_ids):
+            times, marker_poses = output_dict.setdefault(int(aruco_id), ([], []))
+            times.append(tick)
+            marker_poses.append(poses[j])
+    return output_dict
+
+
+def get_metrics(output_dict, path_dict):
+    """
+        Finds the latency, jitter and error of a filter's output, over every
+        marker.
+
+        Returns:
+            - latency <float>: ms, the delay which best lines the output up
+                with the reference path
+            - jitter <float>: cm, RMS distance from the delayed reference path
+            - error <float>: cm, RMS distance from the reference path
+    """
+    def get_offsets(delay):
+        offsets = []
+        for aruco_id in output_dict:
+            times = np.array(output_dict[aruco_id][0])
+            poses = np.array(output_dict[aruco_id][1])
+            path_times, path_poses = path_dict[aruco_id]
+            # Only compare where the reference path is known
+            keep = (times - delay >= path_times[0]) & (times - delay <= path_times[-1])
+            reference = np.stack([
+                np.interp(times[keep] - delay, path_times, path_poses[:, axis])
+                for axis in range(0, 3)
+            ], axis=1)
+            offsets.append(poses[keep] - reference)
+        offsets = np.concatenate(offsets)
+        return np.sqrt((offsets ** 2).sum(axis=1).mean())
+
+    delays = np.arange(0, 1.5, 0.01)
+    rms = np.array([get_offsets(delay) for delay in delays])
+    best = np.argmin(rms)
+    return 1000 * delays[best], rms[best], get_offsets(0.)
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    if args.file:
+        noise = args.noise if args.noise is not None else 0.
+        outliers = args.outliers if args.outliers is not None else 0.
+        path_dict, measurements = load_measurements(
+            args.file, noise, outliers, args.window, rng
+        )
+    else:
+        noise = args.noise if args.noise is not None else 5.
+        outliers = args.outliers if args.outliers is not None else 0.02
+        path_dict = simulate_students(args.markers, args.seconds, rng)
+        # Every camera sends a fused position of every marker it sees
+        measurements = get_measurements(
+            path_dict, C.CAMERA_FRAME_RATE * C.NUM_CAMERAS, noise, outliers, rng
+        )
+    print(len(measurements), "positions of", len(path_dict), "markers,",
+        noise, "cm noise,", outliers, "outliers"
+    )
+
+    pose_filters = [
+        ("average of 30", PoseStore(max_queue_length=30)),
+        ("average of " + str(POSE_QUEUE_LENGTH), PoseStore()),
+        ("kalman tracker", MarkerTracker(
+            measurement_sigma=noise if noise > 0 else C.TRACKER_MEASUREMENT_SIGMA
+        ))
+    ]
+    print("filter, latency (ms), jitter (cm), error (cm)")
+    for name, pose_filter in pose_filters:
+        output_dict = run_filter(pose_filter, measurements, C.MOCAP_OUT_FRAME_RATE)
+        latency, jitter, error = get_metrics(output_dict, path_dict)
+        print("%s, %.0f, %.2f, %.2f" % (name, latency, jitter, error))
@@ -0,0 +1,119 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from utils.Rectifier import Rectifier
+from utils.constants import constants as C
+
+# Compares the frames per second of the old cv2.undistort() path against the
+# Rectifier's precomputed remap tables, for each camera.
+# Examples:
+#   python benchmark_undistort.py                      (synthetic 640x480 frames)
+#   python benchmark_undistort.py -s 0 2 4 6           (live cv2 camera sources)
+#   python benchmark_undistort.py -s 2022_2_17_14_57_camera_1.avi
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-s", "--sources",
+    help="cv2.VideoCapture sources or video files, one per camera",
+    nargs="*"
+)
+parser.add_argument("-n", "--num-frames",
+    help="How many frames to undistort per camera (default 300)",
+    type=int,
+    default=300
+)
+args = parser.parse_args()
+
+
+def get_frames(src, num_frames):
+    """
+        Reads frames from a camera source, or makes random frames the size of
+        C.CAMERA_FRAME_SIZE if src is None. Frames are read before timing so
+        that we only measure the undistortion.
+
+        Inputs:
+            - src <int or string>: cv2.VideoCapture source, or None
+            - num_frames <int>: how many frames to read
+
+        Returns:
+            - frames <list<np.array>>: the frames to undistort
+    """
+    frames = []
+    if src is None:
+        w, h = C.CAMERA_FRAME_SIZE
+        for i in range(0, num_frames):
+            frames.append(np.random.randint(0, 256, (h, w, 3), dtype=np.uint8))
+        return frames
+
+    cap = cv2.VideoCapture(int(src) if src.isdigit() else src)
+    while len(frames) < num_frames:
+        test, frame = cap.read()
+        if not test:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def get_camera_meta(frame):
+    camera_meta = {}
+    camera_meta["mtx"] = C.CAMERA_CALIBRATION_MATRIX
+    camera_meta["dist_coeff"] = C.CAMERA_CALIBRATION_DISTANCE_COEFF
+    h, w = frame.shape[:2]
+    new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
+        camera_meta["mtx"],
+        camera_meta["dist_coeff"],
+        (w, h),
+        1,
+        (w, h)
+    )
+    camera_meta["new_camera_mtx"] = new_camera_mtx
+    camera_meta["roi"] = roi
+    return camera_meta
+
+
+def undistort_old(frames, camera_meta):
+    x, y, w, h = camera_meta["roi"]
+    for frame in frames:
+        undistorted_img = cv2.undistort(
+            frame,
+            camera_meta["mtx"],
+            camera_meta["dist_coeff"],
+            None,
+            camera_meta["new_camera_mtx"]
+        )
+        undistorted_img = undistorted_img[y:y+h, x:x+w]
+    return undistorted_img
+
+
+def undistort_remap(frames, rectifier):
+    for frame in frames:
+        undistorted_img = rectifier.undistort(frame)
+    return undistorted_img
+
+
+sources = args.sources if args.sources else [None] * C.NUM_CAMERAS
+print("camera, frames, undistort_fps, remap_fps, speedup, max_pixel_diff")
+for idx, src in enumerate(sources):
+    frames = get_frames(src, args.num_frames)
+    if len(frames) == 0:
+        print("No frames read from", src)
+        continue
+    camera_meta = get_camera_meta(frames[0])
+    rectifier = Rectifier(camera_meta)
+
+    start = time.perf_counter()
+    old_img = undistort_old(frames, camera_meta)
+    old_fps = len(frames) / (time.perf_counter() - start)
+
+    # The first call builds the maps, so it is counted in the timing as well
+    start = time.perf_counter()
+    new_img = undistort_remap(frames, rectifier)
+    new_fps = len(frames) / (time.perf_counter() - start)
+
+    max_diff = np.abs(old_img.astype(np.int16) - new_img.astype(np.int16)).max()
+    print("%d, %d, %.1f, %.1f, %.2fx, %d" % (
+        idx + 1, len(frames), old_fps, new_fps, new_fps / old_fps, max_diff
+    ))
@@ -0,0 +1,132 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+
+import cv2
+
+from utils.BundleAdjuster import BundleAdjuster
+from utils.ExtrinsicSolver import save_extrinsic_calibration
+from utils.constants import constants as C
+
+# Solves every camera's extrinsic matrix at once from all the
+# camera_world_calibration/camera_N_data.csv files, using the pictures that
+# more than one camera took at the same time (same file name) to make the
+# cameras agree with each other. Writes camera_N_extrinsic.json like
+# solve_extrinsics.py, which constants.py loads the next time the system starts.
+# A camera's file is only written if the joint solve doesn't make its world
+# error (against the surveyed positions) worse than its own fit.
+# Examples:
+#   python calibrate_all_cameras.py
+#   python calibrate_all_cameras.py --dry-run
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-c", "--cameras",
+    help="Camera ids to calibrate together (default 1 to C.NUM_CAMERAS)",
+    nargs="*",
+    type=int
+)
+parser.add_argument("-d", "--dry-run",
+    help="Include to only print the results without writing the calibration files",
+    action="store_true"
+)
+args = parser.parse_args()
+camera_ids = args.cameras if args.cameras else range(1, C.NUM_CAMERAS + 1)
+
+
+def read_data(file_name):
+    """
+        Reads a camera_N_data.csv, with columns
+        file, real_x, real_y, real_z, detected_x, detected_y, detected_z
+
+        Returns:
+            - file_names <list<string>>
+            - real_poses <np.array(n, 3)>
+            - detected_poses <np.array(n, 3)>
+    """
+    with open(file_name) as csvfile:
+        rows = [row for idx, row in enumerate(csv.reader(csvfile)) if idx != 0]
+    values = np.array([[float(x) for x in row[1:7]] for row in rows]).reshape(-1, 6)
+    return [row[0].strip() for row in rows], values[:, 0:3], values[:, 3:6]
+
+
+def print_stats(camera_id_stats_dict):
+    print("camera, observations, shared, inliers, reprojection_rmse (px), "
+        "median_reprojection (px), median_error (cm), median_disagreement (cm)")
+    for camera_id in camera_id_stats_dict:
+        stats = camera_id_stats_dict[camera_id]
+        print("%d, %d, %d, %d, %.2f, %.2f, %.1f, %.1f" % (
+            camera_id,
+            stats["num_observations"],
+            stats["num_shared"],
+            stats["num_inliers"],
+            stats["reprojection_rmse"],
+            stats["median_reprojection_error"],
+            stats["median_error"],
+            stats["median_disagreement"]
+        ))
+
+
+camera_id_data_dict = {}
+for camera_id in camera_ids:
+    data_file_name = os.path.join(
+        C.EXTRINSIC_CALIBRATION_PATH, "camera_" + str(camera_id) + "_data.csv"
+    )
+    if not os.path.exists(data_file_name):
+        print(data_file_name, "not found. Skipping")
+        continue
+    camera_id_data_dict[camera_id] = read_data(data_file_name)
+
+# The detections were estimated with the new_camera_mtx of a full frame
+camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
+    C.CAMERA_CALIBRATION_MATRIX,
+    C.CAMERA_CALIBRATION_DISTANCE_COEFF,
+    C.CAMERA_FRAME_SIZE,
+    1,
+    C.CAMERA_FRAME_SIZE
+)
+
+start = time.perf_counter()
+bundle_adjuster = BundleAdjuster(camera_id_data_dict, camera_mtx)
+print("Each camera solved on its own:")
+own_stats_dict = bundle_adjuster.get_camera_stats()
+print_stats(own_stats_dict)
+
+num_iterations = bundle_adjuster.solve()
+camera_id_stats_dict = bundle_adjuster.get_camera_stats()
+print("\nAll cameras solved together (%d points, %d iterations, %.2f s):" % (
+    len(bundle_adjuster.points),
+    num_iterations,
+    time.perf_counter() - start
+))
+print_stats(camera_id_stats_dict)
+
+for camera_index, camera_id in enumerate(bundle_adjuster.camera_ids):
+    extrinsic_matrix = bundle_adjuster.get_extrinsic_matrix(camera_index)
+    print("\nCamera", camera_id)
+    print(extrinsic_matrix)
+    median_error = camera_id_stats_dict[camera_id]["median_error"]
+    own_median_error = own_stats_dict[camera_id]["median_error"]
+    if median_error > own_median_error:
+        print("Not saving camera %d, its world error went from %.1f to %.1f cm. "
+            "Use solve_extrinsics.py for it instead" % (
+                camera_id, own_median_error, median_error
+            )
+        )
+        continue
+    if args.dry_run:
+        continue
+    calibration = {
+        "camera_id": camera_id,
+        "extrinsic_matrix": extrinsic_matrix.tolist(),
+        "method": "bundle_adjustment",
+        "num_samples": camera_id_stats_dict[camera_id]["num_observations"],
+        "num_inliers": camera_id_stats_dict[camera_id]["num_inliers"],
+        # Pixels, unlike the "rmse" (cm) of solve_extrinsics.py's files
+        "reprojection_rmse_px": camera_id_stats_dict[camera_id]["reprojection_rmse"],
+        "median_error": camera_id_stats_dict[camera_id]["median_error"],
+        "stats": camera_id_stats_dict[camera_id],
+        "created": time.time()
+    }
+    print(save_extrinsic_calibration(calibration))
@@ -0,0 +1,64 @@
+import argparse
+import numpy as np
+
+import yaml
+
+from utils.CalibrationStore import CalibrationStore
+from utils.constants import constants as C
+
+# Looks at or changes the per camera calibrations in C.CALIBRATION_STORE_PATH.
+# A running system reloads a changed calibration within
+# C.CALIBRATION_RELOAD_INTERVAL seconds.
+# Examples:
+#   python calibrations.py list
+#   python calibrations.py intrinsics camera_3 ../camera_calibration_checker/calibration.yaml
+#   python calibrations.py create camera_3 3 640 480
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="command")
+subparsers.add_parser("list", help="Print every camera's calibration")
+intrinsics_parser = subparsers.add_parser("intrinsics",
+    help="Set a camera's intrinsics from a camera_calibration.py yaml file"
+)
+intrinsics_parser.add_argument("identity", help="Camera identity, i.e. camera_3")
+intrinsics_parser.add_argument("yaml_file", help="yaml with camera_matrix and dist_coeff")
+create_parser = subparsers.add_parser("create",
+    help="Create a camera's calibration from the defaults in constants.py"
+)
+create_parser.add_argument("identity", help="Camera identity, i.e. camera_3")
+create_parser.add_argument("camera_id", help="Camera id in the real world", type=int)
+create_parser.add_argument("width", type=int, nargs="?", default=C.CAMERA_FRAME_SIZE[0])
+create_parser.add_argument("height", type=int, nargs="?", default=C.CAMERA_FRAME_SIZE[1])
+args = parser.parse_args()
+
+calibration_store = CalibrationStore()
+if args.command == "intrinsics":
+    with open(args.yaml_file) as f:
+        data = yaml.safe_load(f)
+    calibration_store.set_intrinsics(
+        args.identity,
+        data["camera_matrix"],
+        data["dist_coeff"]
+    )
+    print("Updated", args.identity)
+elif args.command == "create":
+    calibration = calibration_store.create(
+        args.identity,
+        args.camera_id,
+        (args.width, args.height)
+    )
+    calibration_store.save(calibration)
+    print("Created", args.identity)
+else:
+    for identity in calibration_store.get_identities():
+        calibration = calibration_store.get(identity)
+        if calibration is None:
+            continue
+        print(identity)
+        print("    camera_id:", calibration["camera_id"])
+        print("    version:", calibration["version"])
+        print("    frame_size:", calibration["frame_size"])
+        print("    roi:", calibration["roi"])
+        print("    focal length:", calibration["mtx"][0, 0], calibration["mtx"][1, 1])
+        print("    remap tables:", "yes" if len(calibration["maps"]) else "no")
+        print("    extrinsic_matrix:", "yes" if calibration["extrinsic_matrix"] is not None else "no")
@@ -0,0 +1,181 @@
+import argparse
+import csv
+import os
+
+import cv2
+from cv2 import aruco
+import numpy as np
+
+from utils.Rectifier import Rectifier
+from utils.constants import constants as C
+
+# Compares the accuracy of detecting aruco markers on the undistorted frame
+# (the default path in VideoStreamWidget) against detecting on the raw frame and
+# only undistorting the corners (C.DETECT_ON_RAW_FRAME = True).
+#
+# This reads the camera_world_calibration image sets. The images need to be
+# raw camera frames (v.save_image(PATH, "RAW") in collect_pictures.py), since
+# "GRAY" images have already been undistorted.
+#
+# For each camera it reports how often each path finds the marker, how far
+# apart the two intrinsic tvecs are, and how far each world position is from
+# the surveyed position in image_mappings.csv.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-c", "--cameras",
+    help="Which camera ids to compare (default all)",
+    nargs="*",
+    type=int
+)
+parser.add_argument("-p", "--path",
+    help="Folder holding the camera_<id> image folders",
+    default="camera_world_calibration/images/"
+)
+args = parser.parse_args()
+
+
+def get_camera_meta(img):
+    camera_meta = {}
+    camera_meta["mtx"] = C.CAMERA_CALIBRATION_MATRIX
+    camera_meta["dist_coeff"] = C.CAMERA_CALIBRATION_DISTANCE_COEFF
+    h, w = img.shape[:2]
+    new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
+        camera_meta["mtx"],
+        camera_meta["dist_coeff"],
+        (w, h),
+        1,
+        (w, h)
+    )
+    camera_meta["new_camera_mtx"] = new_camera_mtx
+    camera_meta["roi"] = roi
+    return camera_meta
+
+
+def detect(img_gray, corners_fn, camera_meta):
+    """
+        Detects aruco markers and estimates their pose.
+
+        Inputs:
+            - img_gray <np.array>: the grayscale image to detect markers on
+            - corners_fn <function>: applied to the detected corners before pose
+                estimation
+            - camera_meta <dict>: mtx, dist_coeff and new_camera_mtx
+
+        Returns:
+            - tvec_dict <dict>: aruco_id -> intrinsic tvec <np.array(3)>
+    """
+    tvec_dict = {}
+    corners, ids, rejected_pts = aruco.detectMarkers(
+        img_gray,
+        C.ARUCO_DICT,
+        parameters=C.ARUCO_PARAMS
+    )
+    if len(corners) == 0:
+        return tvec_dict
+    rvecs, tvecs, _objPoints = aruco.estimatePoseSingleMarkers(
+        corners_fn(corners),
+        C.MARKER_LENGTH,
+        camera_meta["new_camera_mtx"],
+        camera_meta["dist_coeff"],
+        None,
+        None
+    )
+    for i, aruco_id in enumerate(ids):
+        tvec_dict[aruco_id[0]] = tvecs[i][0]
+    return tvec_dict
+
+
+def to_world(camera_id, tvec):
+    if camera_id not in C.CAMERA_EXTRINSIC_MATRIX_DICT:
+        return None
+    CAM_MAT = C.CAMERA_EXTRINSIC_MATRIX_DICT[camera_id]
+    return CAM_MAT[0:3, 0:3] @ tvec + CAM_MAT[0:3, 3]
+
+
+def compare_camera(camera_id):
+    read_path = args.path + "camera_" + str(camera_id) + "/"
+    rectifier = None
+    camera_meta = None
+    stats = {
+        "images": 0,
+        "undistorted_found": 0,
+        "raw_found": 0,
+        "tvec_diff": [],
+        "undistorted_world_err": [],
+        "raw_world_err": []
+    }
+
+    with open(read_path + "image_mappings.csv") as csvfile:
+        reader = csv.reader(csvfile, delimiter=",")
+        for idx, row in enumerate(reader):
+            if idx == 0:
+                continue
+            img = cv2.imread(read_path + row[0])
+            if img is None:
+                continue
+            if rectifier is None:
+                camera_meta = get_camera_meta(img)
+                rectifier = Rectifier(camera_meta)
+            stats["images"] = stats["images"] + 1
+            real = np.array([float(row[1]), float(row[2]), float(row[3])])
+
+            # Current path: undistort every pixel, then detect
+            undistorted_img = rectifier.undistort(img)
+            undistorted_tvecs = detect(
+                cv2.cvtColor(undistorted_img, cv2.COLOR_RGB2GRAY),
+                lambda corners: corners,
+                camera_meta
+            )
+            # Raw path: detect on the raw image, then undistort the corners
+            raw_tvecs = detect(
+                cv2.cvtColor(img, cv2.COLOR_RGB2GRAY),
+                rectifier.undistort_corners,
+                camera_meta
+            )
+
+            if len(undistorted_tvecs) != 0:
+                stats["undistorted_found"] = stats["undistorted_found"] + 1
+            if len(raw_tvecs) != 0:
+                stats["raw_found"] = stats["raw_found"] + 1
+
+            for aruco_id in undistorted_tvecs:
+                world = to_world(camera_id, undistorted_tvecs[aruco_id])
+                if world is not None:
+                    stats["undistorted_world_err"].append(
+                        np.linalg.norm(world - real)
+                    )
+                if aruco_id in raw_tvecs:
+                    stats["tvec_diff"].append(np.linalg.norm(
+                        undistorted_tvecs[aruco_id] - raw_tvecs[aruco_id]
+                    ))
+            for aruco_id in raw_tvecs:
+                world = to_world(camera_id, raw_tvecs[aruco_id])
+                if world is not None:
+                    stats["raw_world_err"].append(np.linalg.norm(world - real))
+    return stats
+
+
+def summarize(values):
+    if len(values) == 0:
+        return "n/a"
+    return "%.2f / %.2f" % (np.mean(values), np.max(values))
+
+
+camera_ids = args.cameras if args.cameras else range(1, C.NUM_CAMERAS + 1)
+for camera_id in camera_ids:
+    if not os.path.exists(args.path + "camera_" + str(camera_id)):
+        print("camera", camera_id, "image folder not found")
+        continue
+    stats = compare_camera(camera_id)
+    print("Camera", camera_id)
+    print("  images read:", stats["images"])
+    print("  marker found (undistorted / raw):",
+        stats["undistorted_found"], "/", stats["raw_found"]
+    )
+    print("  tvec difference cm (mean / max):", summarize(stats["tvec_diff"]))
+    print("  undistorted world error cm (mean / max):",
+        summarize(stats["undistorted_world_err"])
+    )
+    print("  raw world error cm (mean / max):",
+        summarize(stats["raw_world_err"])
+    )
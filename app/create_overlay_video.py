@@ -1,48 +1,382 @@
-import cv2
-from utils.constants import constants as C
+import os
 import time
+import argparse
 
+import cv2
+import numpy as np
 
-DATA_FILE_PATH = "/media/mighty/research-1/collected_data_from_cameras"
-DATE = "2022_2_17/2022_2_17_14_57_"
-video_file_name = "test.avi"
+from multiprocessing import Process
 
-screen_capture = cv2.VideoCapture("%s/screen/%sscreen.avi" % (DATA_FILE_PATH, DATE))
-video_captures_list = []
+from utils.FrameRecorder import FrameQueue, FrameRecorder
+from utils.RecordingIndex import RecordingIndex, get_index_file_name
+from utils.constants import constants as C
 
-for i in range(1,C.NUM_CAMERAS + 1):
-    vc = cv2.VideoCapture("%s/video/%scamera_%s.avi" % (DATA_FILE_PATH, DATE, i))
-    video_captures_list.append(vc)
+# Puts the camera videos of a session on top of its screen recording, i.e. to
+# show the students next to what Desmos showed. Every input is decoded (and
+# shrunk) in its own process, each output frame is put together in place in
+# the encoder's shared memory, and the encoding runs in a process of its own.
+# Recordings with an index are lined up by the time each frame was grabbed.
+# Older ones are assumed to start together and run at their frame rate.
+# Examples:
+#   python create_overlay_video.py 2022_2_17/2022_2_17_14_57_
+#   python create_overlay_video.py 2022_2_17/2022_2_17_14_57_ -l right --scale 0.4 -s 600 -e 900 -o part.avi
 
-video_writer = cv2.VideoWriter(video_file_name,
-    cv2.VideoWriter_fourcc(*'MJPG'),
-    C.CAMERA_FRAME_RATE,
-    C.SCREEN_CAPTURE_SIZE
+parser = argparse.ArgumentParser()
+parser.add_argument("session",
+    help="Name of the recordings up to the source, i.e. 2022_2_17/2022_2_17_14_57_"
+)
+parser.add_argument("-o", "--output",
+    help="Video file to write (default overlay.avi)",
+    default="overlay.avi"
+)
+parser.add_argument("-l", "--layout",
+    help="Where the cameras go: bottom, top, left or right (default bottom)",
+    choices=["bottom", "top", "left", "right"],
+    default="bottom"
+)
+parser.add_argument("--scale",
+    help="Size of each camera compared to its recording (default 0.55)",
+    type=float,
+    default=0.55
+)
+parser.add_argument("-p", "--padding",
+    help="Pixels between the cameras and the edge of the screen (default 50)",
+    type=int,
+    default=50
+)
+parser.add_argument("-n", "--num-cameras",
+    help="How many cameras were recorded (default C.NUM_CAMERAS)",
+    type=int,
+    default=C.NUM_CAMERAS
+)
+parser.add_argument("-r", "--frame-rate",
+    help="Frame rate of the overlay video (default C.SCREEN_CAPTURE_FRAME_RATE)",
+    type=float,
+    default=C.SCREEN_CAPTURE_FRAME_RATE
+)
+parser.add_argument("-s", "--start",
+    help="Seconds into the session to start from (default the start)",
+    type=float
 )
+parser.add_argument("-e", "--end",
+    help="Seconds into the session to stop at (default the end of the screen recording)",
+    type=float
+)
+parser.add_argument("--screen",
+    help="Screen recording to use (default C.SAVE_SCREEN_STREAM_FILE_PATH + session + screen.avi)"
+)
+parser.add_argument("--cameras",
+    help="Camera recordings up to the camera number (default C.SAVE_VIDEO_STREAM_FILE_PATH + session + camera_)"
+)
+args = parser.parse_args()
+
+
+def get_layout(layout, num_tiles, frame_size, tile_size, padding):
+    """
+        Finds where each camera goes on the screen, spread out evenly along
+        one side.
+
+        Inputs:
+            - layout <string>: "bottom", "top", "left" or "right"
+            - num_tiles <int>: how many cameras
+            - frame_size <tuple>: (w, h) of the screen recording
+            - tile_size <tuple>: (w, h) of each camera after scaling
+            - padding <int>: pixels between the cameras and the edge
+
+        Returns:
+            - positions <list<tuple>>: (x, y) of the top left corner of each
+                camera, or None if they don't fit
+    """
+    bg_w, bg_h = frame_size
+    f_w, f_h = tile_size
+    if layout in ["bottom", "top"]:
+        spacing = int((bg_w - (num_tiles * f_w)) / (num_tiles + 1))
+        y = bg_h - f_h - padding if layout == "bottom" else padding
+        # Camera 1 is on the right, like the first overlay videos
+        positions = [
+            (bg_w - f_w - (spacing * (i + 1)) - (f_w * i), y)
+            for i in range(0, num_tiles)
+        ]
+    else:
+        spacing = int((bg_h - (num_tiles * f_h)) / (num_tiles + 1))
+        x = bg_w - f_w - padding if layout == "right" else padding
+        positions = [
+            (x, (spacing * (i + 1)) + (f_h * i))
+            for i in range(0, num_tiles)
+        ]
+    for x, y in positions:
+        if x < 0 or y < 0 or x + f_w > bg_w or y + f_h > bg_h:
+            return None
+    return positions
+
+
+def decode_stream(src, frame_queue, first_frame, timestamps, frame_rate, size):
+    """
+        Decodes a video from first_frame on and puts every frame into
+        frame_queue, resized to size straight into shared memory. This is run
+        in a Process, one per input video.
+
+        Inputs:
+            - src <string>: the video file
+            - frame_queue <FrameQueue>: where the frames go
+            - first_frame <int>: the frame to start from
+            - timestamps <np.array>: seconds from the start of the session of
+                every frame, from the video's index. None to use
+                frame number / frame_rate
+            - frame_rate <float>: the frame rate the video was recorded at
+            - size <tuple>: (w, h) to resize each frame to
+
+        Returns: None
+    """
+    # Every input has its own process, so OpenCV's threads would only fight
+    # the other decoders for the same cores
+    cv2.setNumThreads(1)
+    shape = (size[1], size[0], 3)
+    capture = cv2.VideoCapture(src)
+    if first_frame > 0 and not capture.set(cv2.CAP_PROP_POS_FRAMES, first_frame):
+        # OpenCV can't seek far into some MJPG .avi files, so skip up to
+        # first_frame without decoding instead
+        for _ in range(0, first_frame):
+            if not capture.grab():
+                break
+    frame_number = first_frame
+    while timestamps is None or frame_number < len(timestamps):
+        status, img = capture.read()
+        if not status:
+            break
+        if timestamps is not None:
+            timestamp = float(timestamps[frame_number])
+        else:
+            timestamp = frame_number / frame_rate
+        # Wait for the compositor instead of dropping frames
+        slot = frame_queue.get_free_slot(block=True)
+        frame = frame_queue.get_frame(slot, shape)
+        if (img.shape[1], img.shape[0]) == size:
+            frame[:] = img
+        else:
+            cv2.resize(img, size, dst=frame, interpolation=cv2.INTER_AREA)
+        frame_queue.put(slot, timestamp, shape)
+        frame_number = frame_number + 1
+    capture.release()
+    frame_queue.close()
+
+
+class OverlayStream(object):
+    """
+        One input of the overlay: a video decoded by decode_stream() in its own
+        process, and the frame of it being shown.
+
+        - src <string>: the video file
+
+        - size <tuple>: (w, h) the frames are resized to
+
+        - period <float>: seconds each frame is shown for, at most
+
+        - frame_queue <FrameQueue>: the decoded frames
+
+        - current <tuple>: (slot, timestamp, frame) being shown, or None
+            before the first frame
+
+        - next <tuple>: the frame after current, once it is popped
+
+        - done <bool>: True once the video has no more frames
+
+        - process <Process>: Runs decode_stream
+    """
+    def __init__(self, src, size, first_frame, timestamps, frame_rate):
+        self.src = src
+        self.size = size
+        self.period = 1. / frame_rate
+        # The shown frame is held while the next ones are decoded
+        self.frame_queue = FrameQueue((size[1], size[0], 3), max_length=8)
+        self.current = None
+        self.next = None
+        self.done = False
+        self.process = Process(
+            target=decode_stream,
+            args=(src, self.frame_queue, first_frame, timestamps, frame_rate, size)
+        )
+        self.process.daemon = True
+        self.process.start()
+
+
+    def advance(self, tick):
+        """
+            Moves to the newest frame grabbed at or before tick, releasing the
+            frames that are skipped.
+
+            Inputs:
+                - tick <float>: seconds from the start of the session
+
+            Returns:
+                - frame <np.array>: the frame to show, or None before the
+                    video starts or after it ends
+        """
+        while not self.done:
+            if self.next is None:
+                item = self.frame_queue.pop()
+                if item is None:
+                    self.done = True
+                    break
+                self.next = item[0:3]
+            if self.next[1] > tick:
+                break
+            if self.current is not None:
+                self.frame_queue.release(self.current[0])
+            self.current = self.next
+            self.next = None
+        if self.current is None:
+            return None
+        if self.done and tick >= self.current[1] + self.period:
+            return None
+        return self.current[2]
+
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.frame_queue.shm.close()
+        self.frame_queue.shm.unlink()
+
+
+def get_stream_timing(src, frame_rate, session_start, start):
+    """
+        Finds the time of every frame of a video and the frame to start from.
+
+        Inputs:
+            - src <string>: the video file
+            - frame_rate <float>: the frame rate it was recorded at
+            - session_start <float>: time.time() value the session started at,
+                or None if no input has an index
+            - start <float>: seconds from the start of the session
+
+        Returns:
+            - timestamps <np.array>: seconds from the start of the session of
+                every frame, or None if the video has no index
+            - first_frame <int>: the frame showing at start
+            - end <float>: seconds from the start of the session when the
+                video ends, or None if it has no index. OpenCV's frame count
+                is often wrong for MJPG .avi files, so it isn't used
+    """
+    index_file_name = get_index_file_name(src)
+    if session_start is not None and os.path.exists(index_file_name):
+        timestamps = RecordingIndex(index_file_name).timestamps - session_start
+        first_frame = max(int(np.searchsorted(timestamps, start, side="right")) - 1, 0)
+        end = timestamps[-1] + 1. / frame_rate if len(timestamps) > 0 else 0.
+        return timestamps, first_frame, end
+
+    return None, int(np.floor(start * frame_rate)), None
+
 
-while True:
-    ret, background = screen_capture.read()
+if __name__ == "__main__":
+    screen_src = args.screen
+    if screen_src is None:
+        screen_src = C.SAVE_SCREEN_STREAM_FILE_PATH + args.session + "screen.avi"
+    camera_path = args.cameras
+    if camera_path is None:
+        camera_path = C.SAVE_VIDEO_STREAM_FILE_PATH + args.session + "camera_"
 
-    num_sources = len(video_captures_list)
-    padding = 50 #50px
+    capture = cv2.VideoCapture(screen_src)
+    status, background = capture.read()
+    capture.release()
+    if not status:
+        print("Could not read", screen_src)
+        raise SystemExit(1)
+    frame_size = (background.shape[1], background.shape[0])
 
-    bg_h = background.shape[0]
-    bg_w = background.shape[1]
+    camera_srcs = []
+    for i in range(1, args.num_cameras + 1):
+        src = camera_path + str(i) + ".avi"
+        if os.path.exists(src):
+            camera_srcs.append(src)
+        else:
+            print(src, "not found. Skipping camera", i)
 
-    f_w = C.CAMERA_FRAME_SIZE[0]
-    f_h = C.CAMERA_FRAME_SIZE[1]
+    tile_size = (
+        int(C.CAMERA_FRAME_SIZE[0] * args.scale),
+        int(C.CAMERA_FRAME_SIZE[1] * args.scale)
+    )
+    positions = get_layout(
+        args.layout, len(camera_srcs), frame_size, tile_size, args.padding
+    )
+    if positions is None:
+        print("The cameras don't fit on the", args.layout, "of the screen. Try a smaller --scale")
+        raise SystemExit(1)
 
-    scale = 0.55
+    # Every indexed recording is timed from the first frame of any of them
+    starts = []
+    for src in [screen_src] + camera_srcs:
+        index_file_name = get_index_file_name(src)
+        if os.path.exists(index_file_name):
+            index = RecordingIndex(index_file_name)
+            if len(index) > 0:
+                starts.append(index.timestamps[0])
+    session_start = float(min(starts)) if len(starts) > 0 else None
 
-    f_w_resize = int(f_w * scale)
-    f_h_resize = int(f_h * scale)
+    start = args.start if args.start is not None else 0.
+    timestamps, first_frame, end = get_stream_timing(
+        screen_src, C.SCREEN_CAPTURE_FRAME_RATE, session_start, start
+    )
+    if args.end is not None:
+        end = args.end if end is None else min(end, args.end)
+    screen = OverlayStream(
+        screen_src, frame_size, first_frame, timestamps, C.SCREEN_CAPTURE_FRAME_RATE
+    )
+    cameras = []
+    for src in camera_srcs:
+        timestamps, first_frame, camera_end = get_stream_timing(
+            src, C.CAMERA_FRAME_RATE, session_start, start
+        )
+        cameras.append(OverlayStream(
+            src, tile_size, first_frame, timestamps, C.CAMERA_FRAME_RATE
+        ))
 
-    spacing = int((bg_w - (num_sources * f_w_resize)) / (num_sources + 1))
+    recorder = FrameRecorder(
+        "overlay",
+        args.output,
+        frame_size=frame_size,
+        raw=False,
+        frame_rate=args.frame_rate,
+        max_length=4
+    )
+    shape = (frame_size[1], frame_size[0], 3)
+    f_w, f_h = tile_size
 
-    for idx, vc in enumerate(video_captures_list):
-        ret_2, foreground = vc.read()
-        if ret_2:
-            foreground = cv2.resize(foreground, (0,0), fx=scale, fy=scale)
-            background[bg_h - f_h_resize - padding : bg_h - padding, bg_w - f_w_resize - (spacing * (idx + 1)) - (f_w_resize * idx) : bg_w - (spacing * (idx + 1)) - (f_w_resize * idx),:] = foreground
+    begin = time.perf_counter()
+    num_frames = 0
+    while True:
+        tick = start + num_frames / args.frame_rate
+        if end is not None and tick >= end:
+            break
+        background = screen.advance(tick)
+        if screen.done and background is None:
+            break
+        # Put the frame together straight in the encoder's shared memory
+        slot = recorder.frame_queue.get_free_slot(block=True)
+        output = recorder.frame_queue.get_frame(slot, shape)
+        if background is not None:
+            np.copyto(output, background)
+        else:
+            output[:] = 0
+        for i, camera in enumerate(cameras):
+            foreground = camera.advance(tick)
+            if foreground is not None:
+                x, y = positions[i]
+                output[y:y + f_h, x:x + f_w] = foreground
+        recorder.frame_queue.put(
+            slot,
+            tick if session_start is None else session_start + tick,
+            shape
+        )
+        num_frames = num_frames + 1
 
-    video_writer.write(background)
+    recorder.stop()
+    seconds = time.perf_counter() - begin
+    for stream in [screen] + cameras:
+        stream.stop()
+    print("%.1f s of video in %.1f s (%.1fx real time)" % (
+        num_frames / args.frame_rate,
+        seconds,
+        num_frames / args.frame_rate / seconds if seconds > 0 else 0
+    ))
@@ -0,0 +1,72 @@
+import os
+import argparse
+
+import cv2
+
+from utils.FrameRecorder import read_raw_frames
+from utils.constants import constants as C
+
+# Encodes the raw recordings that app.py -s -d dumps (.raw) into videos that
+# replay_session.py and app.py -p can read. Each .avi is written next to its
+# .raw file. Frames keep their numbers, so the recording's index
+# (<name>_index.jsonl) works for both.
+# Examples:
+#   python encode_recording.py .../video/2022_2_17/2022_2_17_14_57_camera_1.raw
+#   python encode_recording.py .../video/2022_2_17/*.raw --delete
+
+parser = argparse.ArgumentParser()
+parser.add_argument("files",
+    help="The .raw files to encode",
+    nargs="+"
+)
+parser.add_argument("-r", "--frame-rate",
+    help="Frame rate of the videos (default C.CAMERA_FRAME_RATE)",
+    type=float,
+    default=C.CAMERA_FRAME_RATE
+)
+parser.add_argument("--delete",
+    help="Include to delete each .raw file once it is encoded",
+    action="store_true"
+)
+args = parser.parse_args()
+
+
+def encode_recording(raw_file_name, video_file_name, frame_rate):
+    """
+        Encodes every frame of a raw recording with C.RECORD_FOURCC.
+
+        Inputs:
+            - raw_file_name <string>: a .raw file written by a FrameRecorder
+            - video_file_name <string>: the .avi file to write
+            - frame_rate <float>: frame rate of the video
+
+        Returns:
+            - frame_count <int>: how many frames were encoded
+    """
+    video_result = None
+    frame_count = 0
+    for timestamp, img in read_raw_frames(raw_file_name):
+        if video_result is None:
+            video_result = cv2.VideoWriter(
+                video_file_name,
+                cv2.VideoWriter_fourcc(*C.RECORD_FOURCC),
+                frame_rate,
+                (img.shape[1], img.shape[0])
+            )
+        video_result.write(img)
+        frame_count = frame_count + 1
+    if video_result is not None:
+        video_result.release()
+    return frame_count
+
+
+if __name__ == "__main__":
+    for raw_file_name in args.files:
+        video_file_name = os.path.splitext(raw_file_name)[0] + ".avi"
+        if os.path.exists(video_file_name):
+            print(video_file_name, "already exists. Skipping")
+            continue
+        frame_count = encode_recording(raw_file_name, video_file_name, args.frame_rate)
+        print("Encoded", frame_count, "frames to", video_file_name)
+        if args.delete and frame_count > 0:
+            os.remove(raw_file_name)
@@ -3,101 +3,176 @@ from cv2 import aruco
 
 import csv
 import time
+import argparse
 import numpy as np
 
 import os
 
+from multiprocessing import Pool
+
 from utils.constants import constants as C
 
-# Change this as we go through each camera
-camera_id = 4
-
-READ_PATH = "camera_world_calibration/images/camera_" + str(camera_id) + "/"
-SAVE_PATH = "camera_world_calibration/camera_" + str(camera_id) + "_data.csv"
-print(READ_PATH)
-
-camera_meta = {}
-camera_meta["mtx"] = C.CAMERA_CALIBRATION_MATRIX
-camera_meta["dist_coeff"] = C.CAMERA_CALIBRATION_DISTANCE_COEFF
-
-img_gray = cv2.imread(READ_PATH + "299.jpg")
-h, w = img_gray.shape[:2]
-# https://docs.opencv.org/3.3.0/d9/d0c/group__calib3d.html#ga7a6c4e032c97f03ba747966e6ad862b1
-new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
-    camera_meta["mtx"],
-    camera_meta["dist_coeff"],
-    (w, h),
-    1,
-    (w, h)
-)
-camera_meta["new_camera_mtx"] = new_camera_mtx
-camera_meta["roi"] = roi
-
-
-def save_row(file, real_x, real_y, real_z, detected_x, detected_y, detected_z):
-    row = [real_x, real_y, real_z, detected_x, detected_y, detected_z]
-    with open(SAVE_PATH, "a") as f:
-        row = ( str(file) + "," +
-            str(real_x) + "," +
-            str(real_y) + "," +
-            str(real_z) + "," +
-            str(detected_x) + "," +
-            str(detected_y) + "," +
-            str(detected_z) + "\n"
-        )
-        f.write(row)
-    f.close()
-
-with open(READ_PATH + "image_mappings.csv") as csvfile:
-    # file_name, real_x, real_y, real_z
-    reader = csv.reader(csvfile, delimiter=",")
-    # This clears the file and then regenerates the file
-    with open(SAVE_PATH, "w") as f:
-        f.write(
-            "file, real_x, real_y, real_z, detected_x, detected_y, detected_z\n"
+# Scans the images of every camera in camera_world_calibration/images/camera_N/
+# for aruco markers and writes camera_world_calibration/camera_N_data.csv,
+# which maps the real world position of each image to the detected position.
+# Every image of every camera is detected in a process pool.
+# Examples:
+#   python generate_marker_data.py              (all C.NUM_CAMERAS cameras)
+#   python generate_marker_data.py -c 2 4       (only cameras 2 and 4)
+
+READ_PATH = "camera_world_calibration/images/camera_"
+SAVE_PATH = "camera_world_calibration/camera_"
+CSV_HEADER = "file, real_x, real_y, real_z, detected_x, detected_y, detected_z\n"
+
+# new_camera_mtx of each image size, so each worker only computes it once
+new_camera_mtx_dict = {}
+
+
+def get_new_camera_mtx(w, h):
+    if (w, h) not in new_camera_mtx_dict:
+        # https://docs.opencv.org/3.3.0/d9/d0c/group__calib3d.html#ga7a6c4e032c97f03ba747966e6ad862b1
+        new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
+            C.CAMERA_CALIBRATION_MATRIX,
+            C.CAMERA_CALIBRATION_DISTANCE_COEFF,
+            (w, h),
+            1,
+            (w, h)
         )
-    f.close()
-    for idx, row in enumerate(reader):
-
-        if idx == 0:
+        new_camera_mtx_dict[(w, h)] = new_camera_mtx
+    return new_camera_mtx_dict[(w, h)]
+
+
+def init_worker():
+    # Every worker detects its own images, so OpenCV's threads would only
+    # fight the other workers for the same cores
+    cv2.setNumThreads(1)
+
+
+def detect_image(job):
+    """
+        Finds the first aruco marker in one calibration image. This is run in
+        a Pool worker.
+
+        Inputs:
+            - job <tuple>: (camera_id <int>, row <list>), where row is the
+                [file_name, real_x, real_y, real_z] row of image_mappings.csv
+
+        Returns:
+            - camera_id <int>: the camera the image is from
+            - line <string>: the row to write in camera_N_data.csv, or None if
+                the image couldn't be read or has no aruco marker
+            - reason <string>: why the image was skipped, or None
+    """
+    camera_id, row = job
+    img = cv2.imread(READ_PATH + str(camera_id) + "/" + row[0])
+    if img is None:
+        return camera_id, None, "unreadable"
+
+    corners, detected_aruco_ids, rejected_pts = aruco.detectMarkers(
+        img,
+        C.ARUCO_DICT,
+        parameters=C.ARUCO_PARAMS
+    )
+    if len(corners) == 0:
+        return camera_id, None, "no_marker"
+
+    h, w = img.shape[:2]
+    rvecs, tvecs, _objPoints = aruco.estimatePoseSingleMarkers(
+        corners,
+        C.MARKER_LENGTH,
+        get_new_camera_mtx(w, h),
+        C.CAMERA_CALIBRATION_DISTANCE_COEFF,
+        None,
+        None
+    )
+    # file, real_x, real_y, real_z, detected_x, detected_y, detected_z
+    line = ( str(row[0]) + "," +
+        str(row[1]) + "," +
+        str(row[2]) + "," +
+        str(row[3]) + "," +
+        str(tvecs[0][0][0]) + "," +
+        str(tvecs[0][0][1]) + "," +
+        str(tvecs[0][0][2]) + "\n"
+    )
+    return camera_id, line, None
+
+
+def read_image_mappings(camera_id):
+    """
+        Reads the image_mappings.csv of a camera.
+
+        Inputs:
+            - camera_id <int>: the camera id
+
+        Returns:
+            - rows <list<list>>: [file_name, real_x, real_y, real_z] of every
+                image, or None if the camera has no image_mappings.csv
+    """
+    mappings_file_name = READ_PATH + str(camera_id) + "/image_mappings.csv"
+    if not os.path.exists(mappings_file_name):
+        return None
+    with open(mappings_file_name) as csvfile:
+        # file_name, real_x, real_y, real_z
+        reader = csv.reader(csvfile, delimiter=",")
+        rows = [row for idx, row in enumerate(reader) if idx != 0 and len(row) >= 4]
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cameras",
+        help="Camera ids to generate data for (default 1 to C.NUM_CAMERAS)",
+        nargs="*",
+        type=int
+    )
+    parser.add_argument("-w", "--workers",
+        help="How many processes to detect with (default one per core)",
+        type=int
+    )
+    args = parser.parse_args()
+    camera_ids = args.cameras if args.cameras else range(1, C.NUM_CAMERAS + 1)
+
+    jobs = []
+    camera_id_rows_dict = {}
+    for camera_id in camera_ids:
+        rows = read_image_mappings(camera_id)
+        if rows is None:
+            print(READ_PATH + str(camera_id) + "/image_mappings.csv not found. Skipping")
             continue
-
-        try:
-            img_gray = cv2.imread(READ_PATH + row[0])
-        except:
-            pass
-        if img_gray is not None:
-            # cv2.imshow("img", img_gray)
-
-            corners, detected_aruco_ids, rejected_pts = aruco.detectMarkers(
-                img_gray,
-                C.ARUCO_DICT,
-                parameters=C.ARUCO_PARAMS
-            )
-
-            if len(corners) != 0:
-                rvecs, tvecs, _objPoints = aruco.estimatePoseSingleMarkers(
-                    corners,
-                    C.MARKER_LENGTH,
-                    camera_meta["new_camera_mtx"],
-                    camera_meta["dist_coeff"],
-                    None,
-                    None
-                )
-
-                detected_x = tvecs[0][0][0]
-                detected_y = tvecs[0][0][1]
-                detected_z = tvecs[0][0][2]
-
-                save_row(
-                    row[0],
-                    row[1],
-                    row[2],
-                    row[3],
-                    detected_x,
-                    detected_y,
-                    detected_z
-                )
-            # else:
-                # print(READ_PATH + row[0])
-                # os.remove((READ_PATH + row[0]))
+        camera_id_rows_dict[camera_id] = rows
+        jobs = jobs + [(camera_id, row) for row in rows]
+
+    start = time.perf_counter()
+    with Pool(args.workers, initializer=init_worker) as pool:
+        # imap keeps the results in the order of image_mappings.csv
+        results = pool.imap(detect_image, jobs, chunksize=8)
+
+        camera_id_lines_dict = dict([(camera_id, []) for camera_id in camera_id_rows_dict])
+        camera_id_skipped_dict = dict([
+            (camera_id, {"unreadable": 0, "no_marker": 0})
+            for camera_id in camera_id_rows_dict
+        ])
+        for camera_id, line, reason in results:
+            if line is None:
+                camera_id_skipped_dict[camera_id][reason] += 1
+            else:
+                camera_id_lines_dict[camera_id].append(line)
+
+    print("camera, images, rows written, skipped (no marker), skipped (unreadable)")
+    for camera_id in camera_id_rows_dict:
+        if (camera_id_skipped_dict[camera_id]["unreadable"] ==
+            len(camera_id_rows_dict[camera_id])):
+            # Don't wipe out a dataset because its images aren't on this computer
+            print("No images read for camera", camera_id, "Not overwriting its data")
+            continue
+        # This clears the file and then regenerates the file in one write
+        with open(SAVE_PATH + str(camera_id) + "_data.csv", "w") as f:
+            f.write(CSV_HEADER + "".join(camera_id_lines_dict[camera_id]))
+        print("%d, %d, %d, %d, %d" % (
+            camera_id,
+            len(camera_id_rows_dict[camera_id]),
+            len(camera_id_lines_dict[camera_id]),
+            camera_id_skipped_dict[camera_id]["no_marker"],
+            camera_id_skipped_dict[camera_id]["unreadable"]
+        ))
+    print("%d images in %.2f s" % (len(jobs), time.perf_counter() - start))
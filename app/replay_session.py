@@ -0,0 +1,89 @@
+import os
+import argparse
+
+from utils.ReplayEngine import ReplayEngine
+from utils.constants import constants as C
+
+# Reprocesses a recorded session as fast as the CPU allows, and writes the
+# fused pose history and the throughput stats (<output>_stats.json).
+# Recordings with an index (<video>_index.jsonl) are lined up by the capture
+# time of each frame, and --start/--end seek straight to that part.
+# Examples:
+#   python replay_session.py .../video/2022_2_17/2022_2_17_14_57_camera_ -o replay.csv
+#   python replay_session.py .../video/2022_2_17/2022_2_17_14_57_camera_ -s 600 -e 660 -i
+
+parser = argparse.ArgumentParser()
+parser.add_argument("path",
+    help="Path to the videos up to the camera number, i.e. .../2022_2_17_14_57_camera_"
+)
+parser.add_argument("-o", "--output",
+    help="Pose history file to write (default <path>replay_pose_history.csv or .bin)"
+)
+parser.add_argument("-f", "--format",
+    help="csv or binary (default C.POSE_HISTORY_FORMAT)",
+    default=C.POSE_HISTORY_FORMAT
+)
+parser.add_argument("-n", "--num-cameras",
+    help="How many cameras were recorded (default C.NUM_CAMERAS)",
+    type=int,
+    default=C.NUM_CAMERAS
+)
+parser.add_argument("-s", "--start",
+    help="Seconds into the session to start replaying from (default the start)",
+    type=float
+)
+parser.add_argument("-e", "--end",
+    help="Seconds into the session to stop replaying at (default the end)",
+    type=float
+)
+parser.add_argument("-i", "--from-index",
+    help="Include to fuse the detections saved in each recording's index instead of detecting again",
+    action="store_true"
+)
+parser.add_argument("-w", "--workers",
+    help="How many processes to detect with (default one per camera)",
+    type=int
+)
+args = parser.parse_args()
+
+if args.format not in ["csv", "binary"]:
+    print("Format must be csv or binary")
+    raise SystemExit(1)
+
+output = args.output
+if output is None:
+    output = args.path + "replay_pose_history" + (
+        ".bin" if args.format == "binary" else ".csv"
+    )
+if os.path.exists(output):
+    print(output, "already exists. Pick another --output.")
+    raise SystemExit(1)
+
+replay_engine = ReplayEngine(
+    args.path,
+    output,
+    format=args.format,
+    num_workers=args.workers,
+    num_cameras=args.num_cameras,
+    start=args.start,
+    end=args.end,
+    use_index=args.from_index
+)
+stats = replay_engine.run()
+
+print("camera, frames, detections, fps")
+for camera_id in stats["cameras"]:
+    camera_stats = stats["cameras"][camera_id]
+    print("%s, %d, %d, %.1f" % (
+        camera_id,
+        camera_stats["num_frames"],
+        camera_stats["num_detections"],
+        camera_stats["fps"]
+    ))
+print("%.1f s of video in %.1f s (%.1fx real time), %d poses written to %s" % (
+    stats["video_seconds"],
+    stats["total_seconds"],
+    stats["speedup"],
+    stats["num_rows"],
+    output
+))
@@ -0,0 +1,71 @@
+import os
+import argparse
+import numpy as np
+
+from utils.ExtrinsicSolver import ExtrinsicSolver, get_residuals, save_extrinsic_calibration
+from utils.constants import constants as C
+
+# Finds each camera's extrinsic matrix from camera_world_calibration/camera_N_data.csv
+# (made by generate_marker_data.py) and writes camera_N_extrinsic.json, which
+# constants.py loads the next time the system starts. No Julia needed.
+# Examples:
+#   python solve_extrinsics.py                  (all C.NUM_CAMERAS cameras)
+#   python solve_extrinsics.py -c 3 --dry-run   (only print camera 3's fit)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-c", "--cameras",
+    help="Camera ids to calibrate (default 1 to C.NUM_CAMERAS)",
+    nargs="*",
+    type=int
+)
+parser.add_argument("-t", "--threshold",
+    help="cm. Samples further than this from the fit are outliers (default C.EXTRINSIC_RANSAC_THRESHOLD)",
+    type=float,
+    default=C.EXTRINSIC_RANSAC_THRESHOLD
+)
+parser.add_argument("-d", "--dry-run",
+    help="Include to only print the results without writing the calibration files",
+    action="store_true"
+)
+args = parser.parse_args()
+camera_ids = args.cameras if args.cameras else range(1, C.NUM_CAMERAS + 1)
+
+print("camera, samples, inliers, rmse, median_error, old_median_error, file")
+for camera_id in camera_ids:
+    data_file_name = os.path.join(
+        C.EXTRINSIC_CALIBRATION_PATH, "camera_" + str(camera_id) + "_data.csv"
+    )
+    if not os.path.exists(data_file_name):
+        print(data_file_name, "not found. Skipping")
+        continue
+    solver = ExtrinsicSolver.from_csv(
+        camera_id,
+        data_file_name,
+        ransac_threshold=args.threshold
+    )
+    calibration = solver.solve()
+
+    # How well the matrix the system is using now fits the same samples
+    old_median_error = float("nan")
+    if camera_id in C.CAMERA_EXTRINSIC_MATRIX_DICT:
+        CAM_MAT = C.CAMERA_EXTRINSIC_MATRIX_DICT[camera_id]
+        old_median_error = np.median(get_residuals(
+            CAM_MAT[0:3, 0:3],
+            CAM_MAT[0:3, 3],
+            solver.detected_poses,
+            solver.real_poses
+        ))
+
+    file_name = "(dry run)"
+    if not args.dry_run:
+        file_name = save_extrinsic_calibration(calibration)
+    print("%d, %d, %d, %.1f, %.1f, %.1f, %s" % (
+        camera_id,
+        calibration["num_samples"],
+        calibration["num_inliers"],
+        calibration["rmse"],
+        calibration["median_error"],
+        old_median_error,
+        file_name
+    ))
+    print(np.array(calibration["extrinsic_matrix"]))
@@ -0,0 +1,441 @@
+import numpy as np
+
+from .constants import constants as C
+from .ExtrinsicSolver import ExtrinsicSolver
+
+def rotation_matrices(rotation_vectors):
+    """
+        Rodrigues' formula for a stack of rotation vectors, like cv2.Rodrigues
+        but for every vector at once.
+
+        Inputs:
+            - rotation_vectors <np.array(n, 3)>: axis * angle (radians)
+
+        Returns:
+            - R <np.array(n, 3, 3)>: rotation matrices
+    """
+    theta = np.linalg.norm(rotation_vectors, axis=1)
+    axis = rotation_vectors / np.maximum(theta, 1e-12)[:, None]
+    K = np.zeros((len(rotation_vectors), 3, 3))
+    K[:, 0, 1] = -axis[:, 2]
+    K[:, 0, 2] = axis[:, 1]
+    K[:, 1, 0] = axis[:, 2]
+    K[:, 1, 2] = -axis[:, 0]
+    K[:, 2, 0] = -axis[:, 1]
+    K[:, 2, 1] = axis[:, 0]
+    sin = np.sin(theta)[:, None, None]
+    cos = np.cos(theta)[:, None, None]
+    return np.eye(3)[None] + sin * K + (1 - cos) * (K @ K)
+
+
+class BundleAdjuster(object):
+    """
+        A BundleAdjuster solves the extrinsic matrices of every camera at once.
+        collect_pictures.py saves the pictures of every camera under the same
+        file name at the same time, so each file name is one position of the
+        marker seen by one or more cameras. We solve for every camera's pose
+        and every marker position together, so that the cameras have to agree
+        with each other instead of only with the surveyed positions.
+
+        Every observation (camera i sees the marker of file name j) has 3
+        residuals:
+            - 2 reprojection residuals: pixel distance between the marker
+                position projected into camera i, and where camera i detected it
+            - 1 range residual: distance from camera i to the marker position,
+                minus the distance camera i detected
+        Every marker position has 3 prior residuals: how far it is from its
+        surveyed position. Each residual is divided by its sigma.
+
+        Observations that each camera's own ExtrinsicSolver fit puts further
+        than C.EXTRINSIC_RANSAC_THRESHOLD from the surveyed position are
+        outliers, and are left out of the solve like the ExtrinsicSolver
+        leaves them out. Huber weights alone still let them pull the cameras
+        away from the surveyed positions.
+
+        An observation only depends on one camera and one marker position, so
+        the Jacobian is block sparse. Levenberg-Marquardt is solved with the
+        Schur complement: the marker positions are eliminated through their
+        3x3 blocks, leaving a (6 * num_cameras) square system for the cameras.
+        This keeps each step cheap with many more cameras and samples.
+
+        - camera_ids <list<int>>: the camera id of each camera index
+
+        - camera_R <np.array(num_cameras, 3, 3)>, camera_t <np.array(num_cameras, 3)>:
+            rotation and translation from each camera to the world
+
+        - points <np.array(num_points, 3)>: the estimated world position of
+            the marker in each file name
+
+        - real_points <np.array(num_points, 3)>: the surveyed world positions
+
+        - point_names <list<string>>: the file name of each point
+
+        - obs_camera, obs_point <np.array(num_obs)>: which camera and point
+            index each observation is of
+
+        - obs_detected <np.array(num_obs, 3)>: the [x, y, z] the camera detected
+
+        - obs_inlier <np.array(num_obs)>: 1. for the observations that are
+            solved with, 0. for the outliers
+
+        - camera_mtx <np.array(3, 3)>: camera matrix used for the reprojection
+            residuals. This should be the new_camera_mtx the detections were
+            estimated with.
+
+        - reprojection_sigma <float>: pixels. C.BA_REPROJECTION_SIGMA
+        - range_sigma <float>: cm. C.BA_RANGE_SIGMA
+        - prior_sigma <float>: cm. C.BA_PRIOR_SIGMA
+        - huber_delta <float>: observations whose normalized residual is
+            larger than this are downweighted. C.BA_HUBER_DELTA
+    """
+    def __init__(
+        self,
+        camera_id_data_dict,
+        camera_mtx,
+        reprojection_sigma=C.BA_REPROJECTION_SIGMA,
+        range_sigma=C.BA_RANGE_SIGMA,
+        prior_sigma=C.BA_PRIOR_SIGMA,
+        huber_delta=C.BA_HUBER_DELTA
+    ):
+        """
+            Inputs:
+                - camera_id_data_dict <dict>: for each camera id, the rows of
+                    its camera_N_data.csv as
+                    (file_names <list<string>>, real_poses <np.array(n, 3)>,
+                    detected_poses <np.array(n, 3)>)
+                - camera_mtx <np.array(3, 3)>
+        """
+        self.camera_mtx = camera_mtx
+        self.reprojection_sigma = reprojection_sigma
+        self.range_sigma = range_sigma
+        self.prior_sigma = prior_sigma
+        self.huber_delta = huber_delta
+
+        self.camera_ids = sorted(camera_id_data_dict)
+        point_index_dict = {}
+        self.point_names = []
+        real_points = []
+        obs_camera = []
+        obs_point = []
+        obs_detected = []
+        for camera_index, camera_id in enumerate(self.camera_ids):
+            file_names, real_poses, detected_poses = camera_id_data_dict[camera_id]
+            for i, file_name in enumerate(file_names):
+                if file_name not in point_index_dict:
+                    point_index_dict[file_name] = len(self.point_names)
+                    self.point_names.append(file_name)
+                    real_points.append(real_poses[i])
+                obs_camera.append(camera_index)
+                obs_point.append(point_index_dict[file_name])
+                obs_detected.append(detected_poses[i])
+        self.real_points = np.array(real_points, dtype=np.float64).reshape(-1, 3)
+        self.points = self.real_points.copy()
+        self.obs_camera = np.array(obs_camera, dtype=np.int64)
+        self.obs_point = np.array(obs_point, dtype=np.int64)
+        self.obs_detected = np.array(obs_detected, dtype=np.float64).reshape(-1, 3)
+        self.detected_pixels = self.project(self.obs_detected)
+        self.detected_range = np.linalg.norm(self.obs_detected, axis=1)
+
+        # Every pair of observations of the same point fills in one 6x6 block
+        # of the Schur complement
+        order = np.argsort(self.obs_point, kind="stable")
+        starts = np.searchsorted(self.obs_point[order], np.arange(len(self.points)))
+        ends = np.searchsorted(self.obs_point[order], np.arange(len(self.points)), side="right")
+        pair_a = []
+        pair_b = []
+        for j in range(0, len(self.points)):
+            obs = order[starts[j]:ends[j]]
+            pair_a.append(np.repeat(obs, len(obs)))
+            pair_b.append(np.tile(obs, len(obs)))
+        self.pair_a = np.concatenate(pair_a)
+        self.pair_b = np.concatenate(pair_b)
+
+        # Start every camera from its own ExtrinsicSolver fit
+        self.camera_R = np.zeros((len(self.camera_ids), 3, 3))
+        self.camera_t = np.zeros((len(self.camera_ids), 3))
+        for camera_index, camera_id in enumerate(self.camera_ids):
+            file_names, real_poses, detected_poses = camera_id_data_dict[camera_id]
+            calibration = ExtrinsicSolver(camera_id, real_poses, detected_poses).solve()
+            extrinsic_matrix = np.array(calibration["extrinsic_matrix"])
+            self.camera_R[camera_index] = extrinsic_matrix[0:3, 0:3]
+            self.camera_t[camera_index] = extrinsic_matrix[0:3, 3]
+
+        world_detected = self.get_world_detected()
+        self.obs_inlier = (
+            np.linalg.norm(world_detected - self.real_points[self.obs_point], axis=1)
+            < C.EXTRINSIC_RANSAC_THRESHOLD
+        ).astype(np.float64)
+
+
+    def project(self, camera_points):
+        """
+            Pinhole projection of points in a camera's coordinates to pixels.
+
+            Inputs:
+                - camera_points <np.array(n, 3)>
+
+            Returns:
+                - pixels <np.array(n, 2)>
+        """
+        K = self.camera_mtx
+        z = np.maximum(camera_points[:, 2], 1e-6)
+        return np.stack([
+            K[0, 0] * camera_points[:, 0] / z + K[0, 2],
+            K[1, 1] * camera_points[:, 1] / z + K[1, 2]
+        ], axis=1)
+
+
+    def get_obs_residuals(self, camera_R, camera_t, points):
+        """
+            The normalized residuals of every observation, where camera_R,
+            camera_t and points are already indexed per observation.
+
+            Returns:
+                - residuals <np.array(num_obs, 3)>: 2 reprojection, 1 range
+        """
+        # R^T (X - t), written with row vectors
+        camera_points = ((points - camera_t)[:, None, :] @ camera_R)[:, 0, :]
+        pixels = self.project(camera_points)
+        return np.concatenate([
+            (pixels - self.detected_pixels) / self.reprojection_sigma,
+            ((np.linalg.norm(camera_points, axis=1) - self.detected_range) /
+                self.range_sigma)[:, None]
+        ], axis=1)
+
+
+    def get_jacobians(self):
+        """
+            Central difference Jacobian of every observation's residuals, with
+            respect to its camera (rotation vector applied on the left, then
+            translation) and its point. All observations are differentiated
+            at once, so this is 18 vectorized residual evaluations.
+
+            Returns:
+                - residuals <np.array(num_obs, 3)>
+                - J_camera <np.array(num_obs, 3, 6)>
+                - J_point <np.array(num_obs, 3, 3)>
+        """
+        R = self.camera_R[self.obs_camera]
+        t = self.camera_t[self.obs_camera]
+        X = self.points[self.obs_point]
+        n = len(self.obs_camera)
+        residuals = self.get_obs_residuals(R, t, X)
+        J_camera = np.zeros((n, 3, 6))
+        J_point = np.zeros((n, 3, 3))
+        rotation_eps = 1e-6
+        translation_eps = 1e-3
+        for k in range(0, 3):
+            step = np.zeros((n, 3))
+            step[:, k] = rotation_eps
+            plus = self.get_obs_residuals(rotation_matrices(step) @ R, t, X)
+            minus = self.get_obs_residuals(rotation_matrices(-step) @ R, t, X)
+            J_camera[:, :, k] = (plus - minus) / (2 * rotation_eps)
+
+            step[:, k] = translation_eps
+            plus = self.get_obs_residuals(R, t + step, X)
+            minus = self.get_obs_residuals(R, t - step, X)
+            J_camera[:, :, 3 + k] = (plus - minus) / (2 * translation_eps)
+            J_point[:, :, k] = (minus - plus) / (2 * translation_eps)
+        return residuals, J_camera, J_point
+
+
+    def get_huber_weights(self, residuals):
+        norms = np.linalg.norm(residuals, axis=1)
+        return self.obs_inlier * np.where(
+            norms <= self.huber_delta,
+            1.,
+            self.huber_delta / np.maximum(norms, 1e-12)
+        )
+
+
+    def get_world_detected(self):
+        """
+            Returns:
+                - world_detected <np.array(num_obs, 3)>: every detected point
+                    moved into the world by its camera's current pose
+        """
+        R = self.camera_R[self.obs_camera]
+        t = self.camera_t[self.obs_camera]
+        return (R @ self.obs_detected[:, :, None])[:, :, 0] + t
+
+
+    def get_cost(self, camera_R, camera_t, points):
+        residuals = self.get_obs_residuals(
+            camera_R[self.obs_camera],
+            camera_t[self.obs_camera],
+            points[self.obs_point]
+        )
+        norms = np.linalg.norm(residuals, axis=1)
+        obs_cost = (self.obs_inlier * np.where(
+            norms <= self.huber_delta,
+            0.5 * norms ** 2,
+            self.huber_delta * (norms - 0.5 * self.huber_delta)
+        )).sum()
+        prior_cost = 0.5 * (((points - self.real_points) / self.prior_sigma) ** 2).sum()
+        return obs_cost + prior_cost
+
+
+    def solve_step(self, damping):
+        """
+            Solves one damped Gauss-Newton step with the Schur complement.
+
+            Inputs:
+                - damping <float>: Levenberg-Marquardt lambda
+
+            Returns:
+                - camera_step <np.array(num_cameras, 6)>
+                - point_step <np.array(num_points, 3)>
+        """
+        num_cameras = len(self.camera_ids)
+        num_points = len(self.points)
+        residuals, J_camera, J_point = self.get_jacobians()
+        # Huber as iteratively reweighted least squares
+        w = self.get_huber_weights(residuals)[:, None, None]
+        J_camera_T = np.swapaxes(J_camera, 1, 2)
+        J_point_T = np.swapaxes(J_point, 1, 2)
+
+        U = np.zeros((num_cameras, 6, 6))
+        np.add.at(U, self.obs_camera, J_camera_T @ (w * J_camera))
+        V = np.zeros((num_points, 3, 3))
+        np.add.at(V, self.obs_point, J_point_T @ (w * J_point))
+        V = V + np.eye(3) / self.prior_sigma ** 2
+        W = J_camera_T @ (w * J_point)
+
+        g_camera = np.zeros((num_cameras, 6))
+        np.add.at(g_camera, self.obs_camera, (J_camera_T @ (w * residuals[:, :, None]))[:, :, 0])
+        g_point = np.zeros((num_points, 3))
+        np.add.at(g_point, self.obs_point, (J_point_T @ (w * residuals[:, :, None]))[:, :, 0])
+        g_point = g_point + (self.points - self.real_points) / self.prior_sigma ** 2
+
+        # Marquardt scaling of the diagonals
+        U = U + damping * U * np.eye(6)[None]
+        V = V + damping * V * np.eye(3)[None]
+        V_inv = np.linalg.inv(V)
+
+        # S = U - W V^-1 W^T, summed over every pair of observations of a point
+        Y = W @ V_inv[self.obs_point]
+        S = np.zeros((num_cameras, num_cameras, 6, 6))
+        np.add.at(
+            S,
+            (self.obs_camera[self.pair_a], self.obs_camera[self.pair_b]),
+            -Y[self.pair_a] @ np.swapaxes(W[self.pair_b], 1, 2)
+        )
+        S[np.arange(num_cameras), np.arange(num_cameras)] += U
+        S = S.transpose(0, 2, 1, 3).reshape(6 * num_cameras, 6 * num_cameras)
+
+        b = -g_camera
+        V_inv_g_point = (V_inv @ g_point[:, :, None])[:, :, 0]
+        np.add.at(b, self.obs_camera, (W @ V_inv_g_point[self.obs_point][:, :, None])[:, :, 0])
+        camera_step = np.linalg.solve(S, b.reshape(-1)).reshape(num_cameras, 6)
+
+        rhs = -g_point
+        np.add.at(
+            rhs,
+            self.obs_point,
+            -(np.swapaxes(W, 1, 2) @ camera_step[self.obs_camera][:, :, None])[:, :, 0]
+        )
+        point_step = (V_inv @ rhs[:, :, None])[:, :, 0]
+        return camera_step, point_step
+
+
+    def solve(self, max_iterations=100, tolerance=1e-8):
+        """
+            Runs Levenberg-Marquardt until the cost stops improving.
+
+            Inputs:
+                - max_iterations <int>: most steps to take
+                - tolerance <float>: stop when the cost improves by less than
+                    this fraction
+
+            Returns:
+                - num_iterations <int>: how many steps were taken
+        """
+        damping = 1e-3
+        cost = self.get_cost(self.camera_R, self.camera_t, self.points)
+        num_iterations = 0
+        for num_iterations in range(1, max_iterations + 1):
+            camera_step, point_step = self.solve_step(damping)
+            new_R = rotation_matrices(camera_step[:, 0:3]) @ self.camera_R
+            new_t = self.camera_t + camera_step[:, 3:6]
+            new_points = self.points + point_step
+            new_cost = self.get_cost(new_R, new_t, new_points)
+            if new_cost < cost:
+                improvement = (cost - new_cost) / max(cost, 1e-12)
+                self.camera_R, self.camera_t, self.points = new_R, new_t, new_points
+                cost = new_cost
+                damping = max(damping / 3, 1e-9)
+                if improvement < tolerance:
+                    break
+            else:
+                damping = damping * 4
+                if damping > 1e9:
+                    break
+        return num_iterations
+
+
+    def get_extrinsic_matrix(self, camera_index):
+        extrinsic_matrix = np.eye(4)
+        extrinsic_matrix[0:3, 0:3] = self.camera_R[camera_index]
+        extrinsic_matrix[0:3, 3] = self.camera_t[camera_index]
+        return extrinsic_matrix
+
+
+    def get_camera_stats(self):
+        """
+            Residuals of each camera at the current solution.
+
+            Inputs: None
+
+            Returns:
+                - camera_id_stats_dict <dict>: for each camera id
+                    {
+                        "num_observations": <int>,
+                        "num_shared": <int> observations of a point that
+                            another camera also saw,
+                        "num_inliers": <int> observations that were solved
+                            with,
+                        "reprojection_rmse": <float> pixels,
+                        "median_reprojection_error": <float> pixels,
+                        "median_error": <float> cm, from the detected point
+                            moved into the world to the surveyed position,
+                        "median_point_error": <float> cm, from the detected
+                            point moved into the world to the solved position,
+                        "median_disagreement": <float> cm, for shared points,
+                            from the detected point moved into the world to
+                            the average of every camera's detection of it
+                    }
+        """
+        R = self.camera_R[self.obs_camera]
+        t = self.camera_t[self.obs_camera]
+        camera_points = ((self.points[self.obs_point] - t)[:, None, :] @ R)[:, 0, :]
+        pixel_errors = np.linalg.norm(
+            self.project(camera_points) - self.detected_pixels, axis=1
+        )
+        world_detected = self.get_world_detected()
+        real_errors = np.linalg.norm(world_detected - self.real_points[self.obs_point], axis=1)
+        point_errors = np.linalg.norm(world_detected - self.points[self.obs_point], axis=1)
+        num_views = np.bincount(self.obs_point, minlength=len(self.points))
+        mean_detected = np.stack([
+            np.bincount(self.obs_point, world_detected[:, k], len(self.points))
+            for k in range(0, 3)
+        ], axis=1) / np.maximum(num_views, 1)[:, None]
+        disagreements = np.linalg.norm(
+            world_detected - mean_detected[self.obs_point], axis=1
+        )
+
+        camera_id_stats_dict = {}
+        for camera_index, camera_id in enumerate(self.camera_ids):
+            obs = self.obs_camera == camera_index
+            shared = obs & (num_views[self.obs_point] > 1)
+            camera_id_stats_dict[camera_id] = {
+                "num_observations": int(obs.sum()),
+                "num_shared": int(shared.sum()),
+                "num_inliers": int(self.obs_inlier[obs].sum()),
+                "reprojection_rmse": float(np.sqrt(np.mean(pixel_errors[obs] ** 2))),
+                "median_reprojection_error": float(np.median(pixel_errors[obs])),
+                "median_error": float(np.median(real_errors[obs])),
+                "median_point_error": float(np.median(point_errors[obs])),
+                "median_disagreement": (float(np.median(disagreements[shared]))
+                    if shared.any() else 0.)
+            }
+        return camera_id_stats_dict
@@ -0,0 +1,356 @@
+import os
+import json
+import time
+import numpy as np
+
+import cv2
+
+from threading import Lock
+
+from .constants import constants as C
+
+class CalibrationStore(object):
+    """
+        A CalibrationStore keeps one calibration per camera on the disk, so
+        that each camera can have its own intrinsics and nothing is recomputed
+        at startup. Calibrations are keyed by a camera identity: a name that
+        stays the same for a physical camera, from CameraDiscovery.
+
+        Each camera has 3 files in folder:
+            - <identity>.json: camera_id, frame_size, mtx, dist_coeff,
+                new_camera_mtx, roi, extrinsic_matrix (None if the camera
+                isn't calibrated to the world) and version
+            - <identity>_map1.npy, <identity>_map2.npy: the CV_16SC2 remap
+                tables for frame_size, memory-mapped when they're loaded
+
+        Calibrations are only read when they're first asked for. reload()
+        checks the .json's modification time, so a running system picks up
+        a new calibration without restarting.
+
+        - folder <string>: where the calibration files are.
+            Corresponds to C.CALIBRATION_STORE_PATH
+
+        - calibration_dict <dict>: Loaded calibrations, keyed by identity.
+            Each one is a camera_meta (see MocapSystem) with the keys of the
+            .json, plus "identity", "maps" and "mtime"
+
+        - lock <Lock>: get() and reload() may be called from different threads
+    """
+    def __init__(self, folder=C.CALIBRATION_STORE_PATH):
+        self.folder = folder
+        self.calibration_dict = {}
+        self.lock = Lock()
+
+
+    def get_file_name(self, identity, suffix=".json"):
+        return os.path.join(self.folder, identity + suffix)
+
+
+    def get_identities(self):
+        """
+            Returns:
+                - identities <list<string>>: every camera identity in the store
+        """
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted([
+            file_name[:-len(".json")]
+            for file_name in os.listdir(self.folder)
+            if file_name.endswith(".json")
+        ])
+
+
+    def get_identity(self, camera_id):
+        """
+            Finds the camera identity that is calibrated as camera_id, i.e.
+            for replaying videos, which only know the camera id.
+
+            Returns:
+                - identity <string>: the identity, or "camera_<camera_id>" if
+                    no camera in the store has this camera id
+        """
+        for identity in self.get_identities():
+            calibration = self.get(identity)
+            if calibration is not None and calibration["camera_id"] == camera_id:
+                return identity
+        return "camera_" + str(camera_id)
+
+
+    def load(self, identity):
+        """
+            Reads a calibration from the disk. The remap tables are memory-mapped,
+            so only the pages cv2.remap() touches are read.
+
+            Inputs:
+                - identity <string>: the camera identity
+
+            Returns:
+                - calibration <dict>: the camera_meta of the camera, or None if
+                    the store has no calibration for it
+        """
+        file_name = self.get_file_name(identity)
+        try:
+            mtime = os.stat(file_name).st_mtime_ns
+            with open(file_name) as f:
+                saved = json.load(f)
+        except (OSError, ValueError) as error:
+            if os.path.exists(file_name):
+                print(error)
+                print("Could not read calibration", file_name)
+            return None
+
+        calibration = {
+            "identity": identity,
+            "camera_id": saved["camera_id"],
+            "frame_size": tuple(saved["frame_size"]),
+            "mtx": np.array(saved["mtx"]),
+            "dist_coeff": np.array(saved["dist_coeff"]),
+            "new_camera_mtx": np.array(saved["new_camera_mtx"]),
+            "roi": tuple(saved["roi"]),
+            "extrinsic_matrix": None,
+            "version": saved.get("version", 0),
+            "maps": {},
+            "mtime": mtime
+        }
+        if saved.get("extrinsic_matrix") is not None:
+            calibration["extrinsic_matrix"] = np.array(saved["extrinsic_matrix"]).reshape(4,4)
+        try:
+            calibration["maps"][calibration["frame_size"]] = (
+                np.load(self.get_file_name(identity, "_map1.npy"), mmap_mode="r"),
+                np.load(self.get_file_name(identity, "_map2.npy"), mmap_mode="r")
+            )
+        except (OSError, ValueError):
+            # The Rectifier builds the maps itself if they're missing
+            pass
+        return calibration
+
+
+    def get(self, identity):
+        """
+            Gets a calibration, reading it from the disk the first time.
+
+            Inputs:
+                - identity <string>: the camera identity
+
+            Returns:
+                - calibration <dict>: the camera_meta of the camera, or None
+        """
+        with self.lock:
+            if identity not in self.calibration_dict:
+                calibration = self.load(identity)
+                if calibration is None:
+                    return None
+                self.calibration_dict[identity] = calibration
+            return self.calibration_dict[identity]
+
+
+    def reload(self, identity):
+        """
+            Reads a calibration again if its file changed since it was loaded.
+
+            Inputs:
+                - identity <string>: the camera identity
+
+            Returns:
+                - calibration <dict>: the new calibration, or None if it
+                    didn't change
+        """
+        try:
+            mtime = os.stat(self.get_file_name(identity)).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            old = self.calibration_dict.get(identity)
+            if old is not None and old["mtime"] == mtime:
+                return None
+            calibration = self.load(identity)
+            if calibration is None:
+                return None
+            self.calibration_dict[identity] = calibration
+            return calibration
+
+
+    def save(self, calibration):
+        """
+            Writes a calibration and its remap tables. Each file is written to
+            a temporary file first, and the .json is replaced last, so a
+            running system never reloads half a calibration.
+
+            Inputs:
+                - calibration <dict>: a calibration from create() or get()
+
+            Returns: None
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        identity = calibration["identity"]
+        frame_size = tuple(calibration["frame_size"])
+        if frame_size in calibration["maps"]:
+            for i, suffix in enumerate(["_map1.npy", "_map2.npy"]):
+                file_name = self.get_file_name(identity, suffix)
+                with open(file_name + ".tmp", "wb") as f:
+                    np.save(f, np.ascontiguousarray(calibration["maps"][frame_size][i]))
+                os.replace(file_name + ".tmp", file_name)
+
+        extrinsic_matrix = calibration["extrinsic_matrix"]
+        saved = {
+            "camera_id": calibration["camera_id"],
+            "frame_size": list(frame_size),
+            "mtx": np.asarray(calibration["mtx"]).tolist(),
+            "dist_coeff": np.asarray(calibration["dist_coeff"]).tolist(),
+            "new_camera_mtx": np.asarray(calibration["new_camera_mtx"]).tolist(),
+            "roi": [int(x) for x in calibration["roi"]],
+            "extrinsic_matrix": (np.asarray(extrinsic_matrix).tolist()
+                if extrinsic_matrix is not None else None),
+            "version": calibration.get("version", 0) + 1,
+            "updated": time.time()
+        }
+        file_name = self.get_file_name(identity)
+        with open(file_name + ".tmp", "w") as f:
+            json.dump(saved, f, indent=4)
+        os.replace(file_name + ".tmp", file_name)
+        with self.lock:
+            self.calibration_dict.pop(identity, None)
+
+
+    def create(
+        self,
+        identity,
+        camera_id,
+        frame_size,
+        mtx=C.CAMERA_CALIBRATION_MATRIX,
+        dist_coeff=C.CAMERA_CALIBRATION_DISTANCE_COEFF,
+        extrinsic_matrix=None
+    ):
+        """
+            Computes a calibration the way MocapSystem.load_cameras() used to on
+            every startup: the optimal new camera matrix, its ROI and the remap
+            tables for frame_size. The extrinsic matrix defaults to camera_id's
+            in C.CAMERA_EXTRINSIC_MATRIX_DICT.
+
+            Inputs:
+                - identity <string>: the camera identity
+                - camera_id <int>: the camera id in the real world
+                - frame_size <tuple>: (w, h) of the camera's frames
+                - mtx <np.array(3,3)>, dist_coeff <np.array>: the intrinsics
+                - extrinsic_matrix <np.array(4,4)>: camera to world
+
+            Returns:
+                - calibration <dict>: the new calibration. It isn't saved.
+        """
+        frame_size = (int(frame_size[0]), int(frame_size[1]))
+        # https://docs.opencv.org/3.3.0/d9/d0c/group__calib3d.html#ga7a6c4e032c97f03ba747966e6ad862b1
+        new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
+            mtx,
+            dist_coeff,
+            frame_size,
+            1,
+            frame_size
+        )
+        if extrinsic_matrix is None and camera_id in C.CAMERA_EXTRINSIC_MATRIX_DICT:
+            extrinsic_matrix = C.CAMERA_EXTRINSIC_MATRIX_DICT[camera_id]
+        return {
+            "identity": identity,
+            "camera_id": camera_id,
+            "frame_size": frame_size,
+            "mtx": np.asarray(mtx),
+            "dist_coeff": np.asarray(dist_coeff),
+            "new_camera_mtx": new_camera_mtx,
+            "roi": tuple(roi),
+            "extrinsic_matrix": extrinsic_matrix,
+            "version": 0,
+            "maps": {
+                frame_size: cv2.initUndistortRectifyMap(
+                    mtx,
+                    dist_coeff,
+                    None,
+                    new_camera_mtx,
+                    frame_size,
+                    cv2.CV_16SC2
+                )
+            },
+            "mtime": None
+        }
+
+
+    def get_camera_meta(self, identity, camera_id, frame_size, save=True):
+        """
+            Gets the calibration of a camera for MocapSystem. If the store has
+            none for this identity, or it was made for a different camera id
+            or frame size, a calibration is made from the defaults in
+            constants.py (and saved, if save is True).
+
+            Inputs:
+                - identity <string>: the camera identity
+                - camera_id <int>: the camera id in the real world
+                - frame_size <tuple>: (w, h) of the camera's frames
+                - save <bool>: whether to save a new calibration
+
+            Returns:
+                - camera_meta <dict>: a copy of the calibration, to add "src"
+                    to
+        """
+        frame_size = (int(frame_size[0]), int(frame_size[1]))
+        calibration = self.get(identity)
+        if (calibration is None or
+            calibration["camera_id"] != camera_id or
+            calibration["frame_size"] != frame_size):
+            old = calibration
+            calibration = self.create(
+                identity,
+                camera_id,
+                frame_size,
+                mtx=old["mtx"] if old is not None else C.CAMERA_CALIBRATION_MATRIX,
+                dist_coeff=(old["dist_coeff"] if old is not None
+                    else C.CAMERA_CALIBRATION_DISTANCE_COEFF)
+            )
+            if save:
+                if old is not None:
+                    calibration["version"] = old["version"]
+                self.save(calibration)
+                calibration = self.get(identity)
+        return dict(calibration)
+
+
+    def set_intrinsics(self, identity, mtx, dist_coeff):
+        """
+            Replaces a camera's intrinsics, i.e. from camera_calibration.py, and
+            recomputes everything that depends on them.
+
+            Returns: None
+        """
+        old = self.get(identity)
+        if old is None:
+            raise KeyError("No calibration for " + identity)
+        calibration = self.create(
+            identity,
+            old["camera_id"],
+            old["frame_size"],
+            mtx=np.asarray(mtx, dtype=np.float64).reshape(3, 3),
+            dist_coeff=np.asarray(dist_coeff, dtype=np.float64).reshape(1, -1),
+            extrinsic_matrix=old["extrinsic_matrix"]
+        )
+        calibration["version"] = old["version"]
+        self.save(calibration)
+
+
+    def set_extrinsic_matrix(self, camera_id, extrinsic_matrix):
+        """
+            Replaces the extrinsic matrix of every identity with this camera id.
+            solve_extrinsics.py and calibrate_all_cameras.py call this so a
+            running system picks up a new world calibration.
+
+            Returns:
+                - identities <list<string>>: the identities that were updated
+        """
+        identities = []
+        for identity in self.get_identities():
+            calibration = self.get(identity)
+            if calibration is None or calibration["camera_id"] != camera_id:
+                continue
+            calibration = dict(calibration)
+            calibration["extrinsic_matrix"] = np.asarray(extrinsic_matrix).reshape(4,4)
+            # The remap tables didn't change, so don't write them again
+            calibration["maps"] = {}
+            self.save(calibration)
+            identities.append(identity)
+        return identities
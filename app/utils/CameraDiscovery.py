@@ -0,0 +1,231 @@
+import os
+import re
+import glob
+import json
+import time
+
+import cv2
+
+from threading import Thread
+
+from .constants import constants as C
+
+class CameraDiscovery(object):
+    """
+        CameraDiscovery finds the cameras that are plugged in and which camera
+        id each one is, without trying 100 cv2.VideoCapture sources one by one.
+
+            1. Only the real V4L2 capture nodes (/dev/videoN) are looked at.
+                The metadata nodes that UVC webcams also create are skipped.
+            2. Every node is opened and read at the same time, on its own
+                Thread. A node that doesn't give a frame in probe_timeout
+                seconds is skipped.
+            3. Each camera gets a stable identity from /dev/v4l/by-id (or the
+                USB port from /dev/v4l/by-path, if two cameras have the same
+                by-id name), so the same camera keeps its identity when the
+                /dev/videoN numbers change.
+            4. The camera id of each identity is saved in the profile. We only
+                ask which camera number it is for cameras not in the profile.
+
+        On computers without /dev/video*, sources 0 to C.CAMERA_PROBE_MAX_SOURCES
+        are probed in parallel instead, with identities "source_N".
+
+        - profile_file_name <string>: Where the camera id of each identity is
+            saved. Corresponds to C.CAMERA_PROFILE_FILE_NAME
+
+        - probe_timeout <float>: Most seconds to wait for the cameras to give
+            a frame. Corresponds to C.CAMERA_PROBE_TIMEOUT
+
+        - reassign <bool>: If True, ask for the camera number of every camera
+            again, even if it is in the profile
+
+        - profile <dict>: The camera id of each identity
+            {
+                "usb-046d_HD_Pro_Webcam_C920_1234ABCD-video-index0": 3
+            }
+    """
+    def __init__(
+        self,
+        profile_file_name=C.CAMERA_PROFILE_FILE_NAME,
+        probe_timeout=C.CAMERA_PROBE_TIMEOUT,
+        reassign=False
+    ):
+        self.profile_file_name = profile_file_name
+        self.probe_timeout = probe_timeout
+        self.reassign = reassign
+        self.profile = self.load_profile()
+
+
+    def load_profile(self):
+        try:
+            with open(self.profile_file_name) as f:
+                return dict([
+                    (identity, int(camera_id))
+                    for identity, camera_id in json.load(f)["cameras"].items()
+                ])
+        except (OSError, ValueError, KeyError):
+            return {}
+
+
+    def save_profile(self):
+        """
+            Writes the profile to a temporary file first, so a crash never
+            leaves half a profile.
+        """
+        folder = os.path.dirname(self.profile_file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(self.profile_file_name + ".tmp", "w") as f:
+            json.dump({"cameras": self.profile}, f, indent=4, sort_keys=True)
+        os.replace(self.profile_file_name + ".tmp", self.profile_file_name)
+
+
+    def list_devices(self):
+        """
+            Lists the V4L2 video capture nodes and their identities.
+
+            Inputs: None
+
+            Returns:
+                - devices <list<dict>>: sorted by src
+                    {
+                        "src": <int> the N of /dev/videoN, for cv2.VideoCapture,
+                        "identity": <string> stable name of the camera,
+                        "name": <string> name the driver gives the camera
+                    }
+        """
+        devices = []
+        for path in glob.glob("/dev/video*"):
+            match = re.match(r"^/dev/video(\d+)$", path)
+            if match is None:
+                continue
+            src = int(match.group(1))
+            sys_folder = "/sys/class/video4linux/video" + str(src)
+            # UVC webcams create a second node for metadata, with index 1.
+            # It can't give frames, so don't bother opening it
+            index = read_sys_file(os.path.join(sys_folder, "index"))
+            if index is not None and index != "0":
+                continue
+            devices.append({
+                "src": src,
+                "name": read_sys_file(os.path.join(sys_folder, "name")) or path,
+                "by_id": get_link_name("/dev/v4l/by-id/*", path),
+                "by_path": get_link_name("/dev/v4l/by-path/*", path)
+            })
+
+        # by-id names only have a serial number if the camera has one, so two
+        # of the same webcam can share a name. Use the USB port for those.
+        by_id_names = [device["by_id"] for device in devices]
+        for device in devices:
+            if device["by_id"] is not None and by_id_names.count(device["by_id"]) == 1:
+                identity = device["by_id"]
+            elif device["by_path"] is not None:
+                identity = device["by_path"]
+            else:
+                identity = device["name"] + "-video" + str(device["src"])
+            device["identity"] = re.sub(r"[^A-Za-z0-9_.-]", "_", identity)
+            del device["by_id"]
+            del device["by_path"]
+        return sorted(devices, key=lambda device: device["src"])
+
+
+    def probe(self, devices):
+        """
+            Opens every device and reads a frame from it, all at the same time.
+
+            Inputs:
+                - devices <list<dict>>: from list_devices()
+
+            Returns:
+                - cameras <list<dict>>: the devices that gave a frame in time,
+                    with "frame_size": (w, h) added
+        """
+        results = [None] * len(devices)
+
+        def probe_device(i):
+            if os.name == "posix":
+                cap = cv2.VideoCapture(devices[i]["src"], cv2.CAP_V4L2)
+            else:
+                cap = cv2.VideoCapture(devices[i]["src"])
+            test, frame = cap.read()
+            # Let go of the camera so the VideoStreamWidget (or a
+            # CaptureWorker in another process) can open it
+            cap.release()
+            if test:
+                results[i] = (frame.shape[1], frame.shape[0])
+
+        threads = []
+        for i in range(0, len(devices)):
+            # Daemon threads, so a camera that hangs can't keep us from exiting
+            thread = Thread(target=probe_device, args=(i,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        deadline = time.monotonic() + self.probe_timeout
+        for i, thread in enumerate(threads):
+            thread.join(max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                print("Camera", devices[i]["identity"], "didn't respond. Skipping")
+
+        cameras = []
+        for i, device in enumerate(devices):
+            if results[i] is not None:
+                camera = dict(device)
+                camera["frame_size"] = results[i]
+                cameras.append(camera)
+        return cameras
+
+
+    def discover(self):
+        """
+            Finds the working cameras and the camera id of each one. Only asks
+            the user for cameras that aren't in the profile.
+
+            Inputs: None
+
+            Returns:
+                - cameras <list<dict>>: from probe(), with "camera_id" added
+        """
+        start = time.monotonic()
+        devices = self.list_devices()
+        if len(devices) == 0:
+            devices = [
+                {"src": src, "identity": "source_" + str(src), "name": "source " + str(src)}
+                for src in range(0, C.CAMERA_PROBE_MAX_SOURCES)
+            ]
+        cameras = self.probe(devices)
+        print("Found", len(cameras), "cameras in %.1f s" % (time.monotonic() - start))
+
+        changed = False
+        for camera in cameras:
+            identity = camera["identity"]
+            if self.reassign or identity not in self.profile:
+                print("cv2 Camera Source", camera["src"], "found:", camera["name"], identity)
+                self.profile[identity] = int(input("Which Camera number?  "))
+                changed = True
+            camera["camera_id"] = self.profile[identity]
+        if changed:
+            self.save_profile()
+        return cameras
+
+
+def read_sys_file(file_name):
+    try:
+        with open(file_name) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_link_name(pattern, path):
+    """
+        Finds the symlink matching pattern that points to path, i.e. the
+        /dev/v4l/by-id name of /dev/video2.
+
+        Returns:
+            - name <string>: the name of the symlink, or None
+    """
+    for link in glob.glob(pattern):
+        if os.path.realpath(link) == os.path.realpath(path):
+            return os.path.basename(link)
+    return None
@@ -0,0 +1,442 @@
+import atexit
+import numpy as np
+
+import cv2
+
+from multiprocessing import Process, Pipe, Lock, Value, Array
+from multiprocessing import shared_memory
+from threading import Thread
+
+from .constants import constants as C
+from .VideoStreamWidget import VideoStreamWidget
+from .Rectifier import Rectifier
+from .CalibrationStore import CalibrationStore
+from .RoiDetector import COUNTER_NAMES, get_roi_stats
+
+# Each detection sent from a worker is a row of: aruco_id, rvec (3), tvec (3),
+# tvec_sigma, ray_sigma, camera_center (3), corner_rays (4 x 3). ray_sigma is
+# NaN if the camera isn't calibrated, and then the rest of the row is 0
+DETECTION_ROW_LENGTH = 24
+
+class SharedFrame(object):
+    """
+        A SharedFrame holds the latest image from a camera in shared memory,
+        so that it can be read from another process without pickling it.
+        The writer copies a frame in and readers copy it out, both under a lock.
+
+        - max_shape <tuple>: (h, w, channels) of the largest frame this can hold
+
+        - shm <SharedMemory>: the shared memory block holding the frame
+
+        - lock <Lock>: Makes sure we never read a half written frame
+
+        - frame_shape <Array>: (h, w, channels) of the frame currently held
+
+        - frame_count <Value>: How many frames have been written. Readers can
+            compare this to skip frames they've already seen.
+
+        - timestamp <Value>: time.time() value of when the frame held was
+            grabbed
+    """
+    def __init__(self, max_shape):
+        self.max_shape = max_shape
+        self.shm = shared_memory.SharedMemory(
+            create=True,
+            size=int(np.prod(max_shape))
+        )
+        self.lock = Lock()
+        self.frame_shape = Array("i", 3, lock=False)
+        self.frame_count = Value("L", 0, lock=False)
+        self.timestamp = Value("d", 0., lock=False)
+
+
+    def write(self, img, timestamp=0.):
+        """
+            Copies an image into shared memory.
+
+            Inputs:
+                - img <np.array>: uint8 image no bigger than max_shape
+                - timestamp <float>: time.time() value of when img was grabbed
+
+            Returns:
+                - success <bool>: False if the image didn't fit
+        """
+        if img is None or img.size > self.shm.size:
+            return False
+        shape = img.shape if img.ndim == 3 else (img.shape[0], img.shape[1], 1)
+        with self.lock:
+            frame = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+            frame[:] = img.reshape(shape)
+            self.frame_shape[:] = shape
+            self.timestamp.value = timestamp
+            self.frame_count.value = self.frame_count.value + 1
+        return True
+
+
+    def read(self):
+        """
+            Copies the latest image out of shared memory.
+
+            Inputs: None
+
+            Returns:
+                - img <np.array>: the latest image, or None if nothing has been
+                    written yet
+        """
+        stamped_img = self.read_stamped()
+        if stamped_img is None:
+            return None
+        return stamped_img[1]
+
+
+    def read_stamped(self):
+        """
+            Same as read(), with the timestamp it was written with, read
+            under the same lock
+
+            Returns:
+                - timestamp <float>: time.time() value of when img was grabbed
+                - img <np.array>: the latest image
+                Or None if nothing has been written yet
+        """
+        with self.lock:
+            if self.frame_count.value == 0:
+                return None
+            shape = tuple(self.frame_shape)
+            frame = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+            img = frame.copy()
+            timestamp = self.timestamp.value
+        if shape[2] == 1:
+            img = img.reshape(shape[0], shape[1])
+        return timestamp, img
+
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def run_capture_worker(
+    id,
+    camera_meta,
+    record_start_time,
+    sender,
+    raw_frame,
+    aruco_frame,
+    detection_counters,
+    frame_queue=None
+):
+    """
+        Runs a VideoStreamWidget inside a worker process. After every frame,
+        the raw and annotated images are written into shared memory and the
+        detections are sent through the pipe as packed float64 bytes:
+        [timestamp, aruco_id, rvec_x, rvec_y, rvec_z, tvec_x, tvec_y, tvec_z,
+            tvec_sigma, ray_sigma, camera_center (3), corner_rays (12), ...]
+
+        Inputs:
+            - id <int>: the camera id in the real world
+            - camera_meta <dict>: Meta info passed in from MocapSystem
+            - record_start_time <float>: time.time() value to start saving video
+            - sender <Connection>: the sending end of the detection pipe
+            - raw_frame <SharedFrame>: where to put the raw image
+            - aruco_frame <SharedFrame>: where to put the undistorted image with
+                the detected aruco markers drawn on it
+            - detection_counters <Array>: where to put the RoiDetector's
+                counters
+            - frame_queue <FrameQueue>: Optional queue of a FrameRecorder to
+                push the raw frames into
+
+        Returns: None
+    """
+    warned = False
+
+    def publish(v):
+        nonlocal warned
+        if not v.status:
+            return
+        wrote_raw = raw_frame.write(v.img_raw, v.frame_timestamp)
+        wrote_aruco = aruco_frame.write(v.undistorted_img, v.frame_timestamp)
+        if not (wrote_raw and wrote_aruco) and not warned:
+            # Only once, printing every frame would stall the worker
+            print("Camera", id, "frame", v.img_raw.shape, "doesn't fit in",
+                raw_frame.max_shape, "so it can't be previewed or saved"
+            )
+            warned = True
+        if v.roi_detector is not None:
+            detection_counters[:] = v.roi_detector.get_counters()
+        detections = [v.frame_timestamp]
+        for aruco_id in v.detected_aruco_ids_dict:
+            pose = v.detected_aruco_ids_dict[aruco_id]
+            detections.append(aruco_id)
+            detections.extend(np.ravel(pose["rvec"]))
+            detections.extend(np.ravel(pose["tvec"]))
+            detections.append(pose["tvec_sigma"])
+            if pose["corner_rays"] is None:
+                detections.append(np.nan)
+                detections.extend([0.] * 15)
+            else:
+                detections.append(pose["ray_sigma"])
+                detections.extend(np.ravel(pose["camera_center"]))
+                detections.extend(np.ravel(pose["corner_rays"]))
+        sender.send_bytes(np.array(detections, dtype=np.float64).tobytes())
+
+    v = VideoStreamWidget(
+        id,
+        camera_meta,
+        record_start_time,
+        on_frame=publish,
+        frame_queue=frame_queue
+    )
+    v.update_thread.join()
+
+
+class CaptureWorker(object):
+    """
+        CaptureWorker runs a camera's capture, undistortion and aruco detection
+        in its own Process, so that the cameras don't compete for one
+        interpreter lock. It has the same attributes that MocapSystem and
+        app.py use from a VideoStreamWidget, so the two can be swapped.
+
+        - id <int>: the camera id in the real world
+
+        - camera_meta <dict>: Meta info passed in from MocapSystem
+
+        - record_start_time <float>: time.time() value which determines when
+            to start saving video
+
+        - raw_frame <SharedFrame>: The latest raw image from the worker
+
+        - aruco_frame <SharedFrame>: The latest undistorted image from the
+            worker, with the detected aruco markers drawn on it
+
+        - rectifier <Rectifier>: Undistorts raw_frame for save_image()
+
+        - calibration_store <CalibrationStore>: Where rectifier's calibration
+            is reloaded from when it changes, like the worker's
+            VideoStreamWidget does. None if camera_meta has no identity
+
+        - detected_aruco_ids_dict <dict>: Same as in VideoStreamWidget, updated
+            whenever the worker sends new detections
+
+        - frame_timestamp <float>: time.time() value of when the worker read
+            the frame of the latest detections
+
+        - detection_queue <DetectionQueue>: Optional queue that the detections
+            are pushed into, for MocapSystem to fuse
+
+        - detection_counters <Array>: The worker's RoiDetector counters, see
+            RoiDetector.COUNTER_NAMES
+
+        - frame_queue <FrameQueue>: Optional queue of a FrameRecorder, that
+            the worker pushes the raw frames into. The FrameRecorder is made
+            in this process, since the daemon worker can't start its own.
+
+        - receiver <Connection>: The receiving end of the detection pipe
+
+        - process <Process>: Runs run_capture_worker
+
+        - receive_thread <Thread>: Reads detections from the pipe
+    """
+    def __init__(
+        self,
+        id,
+        camera_meta,
+        record_start_time,
+        detection_queue=None,
+        frame_queue=None
+    ):
+        self.id = id
+        self.camera_meta = camera_meta
+        self.record_start_time = record_start_time
+        self.rectifier = Rectifier(camera_meta)
+        self.calibration_store = None
+        if camera_meta.get("identity") is not None:
+            self.calibration_store = CalibrationStore()
+            self.calibration_store.get(camera_meta["identity"])
+        self.img_with_aruco = None
+
+        # The size the camera really gave when it was probed, which can
+        # differ from C.CAMERA_FRAME_SIZE if it doesn't support that
+        w, h = camera_meta.get("frame_size", C.CAMERA_FRAME_SIZE)
+        self.raw_frame = SharedFrame((h, w, 3))
+        self.aruco_frame = SharedFrame((h, w, 3))
+        self.detection_counters = Array("d", len(COUNTER_NAMES), lock=False)
+
+        self.detected_aruco_ids_dict = {}
+        self.frame_timestamp = None
+        self.detection_queue = detection_queue
+        self.frame_queue = frame_queue
+
+        self.receiver, sender = Pipe(duplex=False)
+        self.process = Process(
+            target=run_capture_worker,
+            args=(
+                id,
+                camera_meta,
+                record_start_time,
+                sender,
+                self.raw_frame,
+                self.aruco_frame,
+                self.detection_counters,
+                frame_queue
+            )
+        )
+        self.process.daemon = True
+        self.process.start()
+        # Only the worker sends, so close our copy of the sending end. This
+        # way recv_bytes() raises EOFError if the worker dies.
+        sender.close()
+
+        self.receive_thread = Thread(target=self.receive_detections, args=())
+        self.receive_thread.daemon = True
+        self.receive_thread.start()
+
+        atexit.register(self.stop)
+
+
+    @property
+    def img_raw(self):
+        return self.raw_frame.read()
+
+
+    @property
+    def undistorted_img(self):
+        return self.aruco_frame.read()
+
+
+    @property
+    def annotated_frame(self):
+        """
+            Same as VideoStreamWidget.annotated_frame, the worker only writes
+            aruco_frame once the markers are drawn
+        """
+        return self.aruco_frame.read_stamped()
+
+
+    def receive_detections(self):
+        """
+            Reads detections sent from the worker process, unpacks them
+            into detected_aruco_ids_dict and pushes them into detection_queue.
+            This function is run on receive_thread.
+
+            Inputs: None
+
+            Returns: None
+        """
+        while True:
+            try:
+                msg = self.receiver.recv_bytes()
+            except (EOFError, OSError):
+                print("Capture worker for camera", self.id, "stopped.")
+                return
+            detections = np.frombuffer(msg, dtype=np.float64)
+            timestamp = detections[0]
+            detections = detections[1:].reshape(-1, DETECTION_ROW_LENGTH)
+            marker_id_pose_dict = {}
+            for row in detections:
+                pose = {
+                    "camera_id": self.id,
+                    "rvec": row[1:4],
+                    "tvec": row[4:7],
+                    "tvec_sigma": row[7],
+                    "camera_center": None,
+                    "corner_rays": None,
+                    "ray_sigma": None
+                }
+                if not np.isnan(row[8]):
+                    pose["ray_sigma"] = row[8]
+                    pose["camera_center"] = row[9:12]
+                    pose["corner_rays"] = row[12:24].reshape(4, 3)
+                marker_id_pose_dict[int(row[0])] = pose
+            self.detected_aruco_ids_dict = marker_id_pose_dict
+            self.frame_timestamp = timestamp
+            if self.detection_queue is not None:
+                self.detection_queue.push(self.id, timestamp, marker_id_pose_dict)
+
+
+    def get_detection_stats(self):
+        """
+            Same as VideoStreamWidget.get_detection_stats(), from the counters
+            the worker shares
+
+            Returns:
+                - stats <dict>: RoiDetector stats, or None if it isn't used
+        """
+        if not C.USE_ROI_DETECTION:
+            return None
+        return get_roi_stats(list(self.detection_counters))
+
+
+    def reload_rectifier(self):
+        """
+            Switches rectifier to the camera's new calibration if it changed
+            in the CalibrationStore. The worker reloads its own calibration,
+            so this is only needed before rectifier is used here.
+
+            Inputs: None
+
+            Returns: None
+        """
+        if self.calibration_store is None:
+            return
+        calibration = self.calibration_store.reload(self.camera_meta["identity"])
+        if calibration is None:
+            return
+        camera_meta = dict(calibration)
+        camera_meta["src"] = self.camera_meta["src"]
+        self.camera_meta = camera_meta
+        self.rectifier = Rectifier(camera_meta)
+
+
+    def save_image(self, file_path, type="RAW"):
+        """
+            Saves a singular image to a file path. Same as
+            VideoStreamWidget.save_image()
+
+            Inputs:
+                - file_path <string>: The file path to where to save the image
+                - type <string>: Which type of image the user wants to save.
+
+            Returns:
+                - success <bool>: Indicates if the saving was successful or not
+        """
+        img_to_save = None
+        if type == "RAW":
+            img_to_save = self.img_raw
+        elif type == "GRAY":
+            img_raw = self.img_raw
+            if img_raw is not None:
+                if not C.DETECT_ON_RAW_FRAME:
+                    # Calibration pictures must use the newest calibration
+                    self.reload_rectifier()
+                    img_raw = self.rectifier.undistort(img_raw)
+                img_to_save = cv2.cvtColor(img_raw, cv2.COLOR_RGB2GRAY)
+        elif type == "ARUCO":
+            img_to_save = self.undistorted_img
+        else:
+            print("Something went wrong in CaptureWorker.py save_image()")
+
+        if img_to_save is not None:
+            cv2.imwrite(file_path, img_to_save)
+            print("Saved an image to", file_path)
+            return True
+        return False
+
+
+    def stop(self):
+        """
+            Stops the worker process and frees the shared memory.
+
+            Inputs: None
+
+            Returns: None
+        """
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        try:
+            self.raw_frame.close(unlink=True)
+            self.aruco_frame.close(unlink=True)
+        except FileNotFoundError:
+            pass
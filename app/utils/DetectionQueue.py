@@ -0,0 +1,105 @@
+import queue
+from threading import Lock
+
+from .constants import constants as C
+
+class DetectionQueue(object):
+    """
+        A bounded queue of timestamped detection batches. Every camera pushes
+        a batch after each frame, and MocapSystem's fusion stage blocks on pop()
+        so that it only wakes up when there is new data. If the fusion stage
+        falls behind, the oldest batch is dropped so the cameras never block.
+
+        - max_length <int>: the most batches the queue will hold
+
+        - queue <queue.Queue>: the batches waiting to be fused
+            {
+                "camera_id": <int> the camera_id
+                "timestamp": <float> time.time() value of when the frame was read
+                "detected_aruco_ids_dict": <dict> the camera's detections, same
+                    format as VideoStreamWidget.detected_aruco_ids_dict
+            }
+
+        - pushed_count <int>: How many batches have been pushed
+
+        - dropped_count <int>: How many batches were dropped because the
+            queue was full
+
+        - popped_count <int>: How many batches have been handed to the
+            fusion stage
+    """
+    def __init__(self, max_length=C.DETECTION_QUEUE_LENGTH):
+        self.max_length = max_length
+        self.queue = queue.Queue(maxsize=max_length)
+        self.lock = Lock()
+        self.pushed_count = 0
+        self.dropped_count = 0
+        self.popped_count = 0
+
+
+    def push(self, camera_id, timestamp, detected_aruco_ids_dict):
+        """
+            Pushes a detection batch into the queue. If the queue is full, the
+            oldest batch is dropped to make room.
+
+            Inputs:
+                - camera_id <int>: the camera the detections came from
+                - timestamp <float>: time.time() value of when the frame was read
+                - detected_aruco_ids_dict <dict>: the detected aruco ids and
+                    their poses
+
+            Returns: None
+        """
+        batch = {
+            "camera_id": camera_id,
+            "timestamp": timestamp,
+            "detected_aruco_ids_dict": detected_aruco_ids_dict
+        }
+        # Several cameras push at once, so drop and put under one lock
+        with self.lock:
+            self.pushed_count = self.pushed_count + 1
+            while True:
+                try:
+                    self.queue.put_nowait(batch)
+                    return
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped_count = self.dropped_count + 1
+                    except queue.Empty:
+                        pass
+
+
+    def pop(self, timeout=None):
+        """
+            Waits for the next detection batch.
+
+            Inputs:
+                - timeout <float>: How many seconds to wait. Waits forever if None
+
+            Returns:
+                - batch <dict>: the oldest detection batch, or None if the
+                    timeout ran out
+        """
+        try:
+            batch = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.popped_count = self.popped_count + 1
+        return batch
+
+
+    def get_stats(self):
+        """
+            Inputs: None
+
+            Returns:
+                - stats <dict>: the current queue depth and counters
+        """
+        return {
+            "depth": self.queue.qsize(),
+            "max_length": self.max_length,
+            "pushed": self.pushed_count,
+            "dropped": self.dropped_count,
+            "popped": self.popped_count
+        }
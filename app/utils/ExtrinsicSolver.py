@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import numpy as np
+
+from .constants import constants as C
+from .CalibrationStore import CalibrationStore
+
+def fit_rigid_transforms(src, dst, weights=None):
+    """
+        Finds the rotation and translation which best maps src onto dst in the
+        (weighted) least squares sense, using the SVD of the cross covariance
+        (the Kabsch algorithm). Works on a stack of point sets at once, so
+        every RANSAC sample is fit in one call.
+
+        Inputs:
+            - src <np.array(..., n, 3)>: points in the camera's coordinates
+            - dst <np.array(..., n, 3)>: the same points in world coordinates
+            - weights <np.array(..., n)>: weight of each point pair. Defaults
+                to 1 for every pair.
+
+        Returns:
+            - R <np.array(..., 3, 3)>: rotation matrices
+            - t <np.array(..., 3)>: translation vectors, so dst = src @ R.T + t
+    """
+    if weights is None:
+        weights = np.ones(src.shape[:-1])
+    w = weights / weights.sum(axis=-1, keepdims=True)
+    src_centroid = (w[..., None] * src).sum(axis=-2)
+    dst_centroid = (w[..., None] * dst).sum(axis=-2)
+    src_centered = src - src_centroid[..., None, :]
+    dst_centered = dst - dst_centroid[..., None, :]
+    H = np.swapaxes(w[..., None] * src_centered, -1, -2) @ dst_centered
+    U, S, Vt = np.linalg.svd(H)
+    V = np.swapaxes(Vt, -1, -2)
+    Ut = np.swapaxes(U, -1, -2)
+    # Flip the last axis if we got a reflection instead of a rotation
+    d = np.where(np.linalg.det(V @ Ut) < 0, -1., 1.)
+    D = np.zeros(H.shape)
+    D[..., 0, 0] = 1
+    D[..., 1, 1] = 1
+    D[..., 2, 2] = d
+    R = V @ D @ Ut
+    t = dst_centroid - (R @ src_centroid[..., None])[..., 0]
+    return R, t
+
+
+def get_residuals(R, t, src, dst):
+    """
+        Distance between each transformed src point and its dst point, for
+        one or a stack of transforms.
+
+        Returns:
+            - residuals <np.array(..., n)>
+    """
+    transformed = src @ np.swapaxes(R, -1, -2) + t[..., None, :]
+    return np.linalg.norm(transformed - dst, axis=-1)
+
+
+class ExtrinsicSolver(object):
+    """
+        An ExtrinsicSolver finds a camera's extrinsic matrix (camera to world)
+        from the camera_N_data.csv made by generate_marker_data.py. This
+        replaces writing a Julia file for Posegraph.jl with generate_icp_jl.py
+        and pasting its output into constants.py.
+
+            1. RANSAC: fit a transform to many random sets of 3 samples at once
+                and keep the one that agrees with the most samples
+            2. Refine: iteratively reweighted least squares with Huber weights
+                on the inliers of 1, starting from the SVD fit of the inliers
+            3. Mark every sample within ransac_threshold of the refined fit
+                as an inlier
+
+        - camera_id <int>: the camera id in the real world
+
+        - real_poses <np.array(n, 3)>: the surveyed world [x, y, z] of each sample
+
+        - detected_poses <np.array(n, 3)>: the [x, y, z] the camera detected
+
+        - ransac_threshold <float>: cm. A sample further than this from a fit
+            is an outlier. Corresponds to C.EXTRINSIC_RANSAC_THRESHOLD
+
+        - ransac_iterations <int>: how many random samples RANSAC tries
+
+        - huber_delta <float>: cm. Samples with a larger residual are
+            downweighted during refinement. Corresponds to C.EXTRINSIC_HUBER_DELTA
+
+        - max_refine_iterations <int>: most IRLS iterations
+
+        - seed <int>: seed for RANSAC, so a calibration can be reproduced
+    """
+    def __init__(
+        self,
+        camera_id,
+        real_poses,
+        detected_poses,
+        ransac_threshold=C.EXTRINSIC_RANSAC_THRESHOLD,
+        ransac_iterations=C.EXTRINSIC_RANSAC_ITERATIONS,
+        huber_delta=C.EXTRINSIC_HUBER_DELTA,
+        max_refine_iterations=50,
+        seed=0
+    ):
+        self.camera_id = camera_id
+        self.real_poses = np.asarray(real_poses, dtype=np.float64).reshape(-1, 3)
+        self.detected_poses = np.asarray(detected_poses, dtype=np.float64).reshape(-1, 3)
+        self.ransac_threshold = ransac_threshold
+        self.ransac_iterations = ransac_iterations
+        self.huber_delta = huber_delta
+        self.max_refine_iterations = max_refine_iterations
+        self.seed = seed
+
+
+    @classmethod
+    def from_csv(cls, camera_id, file_name, **kwargs):
+        """
+            Reads a camera_N_data.csv, with columns
+            file, real_x, real_y, real_z, detected_x, detected_y, detected_z
+
+            Returns:
+                - solver <ExtrinsicSolver>
+        """
+        rows = np.loadtxt(
+            file_name,
+            delimiter=",",
+            skiprows=1,
+            usecols=(1, 2, 3, 4, 5, 6),
+            ndmin=2
+        )
+        return cls(camera_id, rows[:, 0:3], rows[:, 3:6], **kwargs)
+
+
+    def ransac(self):
+        """
+            Fits a transform to ransac_iterations random sets of 3 samples in
+            one vectorized call, and keeps the fit with the most inliers.
+
+            Inputs: None
+
+            Returns:
+                - inliers <np.array(n)>: boolean mask of the samples that agree
+                    with the best fit
+        """
+        n = len(self.real_poses)
+        if n <= 3:
+            return np.ones(n, dtype=bool)
+        rng = np.random.default_rng(self.seed)
+        # Sample 3 different indices for every iteration
+        samples = np.argsort(rng.random((self.ransac_iterations, n)), axis=1)[:, 0:3]
+        src = self.detected_poses[samples]
+        dst = self.real_poses[samples]
+        # Skip samples which are (nearly) on a line, they don't fix a rotation
+        area = np.linalg.norm(
+            np.cross(dst[:, 1] - dst[:, 0], dst[:, 2] - dst[:, 0]), axis=1
+        )
+        good = area > 1e-6
+        if not good.any():
+            return np.ones(n, dtype=bool)
+        R, t = fit_rigid_transforms(src[good], dst[good])
+        residuals = get_residuals(R, t, self.detected_poses, self.real_poses)
+        inlier_masks = residuals < self.ransac_threshold
+        best = np.argmax(inlier_masks.sum(axis=1))
+        if inlier_masks[best].sum() < 3:
+            return np.ones(n, dtype=bool)
+        return inlier_masks[best]
+
+
+    def refine(self, inliers):
+        """
+            Iteratively reweighted least squares with Huber weights, starting
+            from the closed form SVD fit of the inliers.
+
+            Inputs:
+                - inliers <np.array(n)>: boolean mask of the samples to fit
+
+            Returns:
+                - R <np.array(3, 3)>: rotation from camera to world
+                - t <np.array(3)>: translation from camera to world
+                - num_iterations <int>: how many IRLS iterations were run
+        """
+        src = self.detected_poses[inliers]
+        dst = self.real_poses[inliers]
+        R, t = fit_rigid_transforms(src, dst)
+        num_iterations = 0
+        for num_iterations in range(1, self.max_refine_iterations + 1):
+            residuals = get_residuals(R, t, src, dst)
+            weights = np.where(
+                residuals <= self.huber_delta,
+                1.,
+                self.huber_delta / np.maximum(residuals, 1e-12)
+            )
+            new_R, new_t = fit_rigid_transforms(src, dst, weights)
+            change = np.abs(new_R - R).max() + np.abs(new_t - t).max()
+            R, t = new_R, new_t
+            if change < 1e-9:
+                break
+        return R, t, num_iterations
+
+
+    def solve(self):
+        """
+            Finds the extrinsic matrix of the camera.
+
+            Inputs: None
+
+            Returns:
+                - calibration <dict>:
+                    {
+                        "camera_id": <int>,
+                        "extrinsic_matrix": <list> 4x4 camera to world matrix,
+                        "num_samples": <int>,
+                        "num_inliers": <int>,
+                        "rmse": <float> cm, of the inliers,
+                        "median_error": <float> cm, of every sample,
+                        "num_refine_iterations": <int>,
+                        "created": <float> time.time() of the calibration
+                    }
+        """
+        if len(self.real_poses) < 3:
+            raise ValueError(
+                "Camera " + str(self.camera_id) + " needs at least 3 samples"
+            )
+        inliers = self.ransac()
+        R, t, num_iterations = self.refine(inliers)
+        residuals = get_residuals(R, t, self.detected_poses, self.real_poses)
+        inliers = residuals < self.ransac_threshold
+        if inliers.sum() == 0:
+            inliers = np.ones(len(residuals), dtype=bool)
+
+        extrinsic_matrix = np.eye(4)
+        extrinsic_matrix[0:3, 0:3] = R
+        extrinsic_matrix[0:3, 3] = t
+        return {
+            "camera_id": self.camera_id,
+            "extrinsic_matrix": extrinsic_matrix.tolist(),
+            "num_samples": len(residuals),
+            "num_inliers": int(inliers.sum()),
+            "rmse": float(np.sqrt(np.mean(residuals[inliers] ** 2))),
+            "median_error": float(np.median(residuals)),
+            "num_refine_iterations": num_iterations,
+            "created": time.time()
+        }
+
+
+def get_extrinsic_file_name(camera_id, folder=C.EXTRINSIC_CALIBRATION_PATH):
+    return os.path.join(folder, "camera_" + str(camera_id) + "_extrinsic.json")
+
+
+def save_extrinsic_calibration(calibration, folder=C.EXTRINSIC_CALIBRATION_PATH):
+    """
+        Writes a calibration from ExtrinsicSolver.solve() to
+        camera_N_extrinsic.json, which constants.py loads over
+        CAMERA_EXTRINSIC_MATRIX_DICT. The file is written to a temporary file
+        first, so a running system never reads half a calibration. The
+        matrix is also put in the CalibrationStore, so running cameras
+        reload it.
+
+        Returns:
+            - file_name <string>: where the calibration was written
+    """
+    file_name = get_extrinsic_file_name(calibration["camera_id"], folder)
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(calibration, f, indent=4)
+    os.replace(file_name + ".tmp", file_name)
+    CalibrationStore().set_extrinsic_matrix(
+        calibration["camera_id"],
+        calibration["extrinsic_matrix"]
+    )
+    return file_name
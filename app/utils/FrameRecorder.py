@@ -0,0 +1,387 @@
+import os
+import json
+import time
+import atexit
+import queue
+import struct
+import numpy as np
+
+import cv2
+
+from multiprocessing import Process, Queue, Value
+from multiprocessing import shared_memory
+
+from .constants import constants as C
+from .RecordingIndex import get_index_file_name, detections_to_json
+
+# Every frame of a raw recording is this header followed by the frame's bytes:
+# timestamp, h, w, channels
+RAW_FRAME_HEADER = struct.Struct("<d3i")
+
+class FrameQueue(object):
+    """
+        A FrameQueue is a bounded queue of camera frames in shared memory. The
+        camera copies each frame into a free slot once, and the encoder
+        process reads it straight out of shared memory, so frames are never
+        pickled. Only slot numbers go through the queues. If every slot is
+        taken, i.e. the encoder can't keep up, the new frame is dropped so the
+        camera never waits.
+
+        - max_shape <tuple>: (h, w, channels) of the largest frame a slot holds
+
+        - max_length <int>: how many slots there are. Corresponds to
+            C.RECORD_QUEUE_LENGTH
+
+        - slot_size <int>: bytes in each slot
+
+        - shm <SharedMemory>: the shared memory block holding every slot
+
+        - free_slots <Queue>: slots the camera can write into
+
+        - full_slots <Queue>: (slot, timestamp, shape, detections) of each
+            frame waiting for the encoder, oldest first. None tells the
+            encoder to stop.
+
+        - pushed_count <Value>: How many frames have been pushed
+
+        - dropped_count <Value>: How many frames were dropped because every
+            slot was taken
+    """
+    def __init__(self, max_shape, max_length=C.RECORD_QUEUE_LENGTH):
+        self.max_shape = max_shape
+        self.max_length = max_length
+        self.slot_size = int(np.prod(max_shape))
+        self.shm = shared_memory.SharedMemory(
+            create=True,
+            size=self.slot_size * max_length
+        )
+        self.free_slots = Queue()
+        for slot in range(0, max_length):
+            self.free_slots.put(slot)
+        self.full_slots = Queue()
+        self.pushed_count = Value("L", 0, lock=False)
+        self.dropped_count = Value("L", 0, lock=False)
+
+
+    def get_frame(self, slot, shape):
+        """
+            Returns:
+                - frame <np.array>: the frame in slot, as a view of shared
+                    memory (not a copy)
+        """
+        return np.ndarray(
+            shape,
+            dtype=np.uint8,
+            buffer=self.shm.buf,
+            offset=slot * self.slot_size
+        )
+
+
+    def push(self, img, timestamp, detections=None, block=False):
+        """
+            Copies a frame into a free slot for the encoder. Only one process
+            should push into a FrameQueue.
+
+            Inputs:
+                - img <np.array>: uint8 image no bigger than max_shape
+                - timestamp <float>: time.time() value of when img was grabbed
+                - detections <dict>: the detected_aruco_ids_dict of the frame,
+                    for the recording's index
+                - block <bool>: If True, wait for a free slot instead of
+                    dropping the frame. Offline tools use this.
+
+            Returns:
+                - success <bool>: False if the frame was dropped
+        """
+        if img is None or img.size > self.slot_size:
+            return False
+        slot = self.get_free_slot(block)
+        if slot is None:
+            return False
+        self.get_frame(slot, img.shape)[:] = img
+        self.put(slot, timestamp, img.shape, detections)
+        return True
+
+
+    def get_free_slot(self, block=False):
+        """
+            Takes a free slot to write a frame into, for producers that write
+            the frame in place (i.e. ScreenCapture converts its colors straight
+            into the slot) instead of calling push(). Counts as a push.
+
+            Inputs:
+                - block <bool>: If True, wait for a slot to be released
+
+            Returns:
+                - slot <int>: the slot, or None if the frame has to be dropped
+        """
+        self.pushed_count.value = self.pushed_count.value + 1
+        try:
+            return self.free_slots.get(block=block)
+        except queue.Empty:
+            self.dropped_count.value = self.dropped_count.value + 1
+            return None
+
+
+    def put(self, slot, timestamp, shape, detections=None):
+        """
+            Hands a slot from get_free_slot() to the encoder, once its frame
+            of shape is written.
+        """
+        self.full_slots.put((slot, timestamp, shape, detections))
+
+
+    def pop(self):
+        """
+            Waits for the oldest frame. Call release() with its slot once it
+            is written.
+
+            Inputs: None
+
+            Returns:
+                - slot <int>: the slot of the frame
+                - timestamp <float>: time.time() value of when it was grabbed
+                - frame <np.array>: a view of the frame in shared memory
+                - detections <dict>: the detections pushed with it, or None
+                Or None if the queue was closed
+        """
+        item = self.full_slots.get()
+        if item is None:
+            return None
+        slot, timestamp, shape, detections = item
+        return slot, timestamp, self.get_frame(slot, shape), detections
+
+
+    def release(self, slot):
+        self.free_slots.put(slot)
+
+
+    def close(self):
+        """
+            Tells the encoder to stop once it has written every frame before
+            this.
+        """
+        self.full_slots.put(None)
+
+
+def run_frame_encoder(
+    frame_queue,
+    camera_id,
+    file_name,
+    raw,
+    frame_rate,
+    written_count
+):
+    """
+        Writes every frame of a FrameQueue to file_name until the queue is
+        closed, and a line for each one to the recording's index (see
+        RecordingIndex). This is run in the encoder process of a
+        FrameRecorder, so encoding never competes with aruco detection for an
+        interpreter. The index is flushed every
+        C.RECORD_INDEX_FLUSH_INTERVAL seconds, so it survives a crash.
+
+        Inputs:
+            - frame_queue <FrameQueue>: the frames to write
+            - camera_id <int>: the camera id in the real world
+            - file_name <string>: the .avi or .raw file to write
+            - raw <bool>: If True, dump the frames uncompressed, see
+                RAW_FRAME_HEADER. Otherwise encode them with C.RECORD_FOURCC
+            - frame_rate <float>: frame rate of the video
+            - written_count <Value>: How many frames have been written
+
+        Returns: None
+    """
+    video_result = None
+    raw_file = None
+    index_file = open(get_index_file_name(file_name), "w")
+    index_file.write(json.dumps({
+        "camera_id": camera_id,
+        "file_name": os.path.basename(file_name),
+        "raw": raw,
+        "frame_rate": frame_rate
+    }) + "\n")
+    frame_number = 0
+    next_flush = time.monotonic() + C.RECORD_INDEX_FLUSH_INTERVAL
+    while True:
+        item = frame_queue.pop()
+        if item is None:
+            break
+        slot, timestamp, frame, detections = item
+        offset = None
+        if raw:
+            if raw_file is None:
+                raw_file = open(file_name, "wb")
+            offset = raw_file.tell()
+            h, w = frame.shape[:2]
+            channels = frame.shape[2] if frame.ndim == 3 else 1
+            raw_file.write(RAW_FRAME_HEADER.pack(timestamp, h, w, channels))
+            raw_file.write(frame.data)
+        else:
+            if video_result is None:
+                # Open the video at the size of the camera's frames, since
+                # VideoWriter skips frames of any other size
+                video_result = cv2.VideoWriter(
+                    file_name,
+                    cv2.VideoWriter_fourcc(*C.RECORD_FOURCC),
+                    frame_rate,
+                    (frame.shape[1], frame.shape[0])
+                )
+            video_result.write(frame)
+        frame_queue.release(slot)
+        index_file.write(json.dumps({
+            "frame": frame_number,
+            "timestamp": timestamp,
+            "offset": offset,
+            "detections": detections_to_json(detections or {})
+        }) + "\n")
+        frame_number = frame_number + 1
+        written_count.value = written_count.value + 1
+        if time.monotonic() >= next_flush:
+            # The raw frames first, so the index never points past them
+            if raw_file is not None:
+                raw_file.flush()
+            index_file.flush()
+            next_flush = time.monotonic() + C.RECORD_INDEX_FLUSH_INTERVAL
+
+    if video_result is not None:
+        video_result.release()
+    if raw_file is not None:
+        raw_file.close()
+    index_file.close()
+
+
+def read_raw_frames(file_name):
+    """
+        Reads the frames of a raw recording, one at a time.
+
+        Inputs:
+            - file_name <string>: a .raw file written by a FrameRecorder
+
+        Returns:
+            - frames <generator>: (timestamp, img) of every frame
+    """
+    with open(file_name, "rb") as f:
+        while True:
+            header = f.read(RAW_FRAME_HEADER.size)
+            if len(header) < RAW_FRAME_HEADER.size:
+                return
+            timestamp, h, w, channels = RAW_FRAME_HEADER.unpack(header)
+            data = f.read(h * w * channels)
+            if len(data) < h * w * channels:
+                # The recording was cut off in the middle of a frame
+                return
+            img = np.frombuffer(data, dtype=np.uint8).reshape(h, w, channels)
+            if channels == 1:
+                img = img.reshape(h, w)
+            yield timestamp, img
+
+
+class FrameRecorder(object):
+    """
+        A FrameRecorder saves every frame of one camera to a file, from an
+        encoder process of its own. The camera pushes its frames into
+        frame_queue, from a thread or from a CaptureWorker's process, so any
+        number of cameras can be recorded at the same time.
+
+        - id <int>: the camera id in the real world
+
+        - file_name <string>: the .avi (or .raw) file being written. Its
+            index is written next to it, see RecordingIndex
+
+        - raw <bool>: If True, frames are dumped uncompressed to be encoded
+            later with encode_recording.py. This takes much more disk, but
+            almost no CPU. Corresponds to C.RECORD_RAW
+
+        - frame_queue <FrameQueue>: The frames waiting to be written. Pass this
+            to the VideoStreamWidget or CaptureWorker of the camera
+
+        - written_count <Value>: How many frames the encoder has written
+
+        - process <Process>: Runs run_frame_encoder
+    """
+    def __init__(
+        self,
+        id,
+        file_name,
+        frame_size=C.CAMERA_FRAME_SIZE,
+        raw=C.RECORD_RAW,
+        frame_rate=C.CAMERA_FRAME_RATE,
+        max_length=C.RECORD_QUEUE_LENGTH
+    ):
+        self.id = id
+        self.file_name = file_name
+        self.raw = raw
+        w, h = frame_size
+        self.frame_queue = FrameQueue((h, w, 3), max_length)
+        self.written_count = Value("L", 0, lock=False)
+
+        self.process = Process(
+            target=run_frame_encoder,
+            args=(
+                self.frame_queue,
+                id,
+                file_name,
+                raw,
+                frame_rate,
+                self.written_count
+            )
+        )
+        self.process.daemon = True
+        self.process.start()
+
+        atexit.register(self.stop)
+
+
+    def push(self, img, timestamp, detections=None, block=False):
+        """
+            Same as FrameQueue.push()
+        """
+        return self.frame_queue.push(img, timestamp, detections, block)
+
+
+    def get_stats(self):
+        """
+            Inputs: None
+
+            Returns:
+                - stats <dict>: how many frames were pushed, dropped and
+                    written, and how many are waiting to be written
+        """
+        pushed = self.frame_queue.pushed_count.value
+        dropped = self.frame_queue.dropped_count.value
+        written = self.written_count.value
+        return {
+            "file_name": self.file_name,
+            "pushed": pushed,
+            "dropped": dropped,
+            "written": written,
+            "waiting": pushed - dropped - written
+        }
+
+
+    def stop(self):
+        """
+            Writes the frames still in frame_queue, closes the file and frees
+            the shared memory. Without this the .avi isn't finished and can't
+            be played back.
+
+            Inputs: None
+
+            Returns: None
+        """
+        if self.process.is_alive():
+            self.frame_queue.close()
+            self.process.join(C.RECORD_STOP_TIMEOUT)
+            if self.process.is_alive():
+                print("Recorder for camera", self.id, "didn't finish writing", self.file_name)
+                self.process.terminate()
+                self.process.join()
+            stats = self.get_stats()
+            print("Recorded", stats["written"], "frames to", self.file_name,
+                "(" + str(stats["dropped"]), "dropped)"
+            )
+        try:
+            self.frame_queue.shm.close()
+            self.frame_queue.shm.unlink()
+        except FileNotFoundError:
+            pass
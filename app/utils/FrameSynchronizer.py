@@ -0,0 +1,208 @@
+import math
+import numpy as np
+
+from collections import deque
+
+from .constants import constants as C
+
+class FrameSynchronizer(object):
+    """
+        A FrameSynchronizer groups the detection batches of every camera into
+        time slots of one camera frame each, by their capture timestamps,
+        so MultiViewFusion only fuses frames that were taken at about the
+        same time. Without this, one fused position could mix frames taken up
+        to a frame apart, which smears a moving student.
+
+        Slot k holds the frames captured from k * period to (k + 1) * period.
+        A slot is handed out once every active camera has a frame in it, or
+        once a frame newer than the end of the slot plus latency comes in, so
+        one slow camera can't hold up the others for long. A frame that comes
+        in after its slot was handed out is handed out on its own. Cameras
+        that haven't sent their first frame yet are waited for as if they
+        sent one with the first frame of any camera, so the first slots
+        aren't handed out with only the camera that started first.
+
+        The skew of a slot is the time between its first and last frame. The
+        skews and the offset of each camera from the middle of its slots, i.e.
+        (slot + 0.5) * period, are kept for get_stats(), to see how far apart
+        the cameras are and how late each one is.
+
+        - period <float>: Seconds. Corresponds to C.SYNC_PERIOD
+
+        - latency <float>: Seconds. Corresponds to C.SYNC_LATENCY
+
+        - active_time <float>: Seconds. A camera that hasn't sent a frame in
+            this long isn't waited for. Corresponds to C.SYNC_ACTIVE_TIME
+
+        - camera_ids <list<int>>: The cameras we expect frames from, or None
+            to only wait for the cameras that have sent a frame
+
+        - slot_dict <dict>: The slots waiting to be handed out
+            {
+                <int> slot index: {
+                    <int> camera_id: <dict> a DetectionQueue batch
+                }
+            }
+
+        - last_slot <int>: Index of the last slot handed out, or None
+
+        - camera_id_timestamp_dict <dict>: The newest timestamp of each camera
+
+        - newest_timestamp <float>: The newest timestamp of any camera
+
+        - skews <deque<float>>: Seconds, skew of the last C.SYNC_STATS_LENGTH
+            slots with 2 or more cameras
+
+        - camera_id_offsets_dict <dict>: Seconds, offset of each camera from
+            the middle of its last C.SYNC_STATS_LENGTH slots
+
+        - slot_count, late_count, replaced_count <int>: How many slots were
+            handed out, how many frames came in after their slot was handed
+            out, and how many frames were dropped because their camera had
+            another frame in the same slot
+    """
+    def __init__(
+        self,
+        period=C.SYNC_PERIOD,
+        latency=C.SYNC_LATENCY,
+        active_time=C.SYNC_ACTIVE_TIME,
+        camera_ids=None
+    ):
+        self.period = period
+        self.latency = latency
+        self.active_time = active_time
+        self.camera_ids = list(camera_ids) if camera_ids is not None else []
+        self.slot_dict = {}
+        self.last_slot = None
+        self.camera_id_timestamp_dict = {}
+        self.newest_timestamp = -math.inf
+        self.skews = deque(maxlen=C.SYNC_STATS_LENGTH)
+        self.camera_id_offsets_dict = {}
+        self.slot_count = 0
+        self.late_count = 0
+        self.replaced_count = 0
+
+
+    def push(self, batch):
+        """
+            Adds a camera's batch to its slot, and hands out the slots that
+            are ready.
+
+            Inputs:
+                - batch <dict>: a batch from DetectionQueue.pop()
+
+            Returns:
+                - slots <list<list<dict>>>: the batches of each slot that is
+                    ready, oldest slot first
+        """
+        camera_id = batch["camera_id"]
+        timestamp = batch["timestamp"]
+        if len(self.camera_id_timestamp_dict) == 0:
+            # Wait for every camera from the start, not just the first one
+            for expected_camera_id in self.camera_ids:
+                self.camera_id_timestamp_dict[expected_camera_id] = timestamp
+        self.camera_id_timestamp_dict[camera_id] = max(
+            self.camera_id_timestamp_dict.get(camera_id, -math.inf),
+            timestamp
+        )
+        self.newest_timestamp = max(self.newest_timestamp, timestamp)
+
+        # Round first, so frames timed at exact multiples of period (like
+        # recordings) don't land in the slot before because of float error
+        slot = math.floor(round(timestamp / self.period, 6))
+        if self.last_slot is not None and slot <= self.last_slot:
+            self.late_count = self.late_count + 1
+            return [[batch]] + self.flush()
+
+        camera_id_batch_dict = self.slot_dict.setdefault(slot, {})
+        if camera_id in camera_id_batch_dict:
+            # The camera is faster than period. Keep its frame closest to
+            # the middle of the slot
+            middle = (slot + 0.5) * self.period
+            old = camera_id_batch_dict[camera_id]
+            self.replaced_count = self.replaced_count + 1
+            if abs(old["timestamp"] - middle) <= abs(timestamp - middle):
+                return self.flush()
+        camera_id_batch_dict[camera_id] = batch
+        return self.flush()
+
+
+    def flush(self, now=None):
+        """
+            Hands out the slots that are ready. Slots are always handed out in
+            order, so a ready slot also hands out every slot before it.
+
+            Inputs:
+                - now <float>: time.time() value. Slots that ended more than
+                    latency before now are handed out even if a camera is
+                    missing, i.e. when every camera stopped sending. Defaults
+                    to the newest timestamp of any camera.
+
+            Returns:
+                - slots <list<list<dict>>>: the batches of each slot, oldest
+                    slot first
+        """
+        if now is None:
+            now = self.newest_timestamp
+        now = max(now, self.newest_timestamp)
+        active_camera_ids = set([
+            camera_id
+            for camera_id, timestamp in self.camera_id_timestamp_dict.items()
+            if timestamp >= self.newest_timestamp - self.active_time
+        ])
+
+        ready_slot = None
+        for slot in self.slot_dict:
+            if ((slot + 1) * self.period + self.latency <= now or
+                active_camera_ids.issubset(self.slot_dict[slot])):
+                if ready_slot is None or slot > ready_slot:
+                    ready_slot = slot
+        if ready_slot is None:
+            return []
+
+        slots = []
+        for slot in sorted(self.slot_dict):
+            if slot > ready_slot:
+                break
+            batches = list(self.slot_dict.pop(slot).values())
+            self.measure_skew(slot, batches)
+            slots.append(batches)
+            self.last_slot = slot
+        self.slot_count = self.slot_count + len(slots)
+        return slots
+
+
+    def measure_skew(self, slot, batches):
+        if len(batches) < 2:
+            return
+        timestamps = np.array([batch["timestamp"] for batch in batches])
+        self.skews.append(timestamps.max() - timestamps.min())
+        middle = (slot + 0.5) * self.period
+        for batch in batches:
+            offsets = self.camera_id_offsets_dict.setdefault(
+                batch["camera_id"], deque(maxlen=C.SYNC_STATS_LENGTH)
+            )
+            offsets.append(batch["timestamp"] - middle)
+
+
+    def get_stats(self):
+        """
+            Inputs: None
+
+            Returns:
+                - stats <dict>: the counters, the mean and max skew of the
+                    recent slots, and the mean offset of each camera from the
+                    middle of its slots, in ms
+        """
+        skews = np.array(list(self.skews))
+        return {
+            "slots": self.slot_count,
+            "late_frames": self.late_count,
+            "replaced_frames": self.replaced_count,
+            "skew_mean_ms": float(1000 * skews.mean()) if len(skews) else 0.,
+            "skew_max_ms": float(1000 * skews.max()) if len(skews) else 0.,
+            "camera_offset_ms": dict([
+                (str(camera_id), float(1000 * np.mean(list(offsets))))
+                for camera_id, offsets in sorted(list(self.camera_id_offsets_dict.items()))
+            ])
+        }
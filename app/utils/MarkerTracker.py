@@ -0,0 +1,270 @@
+import time
+import numpy as np
+from threading import Lock
+
+from .constants import constants as C
+
+class MarkerTracker(object):
+    """
+        A MarkerTracker follows every aruco marker with a constant velocity
+        Kalman filter, in one set of arrays indexed by aruco id. Instead of
+        averaging the last 30 positions, which lags a moving student by about
+        a second, each marker's position and velocity are updated with every
+        new position, and the expected pose is predicted forward to the time
+        it is sent.
+
+        Every axis has the same noise, so x, y and z share one 2x2 covariance
+        of [position, velocity] per marker.
+
+            - Positions further than gate (in sigmas squared) from where a
+                marker was predicted to be are outliers and are skipped. After
+                max_rejects outliers in a row the track starts over.
+            - A marker that isn't seen for max_age seconds is dropped.
+
+        - num_ids <int>: how many aruco ids we can track (1000 for DICT_6X6_1000)
+
+        - measurement_sigma <float>: cm, the least error a position is
+            trusted to have. Corresponds to C.TRACKER_MEASUREMENT_SIGMA
+
+        - acceleration_sigma <float>: cm/s^2. Corresponds to
+            C.TRACKER_ACCELERATION_SIGMA
+
+        - initial_velocity_sigma <float>: cm/s. Corresponds to
+            C.TRACKER_INITIAL_VELOCITY_SIGMA
+
+        - gate <float>: Corresponds to C.TRACKER_GATE
+
+        - max_rejects <int>: Corresponds to C.TRACKER_MAX_REJECTS
+
+        - max_age <float>: Seconds. Corresponds to C.TRACKER_MAX_AGE
+
+        - max_prediction <float>: Seconds. Corresponds to C.TRACKER_MAX_PREDICTION
+
+        - alive <np.array(num_ids)>: Whether each aruco id has a track
+
+        - position <np.array(num_ids, 3)>: x, y, z of each track
+
+        - velocity <np.array(num_ids, 3)>: cm/s in x, y, z of each track
+
+        - covariance <np.array(num_ids, 2, 2)>: covariance of [position,
+            velocity] of each track, the same for every axis
+
+        - update_time <np.array(num_ids)>: time.time() value the state of each
+            track is at
+
+        - observed_time <np.array(num_ids)>: time.time() value each track last
+            took in a position
+
+        - reject_count <np.array(num_ids)>: outliers in a row of each track
+
+        - accepted_count, rejected_count, reset_count <int>: How many positions
+            were used and skipped, and how many tracks were started over
+
+        - lock <Lock>: push_many() and get_expected_poses() are called from
+            different threads
+    """
+    def __init__(
+        self,
+        num_ids=C.NUM_ARUCO_IDS,
+        measurement_sigma=C.TRACKER_MEASUREMENT_SIGMA,
+        acceleration_sigma=C.TRACKER_ACCELERATION_SIGMA,
+        initial_velocity_sigma=C.TRACKER_INITIAL_VELOCITY_SIGMA,
+        gate=C.TRACKER_GATE,
+        max_rejects=C.TRACKER_MAX_REJECTS,
+        max_age=C.TRACKER_MAX_AGE,
+        max_prediction=C.TRACKER_MAX_PREDICTION
+    ):
+        self.num_ids = num_ids
+        self.measurement_sigma = measurement_sigma
+        self.acceleration_sigma = acceleration_sigma
+        self.initial_velocity_sigma = initial_velocity_sigma
+        self.gate = gate
+        self.max_rejects = max_rejects
+        self.max_age = max_age
+        self.max_prediction = max_prediction
+
+        self.alive = np.zeros(num_ids, dtype=bool)
+        self.position = np.zeros((num_ids, 3))
+        self.velocity = np.zeros((num_ids, 3))
+        self.covariance = np.zeros((num_ids, 2, 2))
+        self.update_time = np.zeros(num_ids)
+        self.observed_time = np.zeros(num_ids)
+        self.reject_count = np.zeros(num_ids, dtype=np.int64)
+        self.accepted_count = 0
+        self.rejected_count = 0
+        self.reset_count = 0
+        self.lock = Lock()
+
+
+    def start_tracks(self, aruco_ids, tvecs, timestamps, sigmas):
+        """
+            Starts the tracks of aruco_ids at tvecs, standing still. Must be
+            called while holding lock.
+        """
+        self.alive[aruco_ids] = True
+        self.position[aruco_ids] = tvecs
+        self.velocity[aruco_ids] = 0
+        self.covariance[aruco_ids, 0, 0] = sigmas ** 2
+        self.covariance[aruco_ids, 0, 1] = 0
+        self.covariance[aruco_ids, 1, 0] = 0
+        self.covariance[aruco_ids, 1, 1] = self.initial_velocity_sigma ** 2
+        self.update_time[aruco_ids] = timestamps
+        self.observed_time[aruco_ids] = timestamps
+        self.reject_count[aruco_ids] = 0
+
+
+    def push_many(self, aruco_ids, tvecs, timestamp=None, sigmas=None):
+        """
+            Updates the tracks of the detected aruco ids with their new
+            positions, all at once. Ids without a track get a new one.
+
+            Inputs:
+                - aruco_ids <np.array(n)>: the detected aruco ids. Each id
+                    should only show up once.
+                - tvecs <np.array(n, 3)>: the x, y, z of each detected id
+                - timestamp <float or np.array(n)>: time.time() value of when
+                    the frame was read, or of each position. Defaults to now.
+                - sigmas <np.array(n)>: cm, estimated error of each position,
+                    i.e. from MultiViewFusion. Never less than
+                    measurement_sigma, which is also the default.
+
+            Returns: None
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        aruco_ids = np.asarray(aruco_ids, dtype=np.int64).reshape(-1)
+        tvecs = np.asarray(tvecs, dtype=np.float64).reshape(-1, 3)
+        timestamps = np.broadcast_to(
+            np.asarray(timestamp, dtype=np.float64), aruco_ids.shape
+        )
+        if sigmas is None:
+            sigmas = np.full(len(aruco_ids), self.measurement_sigma)
+        sigmas = np.maximum(
+            np.asarray(sigmas, dtype=np.float64).reshape(-1),
+            self.measurement_sigma
+        )
+
+        # Ignore ids that aren't in the dictionary, and only keep the first
+        # detection of any repeated id so the fancy indexing below is safe
+        in_range = (aruco_ids >= 0) & (aruco_ids < self.num_ids)
+        aruco_ids = aruco_ids[in_range]
+        tvecs = tvecs[in_range]
+        sigmas = sigmas[in_range]
+        timestamps = timestamps[in_range]
+        aruco_ids, first = np.unique(aruco_ids, return_index=True)
+        tvecs = tvecs[first]
+        sigmas = sigmas[first]
+        timestamps = timestamps[first]
+        if len(aruco_ids) == 0:
+            return
+
+        with self.lock:
+            new = ~self.alive[aruco_ids]
+            self.start_tracks(aruco_ids[new], tvecs[new], timestamps[new], sigmas[new])
+            aruco_ids = aruco_ids[~new]
+            tvecs = tvecs[~new]
+            sigmas = sigmas[~new]
+            timestamps = timestamps[~new]
+            if len(aruco_ids) == 0:
+                return
+
+            # Predict every track forward to the frame. Cameras can send a
+            # little out of order, so an older frame is used as if it were now
+            dt = np.maximum(timestamps - self.update_time[aruco_ids], 0)
+            position = self.position[aruco_ids] + self.velocity[aruco_ids] * dt[:, None]
+            velocity = self.velocity[aruco_ids]
+            P = self.covariance[aruco_ids]
+            # P = F P F^T + Q, with F = [[1, dt], [0, 1]] and Q from a constant
+            # acceleration of acceleration_sigma over dt
+            p00 = P[:, 0, 0] + 2 * dt * P[:, 0, 1] + dt ** 2 * P[:, 1, 1]
+            p01 = P[:, 0, 1] + dt * P[:, 1, 1]
+            p11 = P[:, 1, 1]
+            q = self.acceleration_sigma ** 2
+            p00 = p00 + q * dt ** 4 / 4
+            p01 = p01 + q * dt ** 3 / 2
+            p11 = p11 + q * dt ** 2
+
+            # Skip the positions that are too far from the prediction
+            S = p00 + sigmas ** 2
+            innovation = tvecs - position
+            distance = (innovation ** 2).sum(axis=1) / S
+            accepted = distance <= self.gate
+
+            # Kalman gain of position and velocity, the same for every axis
+            k0 = np.where(accepted, p00 / S, 0)
+            k1 = np.where(accepted, p01 / S, 0)
+            self.position[aruco_ids] = position + k0[:, None] * innovation
+            self.velocity[aruco_ids] = velocity + k1[:, None] * innovation
+            self.covariance[aruco_ids, 0, 0] = p00 - k0 * p00
+            self.covariance[aruco_ids, 0, 1] = p01 - k0 * p01
+            self.covariance[aruco_ids, 1, 0] = p01 - k0 * p01
+            self.covariance[aruco_ids, 1, 1] = p11 - k1 * p01
+            self.update_time[aruco_ids] = np.maximum(
+                self.update_time[aruco_ids], timestamps
+            )
+            self.observed_time[aruco_ids[accepted]] = timestamps[accepted]
+            self.reject_count[aruco_ids[accepted]] = 0
+            self.reject_count[aruco_ids[~accepted]] += 1
+            self.accepted_count = self.accepted_count + int(accepted.sum())
+            self.rejected_count = self.rejected_count + int((~accepted).sum())
+
+            # A marker that keeps showing up somewhere else really moved there
+            reset = self.reject_count[aruco_ids] >= self.max_rejects
+            if reset.any():
+                self.start_tracks(
+                    aruco_ids[reset], tvecs[reset], timestamps[reset], sigmas[reset]
+                )
+                self.reset_count = self.reset_count + int(reset.sum())
+
+
+    def push(self, aruco_id, tvec, timestamp=None, sigma=None):
+        """
+            Pushes a single detection into the tracker. See push_many()
+        """
+        self.push_many(
+            [aruco_id],
+            [np.ravel(tvec)[0:3]],
+            timestamp,
+            None if sigma is None else [sigma]
+        )
+
+
+    def get_expected_poses(self, now=None):
+        """
+            Predicts where every live aruco id is at now. Tracks that haven't
+            been seen for max_age seconds are dropped first.
+
+            Inputs:
+                - now <float>: time.time() value to predict the poses at.
+                    Defaults to now.
+
+            Returns:
+                - aruco_ids <np.array(n)>: the aruco ids that have live tracks
+                - expected_poses <np.array(n, 3)>: [x, y, z] values of where we
+                    expect each of those aruco markers to be
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.alive[self.alive & (self.observed_time + self.max_age <= now)] = False
+            aruco_ids = np.flatnonzero(self.alive)
+            dt = np.clip(now - self.update_time[aruco_ids], 0, self.max_prediction)
+            expected_poses = (
+                self.position[aruco_ids] + self.velocity[aruco_ids] * dt[:, None]
+            )
+        return aruco_ids, expected_poses
+
+
+    def get_stats(self):
+        """
+            Inputs: None
+
+            Returns:
+                - stats <dict>: how many positions the tracker used and skipped
+        """
+        return {
+            "tracks": int(self.alive.sum()),
+            "accepted": self.accepted_count,
+            "rejected": self.rejected_count,
+            "track_resets": self.reset_count
+        }
@@ -0,0 +1,171 @@
+import time
+from threading import Thread, Condition
+
+from .constants import constants as C
+from .WireFrame import WireFrame
+
+class MocapPublisher(object):
+    """
+        A MocapPublisher computes each output frame of the MocapSystem once per
+        tick and hands the same WireFrame to every websocket client connected
+        to /echo, which serializes itself once per format. Without this, every
+        client would recompute and rescale every marker (and write the pose
+        history) on its own.
+
+        - mocap_system <MocapSystem>: the system we're publishing positions from
+
+        - frame_rate <float>: How many frames per second we publish. This
+            corresponds to C.MOCAP_OUT_FRAME_RATE in constants.py
+
+        - scale_x, scale_y <float>: Determines what to multiply every value by
+            to scale the room up or down
+
+        - data <dict>: The latest frame, with keys of aruco ids as strings
+            {
+                "1": {"x": <float>, "y": <float>}
+            }
+
+        - wire_frame <WireFrame>: The latest frame, ready to be serialized in
+            any format of the wire protocol
+
+        - keyframe_interval <int>: Every keyframe_interval frames, every client
+            is sent a full frame instead of a delta
+
+        - frame_count <int>: How many frames have been published. Clients
+            compare this to know when there is a new frame.
+
+        - num_subscribers <int>: How many clients are connected
+
+        - condition <Condition>: Wakes up the clients when a new frame is
+            published
+
+        - publish_thread <Thread>: Computes and publishes a frame every tick
+    """
+    def __init__(self, mocap_system, frame_rate=C.MOCAP_OUT_FRAME_RATE):
+        self.mocap_system = mocap_system
+        self.frame_rate = frame_rate
+        m = mocap_system
+        self.scale_x = abs(m.bounds[0] - m.bounds[1]) / abs(C.DEFAULT_BOUNDS[0] - C.DEFAULT_BOUNDS[1])
+        self.scale_y = abs(m.bounds[2] - m.bounds[3]) / abs(C.DEFAULT_BOUNDS[2] - C.DEFAULT_BOUNDS[3])
+
+        self.data = {}
+        self.frame_count = 0
+        self.wire_frame = WireFrame(self.frame_count, self.data)
+        self.keyframe_interval = C.WIRE_KEYFRAME_INTERVAL
+        self.num_subscribers = 0
+        self.condition = Condition()
+
+        self.publish_thread = Thread(target=self.publish, args=())
+        self.publish_thread.daemon = True
+        self.publish_thread.start()
+
+
+    def get_client_value(self, camera_value, scale, translation, rounding_amount):
+        val = scale * (camera_value - translation)
+        rounded_val = round(val / rounding_amount) * rounding_amount
+        return rounded_val
+
+
+    def compute_frame(self):
+        """
+            Rescales and rounds the expected position of every live aruco
+            marker into the room coordinates that the clients plot.
+
+            Inputs: None
+
+            Returns:
+                - data <dict>: the frame to send, described in the class comment
+        """
+        m = self.mocap_system
+        data = {}
+        avg_aruco_poses_dict = m.get_average_detected_markers()
+        for aruco_marker in avg_aruco_poses_dict:
+            pose = avg_aruco_poses_dict[aruco_marker]
+            rounded_x = self.get_client_value(
+                pose[0], self.scale_x, m.origin[0], m.rounding_amount
+            )
+            if m.mode == 0:
+                rounded_y = self.get_client_value(
+                    pose[1], self.scale_y, m.origin[1], m.rounding_amount
+                )
+            else:
+                rounded_y = self.get_client_value(
+                    pose[2], self.scale_y, m.origin[2], m.rounding_amount
+                )
+            data[str(aruco_marker)] = {
+                "x": rounded_x,
+                "y": rounded_y
+            }
+        return data
+
+
+    def publish(self):
+        """
+            Computes a frame every 1/frame_rate seconds and wakes up every
+            client waiting in wait_for_frame(). Sleeps until the next tick
+            instead of polling time.time(). This function is run on
+            publish_thread.
+
+            Inputs: None
+
+            Returns: None
+        """
+        period = 1. / self.frame_rate
+        next_tick = time.monotonic()
+        while True:
+            data = self.compute_frame()
+            wire_frame = WireFrame(
+                self.frame_count + 1,
+                data,
+                self.data,
+                (self.frame_count + 1) % self.keyframe_interval == 0
+            )
+            with self.condition:
+                self.data = data
+                self.wire_frame = wire_frame
+                self.frame_count = wire_frame.seq
+                self.condition.notify_all()
+
+            next_tick = next_tick + period
+            sleep_time = next_tick - time.monotonic()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            else:
+                # We fell behind, so don't try to catch up with a burst of frames
+                next_tick = time.monotonic()
+
+
+    def wait_for_frame(self, last_frame_count, timeout=1.):
+        """
+            Waits until a frame newer than last_frame_count is published. A
+            client that is slower than frame_rate skips straight to the
+            latest frame.
+
+            Inputs:
+                - last_frame_count <int>: frame_count of the last frame the
+                    client sent
+                - timeout <float>: most seconds to wait
+
+            Returns:
+                - frame_count <int>: frame_count of the wire_frame
+                - wire_frame <WireFrame>: the latest frame, or None if the
+                    timeout ran out
+        """
+        with self.condition:
+            new_frame = self.condition.wait_for(
+                lambda: self.frame_count != last_frame_count,
+                timeout
+            )
+            if not new_frame:
+                return last_frame_count, None
+            return self.frame_count, self.wire_frame
+
+
+    def subscribe(self):
+        with self.condition:
+            self.num_subscribers = self.num_subscribers + 1
+
+
+    def unsubscribe(self):
+        with self.condition:
+            self.num_subscribers = self.num_subscribers - 1
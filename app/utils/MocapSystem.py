@@ -11,8 +11,17 @@ from threading import Thread
 from .constants import constants as C
 
 from .VideoStreamWidget import VideoStreamWidget
-from .PoseQueue import PoseQueue
+from .CaptureWorker import CaptureWorker
+from .MarkerTracker import MarkerTracker
+from .DetectionQueue import DetectionQueue
+from .FrameSynchronizer import FrameSynchronizer
+from .MultiViewFusion import MultiViewFusion
 from .ScreenCapture import ScreenCapture
+from .FrameRecorder import FrameRecorder
+from .PoseHistoryWriter import PoseHistoryWriter
+from .CalibrationStore import CalibrationStore
+from .CameraDiscovery import CameraDiscovery
+from .RecordingIndex import load_recording_indexes, align_recordings
 
 class MocapSystem(object):
     """
@@ -24,19 +33,20 @@ class MocapSystem(object):
             This corresponds to C.NUM_CAMERAS in constants.py
 
         - save_video <boolean>: Flag which determines if we should save VideoStream
-            data or not. Currently (2/27/22), if this is marked True, it will
-            only save data from Camera 3. This is a #FIXME, as my computer
-            can't handle recording all four cameras at the same time, consistently
+            data or not. If True, every camera is recorded by a FrameRecorder
+
+        - record_raw <boolean>: If True, the cameras are recorded as raw
+            frames, to be encoded later with encode_recording.py. Corresponds
+            to C.RECORD_RAW
 
         - screen_capture: <ScreenCapture> Handles screen capturing if save_video
-            is set to True
+            is set to True. Otherwise None
 
         - record_start_time <float>: a time.time() value. If save_video is True, time
             the system will start recording at, to help sync up all the videos together
 
         - old_video_path <string>: This path is used to read old VideoStream to run the
-            system based on old inputs. Currently (2/27/22) useless, since I
-            can't record all four cameras. Example:
+            system based on old inputs. Example:
             "/media/mighty/research-1/collected_data_from_cameras/video/2022_2_17/2022_2_14_17_32_camera_"
 
         - rounding_amount <int>: determines how much I round my output to. i.e.
@@ -48,14 +58,26 @@ class MocapSystem(object):
         - scale_y <float>: Determines what to multiply every value by to scale
             the room up or down for the y value.
 
+        - use_processes <bool>: If True, each camera is run in its own Process
+            with a CaptureWorker instead of a VideoStreamWidget Thread
+
+        - reassign_cameras <bool>: If True, ask for the camera number of every
+            camera again instead of using the saved camera profile
+
         - mode <int>: which tell us to plot using (x,y) positions in the room (0)
             or (x,z) positions in the room (1)
 
-        - aruco_pose_dict <dictionary>: Each key refers to a particular
-            aruco id and the value is a PoseQueue to determine the position.
+        - marker_tracker <MarkerTracker>: Follows the fused positions of every
+            aruco id, to predict where each one is when it is sent.
+
+        - frame_synchronizer <FrameSynchronizer>: Groups the detections of
+            every camera into time slots by their capture timestamps
+
+        - fusion <MultiViewFusion>: Combines the detections of each marker
+            from every camera in a slot into one position
 
         - active_video_streams <List<VideoStreamWidget>>: a list of all the
-            VideoStreamWidget objects which handle all cameras
+            VideoStreamWidget (or CaptureWorker) objects which handle all cameras
 
         - camera_id_meta_dict <dictionary>:
             <int> camera_id {
@@ -63,9 +85,24 @@ class MocapSystem(object):
                 "mtx": <np.array> the camera matrix to undistort the image
                 "dist_coeff": <np.array> the distance coeffs to undistort the image
                 "new_camera_mtx": <np.array> the new camera matrix to undistort img
-                "save_video": <bool> if we should save video or not
+                ... and the rest of the camera's calibration, see CalibrationStore
             }
 
+        - session_time <datetime>: When the system started. Every file saved
+            in this session is named after it, so they can be matched up
+
+        - frame_recorders <dict>: The FrameRecorder of each camera id, if
+            save_video is True. Otherwise empty
+
+        - calibration_store <CalibrationStore>: Holds the calibration of every
+            camera, keyed by camera identity
+
+        - detection_queue <DetectionQueue>: Every camera pushes its timestamped
+            detections in here after each frame, for update_detected_markers
+
+        - pose_history_writer <PoseHistoryWriter>: Saves the expected poses on
+            a background thread if save_video is True. Otherwise None
+
         - update_markers_thread <Thread>: Handles restructuring data into JSON format
 
     """
@@ -79,19 +116,30 @@ class MocapSystem(object):
         ROUNDING_AMOUNT=10,
         BOUNDS=C.DEFAULT_BOUNDS,
         ORIGIN=C.DEFAULT_ORIGIN,
+        USE_PROCESSES=False,
+        REASSIGN_CAMERAS=False,
+        RECORD_RAW=C.RECORD_RAW,
     ):
         self.num_cameras = NUMBER_OF_CAMERAS_IN_SYSTEM
         self.save_video = SAVE_VIDEO
+        self.record_raw = RECORD_RAW
+        self.session_time = datetime.datetime.now()
         self.record_start_time = RECORD_START_TIME
         self.old_video_path = OLD_VIDEO_PATH
         self.rounding_amount = ROUNDING_AMOUNT # How much to round output to
         self.bounds = BOUNDS
         self.origin = ORIGIN
         self.mode = MODE # Graph X-Y (0) or X-Z (1)
+        self.use_processes = USE_PROCESSES
+        self.reassign_cameras = REASSIGN_CAMERAS
 
-        self.aruco_pose_dict = {} # a dictionary of PoseQueues
+        self.marker_tracker = MarkerTracker()
+        self.fusion = MultiViewFusion()
+        self.detection_queue = DetectionQueue()
+        self.calibration_store = CalibrationStore()
         self.active_video_streams = []
         self.camera_id_meta_dict = {}
+        self.frame_recorders = {}
 
         if self.old_video_path == None:
             self.camera_id_meta_dict, self.active_video_streams = (
@@ -102,9 +150,23 @@ class MocapSystem(object):
                 self.load_video_history()
             )
 
+        self.frame_synchronizer = FrameSynchronizer(
+            camera_ids=[v.id for v in self.active_video_streams]
+        )
+
         self.pose_history_file_name = self.get_pose_history_file_name()
+        self.pose_history_writer = None
+        if self.pose_history_file_name:
+            self.pose_history_writer = PoseHistoryWriter(self.pose_history_file_name)
+        self.screen_capture = None
         if self.save_video:
-            self.screen_capture = ScreenCapture(self.record_start_time)
+            self.screen_capture = ScreenCapture(
+                self.record_start_time,
+                self.get_recording_file_name(
+                    C.SAVE_SCREEN_STREAM_FILE_PATH,
+                    "_screen.avi"
+                )
+            )
             print("Screen Capture saving.")
         else:
             print("Screen Capture not being saved.")
@@ -116,9 +178,11 @@ class MocapSystem(object):
 
     def load_cameras(self):
         """
-            Asks the user which cameras are turned on to create an association
-            between the camera_ids and VideoCapture objects. This function is
-            used for live MocapSystem data, rather than replaying the history.
+            Finds the cameras that are turned on and the camera id of each one,
+            with CameraDiscovery. The user is only asked for the camera
+            number of cameras that aren't in the camera profile yet. This
+            function is used for live MocapSystem data, rather than replaying
+            the history.
 
             Inputs: None
 
@@ -128,46 +192,27 @@ class MocapSystem(object):
                 - active_video_streams <list>: List of VideostreamWidgets for
                     handling the Mocap System
         """
-        # This for loop iterates over 200 cv2 Video Capture Sources
-        # Doing this because the webcams aren't correlating with what's in
-        # /dev/video/*. The Camera number corresponds to the camera id
-        # based on my setup. It's just used for calibration and transformation.
+        # The camera number corresponds to the camera id based on my setup.
+        # It's just used for calibration and transformation.
         camera_id_meta_dict = {}
         active_video_streams = []
-        for src in range(0, 100):
-            cap = cv2.VideoCapture(src)
-            test, frame = cap.read()
-            if test:
-                camera_meta = {}
-                print("cv2 Camera Source", src, "found.")
-                cam = input("Which Camera number?  ")
-                camera_meta["src"] = int(src)
-
-                camera_meta["mtx"] = C.CAMERA_CALIBRATION_MATRIX
-                camera_meta["dist_coeff"] = C.CAMERA_CALIBRATION_DISTANCE_COEFF
-
-                # Calculate the Camera Matrix from the yaml fgle
-                img_gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-                h, w = img_gray.shape[:2]
-                # https://docs.opencv.org/3.3.0/d9/d0c/group__calib3d.html#ga7a6c4e032c97f03ba747966e6ad862b1
-                new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
-                    camera_meta["mtx"],
-                    camera_meta["dist_coeff"],
-                    (w, h),
-                    1,
-                    (w, h)
-                )
-                camera_meta["new_camera_mtx"] = new_camera_mtx
-                camera_meta["roi"] = roi
-
-                # FIXME: Hack-y way to handle this for now. Computer can't keep up
-                # with saving all 4 video streams.
-                # if int(cam) == 3:
-                    # camera_meta["save_video"] = self.save_video
-                # else:
-                # Never save video for now.
-                camera_meta["save_video"] = False
-                camera_id_meta_dict[int(cam)] = camera_meta
+        camera_discovery = CameraDiscovery(reassign=self.reassign_cameras)
+        for camera in camera_discovery.discover():
+            cam = camera["camera_id"]
+            if cam in camera_id_meta_dict:
+                print("Camera number", cam, "is used twice. Skipping", camera["identity"])
+                continue
+
+            # The intrinsics, new camera matrix, ROI, remap tables and
+            # extrinsics are all saved in the CalibrationStore, and only
+            # computed the first time a camera is seen
+            camera_meta = self.calibration_store.get_camera_meta(
+                camera["identity"],
+                cam,
+                camera["frame_size"]
+            )
+            camera_meta["src"] = camera["src"]
+            camera_id_meta_dict[cam] = camera_meta
 
         # After finding all camera matrices, make sure we assert that we have
         # the same amount of real cameras and sources.
@@ -177,13 +222,42 @@ class MocapSystem(object):
             """)
         os.system('clear')
 
+        # Every camera gets its own encoder process, so all of them can be
+        # recorded at once. Start them before the cameras so their frames
+        # have somewhere to go.
+        if self.save_video:
+            for key in list(camera_id_meta_dict):
+                self.frame_recorders[key] = FrameRecorder(
+                    key,
+                    self.get_recording_file_name(
+                        C.SAVE_VIDEO_STREAM_FILE_PATH,
+                        "_camera_" + str(key) + (".raw" if self.record_raw else ".avi")
+                    ),
+                    frame_size=camera_id_meta_dict[key]["frame_size"],
+                    raw=self.record_raw
+                )
+
         # All video streams will be appended in a list held in this Class
         for key in list(camera_id_meta_dict):
-            v = VideoStreamWidget(
-                key,
-                camera_id_meta_dict[key],
-                self.record_start_time
-            )
+            frame_queue = None
+            if key in self.frame_recorders:
+                frame_queue = self.frame_recorders[key].frame_queue
+            if self.use_processes:
+                v = CaptureWorker(
+                    key,
+                    camera_id_meta_dict[key],
+                    self.record_start_time,
+                    self.detection_queue,
+                    frame_queue=frame_queue
+                )
+            else:
+                v = VideoStreamWidget(
+                    key,
+                    camera_id_meta_dict[key],
+                    self.record_start_time,
+                    self.detection_queue,
+                    frame_queue=frame_queue
+                )
             active_video_streams.append(v)
 
         return camera_id_meta_dict, active_video_streams
@@ -192,7 +266,11 @@ class MocapSystem(object):
     def load_video_history(self):
         """
             When we're using old video data to replay the MocapSystem outputs,
-            this function is called instead of load_cameras.
+            this function is called instead of load_cameras. This plays the
+            videos back at the camera frame rate so clients can watch them.
+            If the videos have an index, each one starts at its frame from
+            when the last camera started, so they play in sync.
+            To reprocess a session as fast as possible, use ReplayEngine.
 
             Inputs: None
 
@@ -205,89 +283,116 @@ class MocapSystem(object):
         camera_id_meta_dict = {}
         active_video_streams = []
 
-        cap = cv2.VideoCapture(self.old_video_path + "1.avi")
-        test, frame = cap.read()
+        camera_id_frame_dict = {}
+        camera_id_index_dict = load_recording_indexes(
+            self.old_video_path,
+            self.num_cameras
+        )
+        starts = [
+            index.timestamps[0] for index in camera_id_index_dict.values()
+            if len(index) > 0
+        ]
+        if len(starts) != 0:
+            camera_id_frame_dict = align_recordings(camera_id_index_dict, max(starts))
 
         for i in range(1, self.num_cameras + 1):
-            camera_meta = {}
-            camera_meta["src"] = self.old_video_path + str(i) + ".avi"
-            print(self.old_video_path + str(i) + ".avi")
-
-            camera_meta["mtx"] = C.CAMERA_CALIBRATION_MATRIX
-            camera_meta["dist_coeff"] = C.CAMERA_CALIBRATION_DISTANCE_COEFF
-
-            # Calculate the Camera Matrix from the yaml fgle
-            img_gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-            h, w = img_gray.shape[:2]
-            # https://docs.opencv.org/3.3.0/d9/d0c/group__calib3d.html#ga7a6c4e032c97f03ba747966e6ad862b1
-            new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
-                camera_meta["mtx"],
-                camera_meta["dist_coeff"],
+            src = self.old_video_path + str(i) + ".avi"
+            print(src)
+
+            cap = cv2.VideoCapture(src)
+            test, frame = cap.read()
+            cap.release()
+            if not test:
+                print("Could not read", src, "Skipping")
+                continue
+
+            # Replay with the calibration the camera has now, without saving
+            # one for a camera that isn't plugged in
+            h, w = frame.shape[:2]
+            camera_meta = self.calibration_store.get_camera_meta(
+                self.calibration_store.get_identity(i),
+                i,
                 (w, h),
-                1,
-                (w, h)
+                save=False
             )
-            camera_meta["new_camera_mtx"] = new_camera_mtx
-            camera_meta["roi"] = roi
-            camera_meta["save_video"] = False
+            camera_meta["src"] = src
+            camera_meta["start_frame"] = camera_id_frame_dict.get(i, 0)
             camera_id_meta_dict[i] = camera_meta
 
         for key in list(camera_id_meta_dict):
-            v = VideoStreamWidget(key, camera_id_meta_dict[key])
+            v = VideoStreamWidget(
+                key,
+                camera_id_meta_dict[key],
+                self.record_start_time,
+                self.detection_queue
+            )
             active_video_streams.append(v)
 
         return camera_id_meta_dict, active_video_streams
 
 
+    def get_recording_file_name(self, folder_path, suffix):
+        """
+            Creates the day's folder in folder_path, and names a file in it
+            after session_time.
+
+            Inputs:
+                - folder_path <string>: i.e. C.SAVE_VIDEO_STREAM_FILE_PATH
+                - suffix <string>: What goes after the time, i.e.
+                    "_camera_1.avi"
+
+            Returns:
+                - file_name <string>: i.e.
+                    folder_path + "2022_2_17/2022_2_17_14_57_camera_1.avi"
+        """
+        current_datetime = self.session_time
+        current_year = current_datetime.year
+        current_month = current_datetime.month
+        current_day = current_datetime.day
+        current_hour = current_datetime.hour
+        current_minute = current_datetime.minute
+
+        YY_MM_DD_FOLDER = (
+            str(current_year) + "_" +
+            str(current_month) + "_" +
+            str(current_day) + "/"
+        )
+
+        try:
+            os.mkdir(folder_path + YY_MM_DD_FOLDER)
+        except OSError as error:
+            print(error)
+            print("Skipping")
+
+        return (folder_path +
+            YY_MM_DD_FOLDER +
+            str(current_year) + "_" +
+            str(current_month) + "_" +
+            str(current_day) + "_" +
+            str(current_hour) + "_" +
+            str(current_minute) + suffix
+        )
+
+
     def get_pose_history_file_name(self):
         """
-            Creates folders and files the prepare saving for the Pose History.
+            Creates folders the prepare saving for the Pose History.
+            PoseHistoryWriter creates the file itself.
 
             Inputs: None
 
             Returns:
-                - pose_history_file_name <string>: File path to the CSV file
-                    which will save timestamped positions of aruco_ids.
+                - pose_history_file_name <string>: File path to the file
+                    which will save timestamped positions of aruco_ids. This is
+                    a .csv or .bin file, depending on C.POSE_HISTORY_FORMAT
         """
         pose_history_file_name = None
         if self.save_video == True:
-            for v in self.active_video_streams:
-                # FIXME: Cannot save all camera inputs at the same time right now.
-                if v.id == 3:
-                    current_datetime = datetime.datetime.now()
-                    current_year = current_datetime.year
-                    current_month = current_datetime.month
-                    current_day = current_datetime.day
-                    current_hour = current_datetime.hour
-                    current_minute = current_datetime.minute
-
-                    YY_MM_DD_FOLDER = (
-                        str(current_year) + "_" +
-                        str(current_month) + "_" +
-                        str(current_day) + "/"
-                    )
-
-                    try:
-                        os.mkdir(C.SAVE_POSE_HISTORY_FILE_PATH + YY_MM_DD_FOLDER)
-                    except OSError as error:
-                        print(error)
-                        print("Skipping")
-
-                    pose_history_file_name = (C.SAVE_POSE_HISTORY_FILE_PATH +
-                        YY_MM_DD_FOLDER +
-                        str(current_year) + "_" +
-                        str(current_month) + "_" +
-                        str(current_day) + "_" +
-                        str(current_hour) + "_" +
-                        str(current_minute) + "_pose_history.csv"
-                    )
-                    try:
-                        f = open(pose_history_file_name, "x")
-                        f.write("timestamp, id, x, y, z\n")
-                        f.close()
-                    except OSError as error:
-                        print(error)
-                        print("Skipping")
+            pose_history_file_name = self.get_recording_file_name(
+                C.SAVE_POSE_HISTORY_FILE_PATH,
+                "_pose_history" +
+                (".bin" if C.POSE_HISTORY_FORMAT == "binary" else ".csv")
+            )
         else:
             print("Pose History not being saved.")
         return pose_history_file_name
@@ -295,43 +400,76 @@ class MocapSystem(object):
 
     def update_detected_markers(self):
         """
-            Accesses the data inside VideoStreamWidget.detected_aruco_ids_dict
-            and restructures it for easy access for JSON transfer. This function
-            is called repeatedly through the update_markers_thread Thread.
+            Takes the detection batches that each VideoStreamWidget pushes into
+            detection_queue and restructures them for easy access for JSON
+            transfer. This function is run on the update_markers_thread Thread
+            and sleeps until a camera pushes new detections. The batches are
+            grouped into time slots by the frame_synchronizer, and the markers
+            in each slot are fused before going into the MarkerTracker.
 
             Inputs: None
 
             Returns: None
         """
         # Restructure the data so that we can prep for JSON Transfer
-        # Iterate through each camera and their detected aruco markers
-        # Append each detected Pose into a PoseQueue object so that we can
-        # calculate the running average of its position.
-        prev = 0
+        # Go through each camera's detected aruco markers as they come in
+        # Once every camera's frame of a time slot is in (or it waited long
+        # enough), fuse each detected marker with what the other cameras saw
+        # and push the fused Pose into the MarkerTracker so that it can follow
+        # the marker's position and velocity.
         while True:
-            time_elapsed = time.time() - prev
-            if time_elapsed >= 1./C.CAMERA_FRAME_RATE:
-                prev = time.time()
-                for v in self.active_video_streams:
-                    for aruco_id in list(v.detected_aruco_ids_dict):
-                        if aruco_id in self.aruco_pose_dict:
-                            rvec_arr = v.detected_aruco_ids_dict[aruco_id]["rvec"]
-                            tvec_arr = v.detected_aruco_ids_dict[aruco_id]["tvec"]
-                            self.aruco_pose_dict[aruco_id].push(tvec_arr)
-                        else:
-                            self.aruco_pose_dict[aruco_id] = PoseQueue(
-                                aruco_id,
-                                v.detected_aruco_ids_dict[aruco_id]["tvec"]
-                            )
-                    # if aruco_id == 1:
-                    #     print(v.id, v.detected_aruco_ids_dict[aruco_id]["tvec"])
+            # Wake up every slot even if no camera sends, so a slot waiting on
+            # a camera that stopped still gets fused
+            batch = self.detection_queue.pop(timeout=C.SYNC_PERIOD)
+            slots = []
+            if batch is not None:
+                slots = self.frame_synchronizer.push(batch)
+            slots = slots + self.frame_synchronizer.flush(time.time())
+            for batches in slots:
+                aruco_ids, poses, sigmas, timestamps = self.fusion.fuse_slot(batches)
+                if len(aruco_ids) != 0:
+                    self.marker_tracker.push_many(aruco_ids, poses, timestamps, sigmas)
+
+
+    def get_fusion_stats(self):
+        """
+            Reports how well update_detected_markers is keeping up with the
+            cameras.
+
+            Inputs: None
+
+            Returns:
+                - stats <dict>: depth of detection_queue, how many batches
+                    were pushed, dropped and fused, and how many positions
+                    were triangulated or came from a single camera, the
+                    skew between the cameras, the MarkerTracker's counters,
+                    the RoiDetector hit rate of each camera, and how many
+                    frames of each camera were recorded and dropped
+        """
+        stats = self.detection_queue.get_stats()
+        stats.update(self.frame_synchronizer.get_stats())
+        stats.update(self.fusion.get_stats())
+        stats.update(self.marker_tracker.get_stats())
+        stats["detection"] = {}
+        for v in self.active_video_streams:
+            detection_stats = v.get_detection_stats()
+            if detection_stats is not None:
+                stats["detection"][str(v.id)] = detection_stats
+        stats["recording"] = dict([
+            (str(camera_id), self.frame_recorders[camera_id].get_stats())
+            for camera_id in sorted(self.frame_recorders)
+        ])
+        if self.screen_capture is not None:
+            stats["recording"]["screen"] = self.screen_capture.get_stats()
+        return stats
 
 
     def get_average_detected_markers(self):
         """
-            Uses the PoseQueue data from update_detected_markers to calculate
-            the expected value of each detected marker and then sends it to
-            app.py to transfer to the front end
+            Uses the MarkerTracker from update_detected_markers to predict
+            where each detected marker is right now and then sends it to
+            app.py to transfer to the front end. If save_video is True, the
+            expected values are also queued for the pose_history_writer.
 
             Inputs: None
 
@@ -339,13 +477,13 @@ class MocapSystem(object):
                 - expected_aruco_poses_dict <dict>: A dictionary with keys of aruco_ids
                     and values of the expected [x, y, z] values.
         """
-        # Grabs the expected position from each PoseQueue for each aruco id
+        # Predicts the position of every live aruco id at once
         # And returns it for JSON transfer
+        aruco_ids, expected_poses = self.marker_tracker.get_expected_poses()
         expected_aruco_poses_dict = {}
-        for aruco_id in list(self.aruco_pose_dict):
-            expected_pose = self.aruco_pose_dict[aruco_id].get_expected_pose(
-                save = self.save_video,
-                save_location = self.pose_history_file_name
-            )
-            expected_aruco_poses_dict[aruco_id] = expected_pose
+        for i, aruco_id in enumerate(aruco_ids):
+            expected_aruco_poses_dict[int(aruco_id)] = expected_poses[i]
+
+        if self.pose_history_writer is not None:
+            self.pose_history_writer.push(aruco_ids, expected_poses)
         return expected_aruco_poses_dict
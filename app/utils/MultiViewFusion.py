@@ -0,0 +1,189 @@
+import numpy as np
+
+from .constants import constants as C
+
+class MultiViewFusion(object):
+    """
+        MultiViewFusion combines the detections of a marker from every camera
+        into one position, instead of averaging each camera's PnP tvec
+        together. It fuses one slot of the FrameSynchronizer at a time,
+        so only frames taken at about the same time are fused together:
+
+            1. If 2 or more calibrated cameras see the marker within max_skew
+                seconds of each other, each of its 4 corners is triangulated
+                from the corner rays of those cameras, weighted by how far off
+                each ray could be at the marker. The marker's position is the
+                middle of the 4 corners.
+            2. Otherwise (or if the rays are nearly parallel, or they miss each
+                other by more than max_ray_distance), the PnP tvecs are
+                averaged, weighted by 1 / tvec_sigma^2. A far camera, which
+                gets distance badly wrong, counts much less than a near one.
+
+        - max_skew <float>: Seconds. Corresponds to C.SYNC_MAX_SKEW
+
+        - min_ray_angle <float>: Degrees. Corresponds to C.FUSION_MIN_RAY_ANGLE
+
+        - max_ray_distance <float>: cm. Corresponds to C.FUSION_MAX_RAY_DISTANCE
+
+        - triangulated_count <int>: How many positions were triangulated
+
+        - pnp_count <int>: How many positions came from the PnP tvecs
+
+        - rejected_count <int>: How many triangulations were thrown out
+            because the rays were nearly parallel or missed each other
+    """
+    def __init__(
+        self,
+        max_skew=C.SYNC_MAX_SKEW,
+        min_ray_angle=C.FUSION_MIN_RAY_ANGLE,
+        max_ray_distance=C.FUSION_MAX_RAY_DISTANCE
+    ):
+        self.max_skew = max_skew
+        self.min_ray_angle = min_ray_angle
+        self.max_ray_distance = max_ray_distance
+        self.triangulated_count = 0
+        self.pnp_count = 0
+        self.rejected_count = 0
+
+
+    def fuse_slot(self, batches):
+        """
+            Fuses every marker seen in one slot of the FrameSynchronizer.
+
+            Inputs:
+                - batches <list<dict>>: DetectionQueue batches, at most one
+                    per camera
+
+            Returns:
+                - aruco_ids <np.array(n)>: the aruco ids seen in the slot
+                - poses <np.array(n, 3)>: the fused [x, y, z] of each one
+                - sigmas <np.array(n)>: cm, estimated error of each pose
+                - timestamps <np.array(n)>: time.time() value of each pose, the
+                    mean capture time of the frames it was fused from
+        """
+        aruco_id_views_dict = {}
+        for batch in batches:
+            detected_aruco_ids_dict = batch["detected_aruco_ids_dict"]
+            for aruco_id in detected_aruco_ids_dict:
+                aruco_id_views_dict.setdefault(int(aruco_id), []).append(
+                    (batch["timestamp"], detected_aruco_ids_dict[aruco_id])
+                )
+
+        aruco_ids = np.array(list(aruco_id_views_dict), dtype=np.int64)
+        poses = np.zeros((len(aruco_ids), 3))
+        sigmas = np.zeros(len(aruco_ids))
+        timestamps = np.zeros(len(aruco_ids))
+        for i, aruco_id in enumerate(aruco_ids):
+            views = aruco_id_views_dict[int(aruco_id)]
+            # Only frames within max_skew of the newest one are triangulated
+            newest = max([timestamp for timestamp, view in views])
+            close_views = [
+                (timestamp, view) for timestamp, view in views
+                if timestamp >= newest - self.max_skew
+            ]
+            poses[i], sigmas[i], timestamps[i] = self.fuse(views, close_views)
+        return aruco_ids, poses, sigmas, timestamps
+
+
+    def fuse(self, views, close_views):
+        """
+            Fuses the detections of one marker from several cameras.
+
+            Inputs:
+                - views <list<tuple>>: (timestamp, detection) from each camera
+                - close_views <list<tuple>>: the views that are close enough in
+                    time to triangulate
+
+            Returns:
+                - pose <np.array(3)>: the [x, y, z] of the marker
+                - sigma <float>: cm, estimated error of pose
+                - timestamp <float>: mean timestamp of the views that were used
+        """
+        ray_views = [
+            (timestamp, view) for timestamp, view in close_views
+            if view.get("corner_rays") is not None
+        ]
+        if len(ray_views) >= 2:
+            pose, sigma = self.triangulate([view for timestamp, view in ray_views])
+            if pose is not None:
+                self.triangulated_count = self.triangulated_count + 1
+                return pose, sigma, np.mean([timestamp for timestamp, view in ray_views])
+            self.rejected_count = self.rejected_count + 1
+
+        self.pnp_count = self.pnp_count + 1
+        tvecs = np.array([np.ravel(view["tvec"])[0:3] for timestamp, view in views])
+        weights = np.array([
+            1. / max(view.get("tvec_sigma", 1.), 1e-6) ** 2 for timestamp, view in views
+        ])
+        timestamps = np.array([timestamp for timestamp, view in views])
+        pose = (weights[:, None] * tvecs).sum(axis=0) / weights.sum()
+        timestamp = (weights * timestamps).sum() / weights.sum()
+        return pose, np.sqrt(1. / weights.sum()), timestamp
+
+
+    def triangulate(self, views):
+        """
+            Finds the point closest to the rays of each corner, in the weighted
+            least squares sense, and returns the middle of the 4 corners. Ray
+            i's weight is 1 / (ray_sigma_i * distance_i)^2, the inverse variance
+            of where it could be at the marker.
+
+            Inputs:
+                - views <list<dict>>: 2 or more detections with corner rays
+
+            Returns:
+                - pose <np.array(3)>: the [x, y, z] of the marker, or None if the
+                    rays can't fix the marker's position
+                - sigma <float>: cm, estimated error of pose in its worst
+                    direction, or None
+        """
+        centers = np.array([np.ravel(view["camera_center"]) for view in views])
+        rays = np.array([view["corner_rays"] for view in views])
+        tvecs = np.array([np.ravel(view["tvec"])[0:3] for view in views])
+        ray_sigmas = np.array([view["ray_sigma"] for view in views])
+        distances = np.maximum(np.linalg.norm(tvecs - centers, axis=1), 1.)
+        weights = 1. / (ray_sigmas * distances) ** 2
+        total_weight = weights.sum()
+        weights = weights / total_weight
+
+        # For every view and corner, (I - d d^T) projects onto the plane
+        # perpendicular to the ray. The point X closest to the rays solves
+        # sum w (I - d d^T) X = sum w (I - d d^T) c
+        projections = np.eye(3) - rays[..., :, None] * rays[..., None, :]
+        A = (weights[:, None, None, None] * projections).sum(axis=0)
+        b = (
+            weights[:, None, None] * (projections @ centers[:, None, :, None])[..., 0]
+        ).sum(axis=0)
+
+        # For 2 rays at an angle a, the smallest eigenvalue of A is
+        # (1 - cos(a)) / 2. Smaller means the rays can't fix the depth.
+        min_eigenvalue = np.linalg.eigvalsh(A)[:, 0].min()
+        if min_eigenvalue < (1 - np.cos(np.radians(self.min_ray_angle))) / 2:
+            return None, None
+        corners = np.linalg.solve(A, b[..., None])[..., 0]
+
+        # How far each triangulated corner is from each of its rays
+        offsets = corners[None] - centers[:, None, :]
+        misses = np.linalg.norm(
+            (projections @ offsets[..., None])[..., 0], axis=2
+        )
+        if misses.max() > self.max_ray_distance:
+            return None, None
+        # The inverse of total_weight * A is the covariance of each corner, and
+        # the middle of 4 corners has half their error
+        sigma = np.sqrt(1. / (total_weight * min_eigenvalue)) / 2
+        return corners.mean(axis=0), sigma
+
+
+    def get_stats(self):
+        """
+            Inputs: None
+
+            Returns:
+                - stats <dict>: how many positions were fused each way
+        """
+        return {
+            "triangulated": self.triangulated_count,
+            "pnp": self.pnp_count,
+            "rejected_triangulations": self.rejected_count
+        }
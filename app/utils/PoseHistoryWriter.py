@@ -0,0 +1,236 @@
+import os
+import time
+import queue
+import atexit
+import numpy as np
+
+from threading import Thread
+
+from .constants import constants as C
+
+# Binary pose history files start with this, followed by chunks of:
+#   number of rows n <uint32>
+#   timestamps <float64[n]>, ids <uint16[n]>, x <float32[n]>, y <float32[n]>, z <float32[n]>
+BINARY_MAGIC = b"WBMPOSE1"
+BINARY_CHUNK_HEADER = np.dtype("<u4")
+BINARY_COLUMNS = [
+    ("timestamp", np.dtype("<f8")),
+    ("id", np.dtype("<u2")),
+    ("x", np.dtype("<f4")),
+    ("y", np.dtype("<f4")),
+    ("z", np.dtype("<f4"))
+]
+CSV_HEADER = "timestamp, id, x, y, z\n"
+
+class PoseHistoryWriter(object):
+    """
+        A PoseHistoryWriter saves the pose history on a background thread, so
+        that opening files and waiting on the disk never happens inside the
+        websocket path. Poses are taken in through a queue and written in
+        batches, and the file is flushed and fsync'd every flush_interval
+        seconds.
+
+        - file_name <string>: File path of the pose history
+
+        - format <string>: "csv" (timestamp, id, x, y, z rows) or "binary"
+            (columnar chunks, see BINARY_COLUMNS). Read either with
+            load_pose_history()
+
+        - flush_interval <float>: Most seconds between writes to the disk
+
+        - queue <queue.Queue>: Batches of poses waiting to be written
+
+        - dropped_count <int>: How many batches were dropped because the queue
+            was full (the disk couldn't keep up)
+
+        - written_count <int>: How many rows have been written
+
+        - write_thread <Thread>: Takes poses from the queue and writes them
+    """
+    def __init__(
+        self,
+        file_name,
+        format=C.POSE_HISTORY_FORMAT,
+        flush_interval=C.POSE_HISTORY_FLUSH_INTERVAL
+    ):
+        self.file_name = file_name
+        self.format = format
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=C.POSE_HISTORY_QUEUE_LENGTH)
+        self.dropped_count = 0
+        self.written_count = 0
+        self.running = True
+
+        is_new = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+        if self.format == "binary":
+            self.file = open(file_name, "ab")
+            if is_new:
+                self.file.write(BINARY_MAGIC)
+        else:
+            self.file = open(file_name, "a")
+            if is_new:
+                self.file.write(CSV_HEADER)
+
+        self.write_thread = Thread(target=self.write_batches, args=())
+        self.write_thread.daemon = True
+        self.write_thread.start()
+
+        atexit.register(self.close)
+
+
+    def push(self, aruco_ids, poses, timestamp=None, block=False):
+        """
+            Queues the poses of one tick to be saved. This never touches the
+            disk, and only blocks if block is True.
+
+            Inputs:
+                - aruco_ids <np.array(n)>: the aruco ids
+                - poses <np.array(n, 3)>: the [x, y, z] of each aruco id
+                - timestamp <float>: time.time() value of the poses. Defaults
+                    to now.
+                - block <bool>: If True, wait for room in the queue instead of
+                    dropping the poses. Offline tools use this so they never
+                    lose poses by running faster than the disk.
+
+            Returns: None
+        """
+        if len(aruco_ids) == 0:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            self.queue.put((
+                timestamp,
+                np.array(aruco_ids, dtype=np.int64).reshape(-1),
+                np.array(poses, dtype=np.float64).reshape(-1, 3)
+            ), block=block)
+        except queue.Full:
+            self.dropped_count = self.dropped_count + 1
+
+
+    def write_batches(self):
+        """
+            Collects batches from the queue and writes them every
+            flush_interval seconds. This function is run on write_thread.
+
+            Inputs: None
+
+            Returns: None
+        """
+        pending = []
+        next_flush = time.monotonic() + self.flush_interval
+        while self.running or not self.queue.empty():
+            try:
+                pending.append(
+                    self.queue.get(timeout=max(0, next_flush - time.monotonic()))
+                )
+            except queue.Empty:
+                pass
+            if time.monotonic() >= next_flush or not self.running:
+                if len(pending) != 0:
+                    self.write(pending)
+                    pending = []
+                next_flush = time.monotonic() + self.flush_interval
+        if len(pending) != 0:
+            self.write(pending)
+
+
+    def write(self, batches):
+        """
+            Writes batches of poses into the file in one go, then flushes and
+            fsyncs it so the poses survive a crash.
+
+            Inputs:
+                - batches <list<tuple>>: (timestamp, aruco_ids, poses) tuples
+
+            Returns: None
+        """
+        timestamps = np.concatenate(
+            [np.full(len(batch[1]), batch[0]) for batch in batches]
+        )
+        aruco_ids = np.concatenate([batch[1] for batch in batches])
+        poses = np.concatenate([batch[2] for batch in batches])
+        try:
+            if self.format == "binary":
+                self.file.write(
+                    np.array(len(timestamps), dtype=BINARY_CHUNK_HEADER).tobytes()
+                )
+                columns = [timestamps, aruco_ids, poses[:, 0], poses[:, 1], poses[:, 2]]
+                for i, (name, dtype) in enumerate(BINARY_COLUMNS):
+                    self.file.write(columns[i].astype(dtype).tobytes())
+            else:
+                lines = []
+                for i in range(0, len(timestamps)):
+                    # timestamp, id, x, y, z
+                    lines.append(
+                        str(timestamps[i]) + "," +
+                        str(aruco_ids[i]) + "," +
+                        str(poses[i][0]) + "," +
+                        str(poses[i][1]) + "," +
+                        str(poses[i][2]) + "\n"
+                    )
+                self.file.write("".join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.written_count = self.written_count + len(timestamps)
+        except OSError as error:
+            print(error)
+            print("Error in saving Pose")
+
+
+    def close(self):
+        """
+            Writes anything still in the queue and closes the file.
+
+            Inputs: None
+
+            Returns: None
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.write_thread.join()
+        self.file.close()
+
+
+def load_pose_history(file_name):
+    """
+        Reads a pose history file written by PoseHistoryWriter, in either format.
+
+        Inputs:
+            - file_name <string>: File path of the pose history
+
+        Returns:
+            - pose_history <dict>: columns of the file as np.arrays, with keys
+                "timestamp", "id", "x", "y", "z"
+    """
+    with open(file_name, "rb") as f:
+        is_binary = f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+        if not is_binary:
+            rows = np.loadtxt(file_name, delimiter=",", skiprows=1, ndmin=2)
+            return {
+                "timestamp": rows[:, 0],
+                "id": rows[:, 1].astype(np.int64),
+                "x": rows[:, 2],
+                "y": rows[:, 3],
+                "z": rows[:, 4]
+            }
+
+        columns = dict([(name, []) for name, dtype in BINARY_COLUMNS])
+        while True:
+            header = f.read(BINARY_CHUNK_HEADER.itemsize)
+            if len(header) < BINARY_CHUNK_HEADER.itemsize:
+                break
+            n = int(np.frombuffer(header, dtype=BINARY_CHUNK_HEADER)[0])
+            for name, dtype in BINARY_COLUMNS:
+                columns[name].append(
+                    np.frombuffer(f.read(n * dtype.itemsize), dtype=dtype)
+                )
+    pose_history = {}
+    for name, dtype in BINARY_COLUMNS:
+        if len(columns[name]) == 0:
+            pose_history[name] = np.zeros(0, dtype=dtype)
+        else:
+            pose_history[name] = np.concatenate(columns[name])
+    pose_history["id"] = pose_history["id"].astype(np.int64)
+    return pose_history
@@ -0,0 +1,203 @@
+import time
+from threading import Thread, Condition
+
+import cv2
+
+from .constants import constants as C
+
+class PreviewPublisher(object):
+    """
+        A PreviewPublisher JPEG-encodes the latest annotated frame of every
+        camera once per tick, and hands the same JPEG to every viewer of that
+        camera's /preview stream. Frames are only encoded for the sizes
+        someone is watching, and only when the camera has a new frame, so
+        the tracking loop pays nothing when nobody is watching and the same
+        small amount no matter how many viewers there are.
+
+        - mocap_system <MocapSystem>: the system whose cameras we preview
+
+        - frame_rate <float>: How many times per second we look for new
+            frames. Corresponds to C.PREVIEW_FRAME_RATE
+
+        - quality <int>: JPEG quality, 0-100. Corresponds to
+            C.PREVIEW_JPEG_QUALITY
+
+        - thumbnail_scale <float>: Size of a thumbnail compared to the
+            camera's frame. Corresponds to C.PREVIEW_THUMBNAIL_SCALE
+
+        - subscribers <dict>: How many viewers are watching each
+            (camera_id, thumbnail)
+
+        - frames <dict>: The latest encoded frame of each (camera_id,
+            thumbnail) being watched
+            {
+                (1, False): (
+                    <int> frame count, goes up with every new JPEG
+                    <float> timestamp of the annotated_frame it came from
+                    <bytes> the JPEG
+                )
+            }
+
+        - condition <Condition>: Wakes up the viewers when new frames are
+            encoded
+
+        - publish_thread <Thread>: Encodes the frames every tick
+    """
+    def __init__(
+        self,
+        mocap_system,
+        frame_rate=C.PREVIEW_FRAME_RATE,
+        quality=C.PREVIEW_JPEG_QUALITY,
+        thumbnail_scale=C.PREVIEW_THUMBNAIL_SCALE
+    ):
+        self.mocap_system = mocap_system
+        self.frame_rate = frame_rate
+        self.quality = quality
+        self.thumbnail_scale = thumbnail_scale
+        self.subscribers = {}
+        self.frames = {}
+        self.condition = Condition()
+
+        self.publish_thread = Thread(target=self.publish, args=())
+        self.publish_thread.daemon = True
+        self.publish_thread.start()
+
+
+    def get_camera_ids(self):
+        return sorted([v.id for v in self.mocap_system.active_video_streams])
+
+
+    def encode_frame(self, img, thumbnail):
+        """
+            Inputs:
+                - img <np.array>: an annotated frame of a camera
+                - thumbnail <bool>: If True, shrink it by thumbnail_scale first
+
+            Returns:
+                - jpeg <bytes>: the encoded frame, or None if encoding failed
+        """
+        if thumbnail:
+            img = cv2.resize(
+                img,
+                None,
+                fx=self.thumbnail_scale,
+                fy=self.thumbnail_scale,
+                interpolation=cv2.INTER_AREA
+            )
+        status, jpeg = cv2.imencode(
+            ".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        )
+        if not status:
+            return None
+        return jpeg.tobytes()
+
+
+    def publish(self):
+        """
+            Every 1/frame_rate seconds, encodes the newest frame of each
+            camera that is being watched and wakes up its viewers. A camera
+            without a new frame since the last tick isn't encoded again. This
+            function is run on publish_thread.
+
+            Inputs: None
+
+            Returns: None
+        """
+        period = 1. / self.frame_rate
+        next_tick = time.monotonic()
+        while True:
+            with self.condition:
+                watched = [key for key in self.subscribers if self.subscribers[key] > 0]
+            streams = dict([(v.id, v) for v in self.mocap_system.active_video_streams])
+            new_frames = {}
+            for camera_id, thumbnail in watched:
+                v = streams.get(camera_id)
+                if v is None:
+                    continue
+                # A CaptureWorker copies the frame out of shared memory here,
+                # a VideoStreamWidget just hands over its latest array. Both
+                # only hand over frames with the markers drawn on them
+                annotated_frame = v.annotated_frame
+                if annotated_frame is None:
+                    continue
+                frame_timestamp, img = annotated_frame
+                last_frame = self.frames.get((camera_id, thumbnail))
+                if last_frame is not None and last_frame[1] == frame_timestamp:
+                    continue
+                jpeg = self.encode_frame(img, thumbnail)
+                if jpeg is not None:
+                    frame_count = last_frame[0] + 1 if last_frame is not None else 1
+                    new_frames[(camera_id, thumbnail)] = (frame_count, frame_timestamp, jpeg)
+
+            if len(new_frames) > 0:
+                with self.condition:
+                    for key in new_frames:
+                        # Unless every viewer left while it was encoded
+                        if key in self.subscribers:
+                            self.frames[key] = new_frames[key]
+                    self.condition.notify_all()
+
+            next_tick = next_tick + period
+            sleep_time = next_tick - time.monotonic()
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            else:
+                # We fell behind, so don't try to catch up with a burst of frames
+                next_tick = time.monotonic()
+
+
+    def wait_for_frame(self, camera_id, thumbnail, last_frame_count, timeout=1.):
+        """
+            Waits until a frame of camera_id newer than last_frame_count is
+            encoded. A viewer that is slower than frame_rate skips straight to
+            the latest frame.
+
+            Inputs:
+                - camera_id <int>: the camera id in the real world
+                - thumbnail <bool>: If True, wait for the thumbnail
+                - last_frame_count <int>: frame count of the last frame the
+                    viewer got, 0 for none
+                - timeout <float>: most seconds to wait
+
+            Returns:
+                - frame_count <int>: frame count of the jpeg
+                - jpeg <bytes>: the latest frame, or None if the timeout ran
+                    out
+        """
+        key = (camera_id, thumbnail)
+
+        def get_frame_count():
+            return self.frames[key][0] if key in self.frames else 0
+
+        with self.condition:
+            new_frame = self.condition.wait_for(
+                lambda: get_frame_count() != last_frame_count,
+                timeout
+            )
+            if not new_frame:
+                return last_frame_count, None
+            return self.frames[key][0], self.frames[key][2]
+
+
+    def subscribe(self, camera_id, thumbnail):
+        with self.condition:
+            key = (camera_id, thumbnail)
+            self.subscribers[key] = self.subscribers.get(key, 0) + 1
+
+
+    def unsubscribe(self, camera_id, thumbnail):
+        with self.condition:
+            key = (camera_id, thumbnail)
+            self.subscribers[key] = self.subscribers[key] - 1
+            if self.subscribers[key] == 0:
+                # Don't send a new viewer a frame from when the last one left
+                del self.subscribers[key]
+                self.frames.pop(key, None)
+
+
+    def get_stats(self):
+        with self.condition:
+            return dict([
+                (str(camera_id) + ("_thumbnail" if thumbnail else ""), count)
+                for (camera_id, thumbnail), count in sorted(self.subscribers.items())
+            ])
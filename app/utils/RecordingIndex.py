@@ -0,0 +1,285 @@
+import os
+import json
+import numpy as np
+
+import cv2
+
+def get_index_file_name(recording_file_name):
+    """
+        Returns:
+            - index_file_name <string>: the index of a recording, i.e.
+                ..._camera_1_index.jsonl for ..._camera_1.avi. A .raw recording
+                and the .avi encoded from it share one index.
+    """
+    return os.path.splitext(recording_file_name)[0] + "_index.jsonl"
+
+
+def detections_to_json(detected_aruco_ids_dict):
+    """
+        Turns a VideoStreamWidget's detected_aruco_ids_dict into something
+        json can write. camera_id is left out, it is in the index's header.
+    """
+    detections = {}
+    for aruco_id in detected_aruco_ids_dict:
+        pose = detected_aruco_ids_dict[aruco_id]
+        detection = {
+            "rvec": np.ravel(pose["rvec"]).tolist(),
+            "tvec": np.ravel(pose["tvec"]).tolist(),
+            "tvec_sigma": float(pose["tvec_sigma"]),
+            "camera_center": None,
+            "corner_rays": None,
+            "ray_sigma": None
+        }
+        if pose.get("corner_rays") is not None:
+            detection["camera_center"] = np.ravel(pose["camera_center"]).tolist()
+            detection["corner_rays"] = np.asarray(pose["corner_rays"]).tolist()
+            detection["ray_sigma"] = float(pose["ray_sigma"])
+        detections[str(aruco_id)] = detection
+    return detections
+
+
+def detections_from_json(camera_id, detections):
+    """
+        The opposite of detections_to_json()
+
+        Returns:
+            - detected_aruco_ids_dict <dict>: same format as
+                VideoStreamWidget.detected_aruco_ids_dict
+    """
+    detected_aruco_ids_dict = {}
+    for aruco_id in detections:
+        detection = detections[aruco_id]
+        pose = {
+            "camera_id": camera_id,
+            "rvec": np.array(detection["rvec"]),
+            "tvec": np.array(detection["tvec"]),
+            "tvec_sigma": detection["tvec_sigma"],
+            "camera_center": None,
+            "corner_rays": None,
+            "ray_sigma": None
+        }
+        if detection["corner_rays"] is not None:
+            pose["camera_center"] = np.array(detection["camera_center"])
+            pose["corner_rays"] = np.array(detection["corner_rays"])
+            pose["ray_sigma"] = detection["ray_sigma"]
+        detected_aruco_ids_dict[int(aruco_id)] = pose
+    return detected_aruco_ids_dict
+
+
+class RecordingIndex(object):
+    """
+        A RecordingIndex reads the sidecar index that a FrameRecorder writes
+        next to every recording, so replay tools can find a frame by its
+        capture time and jump to it without decoding the video from the start.
+
+        An index is a json line for the recording, then a json line for every
+        frame written, in order:
+            {"camera_id": <int>, "file_name": <string>, "raw": <bool>,
+                "frame_rate": <float>}
+            {"frame": <int> frame number in the recording,
+                "timestamp": <float> time.time() value of when it was grabbed,
+                "offset": <int> byte offset of the frame in a .raw recording,
+                    or null for an .avi, which is sought by frame number,
+                "detections": <dict> see detections_to_json()}
+
+        - file_name <string>: path of the index
+
+        - camera_id <int>: the camera id in the real world
+
+        - recording_file_name <string>: the .avi or .raw file the index is for,
+            in the same folder as the index
+
+        - raw <bool>: whether the recording was dumped raw
+
+        - frame_rate <float>: the frame rate the video was written at
+
+        - timestamps <np.array(n)>: capture time of every frame
+
+        - offsets <np.array(n)>: byte offset of every frame, -1 if unknown
+
+        - detections <list<dict>>: the detections of every frame, as json
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, "r") as f:
+            header = json.loads(f.readline())
+            frames = [json.loads(line) for line in f if line.strip()]
+
+        self.camera_id = header["camera_id"]
+        self.recording_file_name = os.path.join(
+            os.path.dirname(file_name),
+            header["file_name"]
+        )
+        self.raw = header["raw"]
+        self.frame_rate = header["frame_rate"]
+        self.timestamps = np.array([frame["timestamp"] for frame in frames])
+        self.offsets = np.array([
+            frame["offset"] if frame["offset"] is not None else -1
+            for frame in frames
+        ], dtype=np.int64)
+        self.detections = [frame["detections"] for frame in frames]
+
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+    def find_frame(self, timestamp):
+        """
+            Finds the first frame grabbed at or after timestamp.
+
+            Inputs:
+                - timestamp <float>: time.time() value
+
+            Returns:
+                - frame_number <int>: or len(self) if every frame is older
+        """
+        return int(np.searchsorted(self.timestamps, timestamp, side="left"))
+
+
+    def find_nearest_frame(self, timestamp):
+        """
+            Finds the frame grabbed closest to timestamp.
+
+            Inputs:
+                - timestamp <float>: time.time() value
+
+            Returns:
+                - frame_number <int>: or None if the index is empty
+        """
+        if len(self) == 0:
+            return None
+        i = self.find_frame(timestamp)
+        if i == len(self):
+            return i - 1
+        if i > 0 and timestamp - self.timestamps[i - 1] < self.timestamps[i] - timestamp:
+            return i - 1
+        return i
+
+
+    def seek(self, capture, frame_number):
+        """
+            Moves a cv2.VideoCapture of the encoded recording to frame_number,
+            so the next read() returns it. MJPG frames are all key frames, so
+            this doesn't decode the frames before it.
+
+            Inputs:
+                - capture <cv2.VideoCapture>: reading the .avi of this index
+                - frame_number <int>: the frame to read next
+
+            Returns:
+                - success <bool>
+        """
+        return capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+
+
+    def read_raw_frame(self, frame_number):
+        """
+            Reads one frame of a .raw recording straight from its byte offset.
+
+            Inputs:
+                - frame_number <int>: the frame to read
+
+            Returns:
+                - img <np.array>: the frame, or None if it can't be read
+        """
+        # Imported here since FrameRecorder imports this module
+        from .FrameRecorder import RAW_FRAME_HEADER
+        if frame_number < 0 or frame_number >= len(self) or self.offsets[frame_number] < 0:
+            return None
+        with open(self.recording_file_name, "rb") as f:
+            f.seek(self.offsets[frame_number])
+            header = f.read(RAW_FRAME_HEADER.size)
+            if len(header) < RAW_FRAME_HEADER.size:
+                return None
+            timestamp, h, w, channels = RAW_FRAME_HEADER.unpack(header)
+            data = f.read(h * w * channels)
+        if len(data) < h * w * channels:
+            return None
+        img = np.frombuffer(data, dtype=np.uint8).reshape(h, w, channels)
+        return img.reshape(h, w) if channels == 1 else img
+
+
+    def get_batches(self, start=None, end=None):
+        """
+            Makes a DetectionQueue batch of every frame grabbed from start up to
+            end, from the detections saved while recording. This is the
+            cheapest way to re-analyze a session, since nothing is decoded.
+
+            Inputs:
+                - start, end <float>: time.time() values. Defaults to the
+                    whole recording
+
+            Returns:
+                - batches <list<dict>>: see DetectionQueue, in time order
+        """
+        first = 0 if start is None else self.find_frame(start)
+        last = len(self) if end is None else self.find_frame(end)
+        return [
+            {
+                "camera_id": self.camera_id,
+                "timestamp": float(self.timestamps[i]),
+                "detected_aruco_ids_dict": detections_from_json(
+                    self.camera_id,
+                    self.detections[i]
+                )
+            }
+            for i in range(first, last)
+        ]
+
+
+def load_recording_indexes(video_path, num_cameras):
+    """
+        Loads the index of every camera of a recorded session.
+
+        Inputs:
+            - video_path <string>: Path of the recordings up to the camera
+                number, i.e. ".../2022_2_17_14_57_camera_"
+            - num_cameras <int>: Camera numbers 1 to num_cameras are looked for
+
+        Returns:
+            - camera_id_index_dict <dict>: The RecordingIndex of each camera id
+                that has one. Old recordings have none.
+    """
+    camera_id_index_dict = {}
+    for i in range(1, num_cameras + 1):
+        index_file_name = get_index_file_name(video_path + str(i) + ".avi")
+        if os.path.exists(index_file_name):
+            camera_id_index_dict[i] = RecordingIndex(index_file_name)
+    return camera_id_index_dict
+
+
+def align_recordings(camera_id_index_dict, timestamp):
+    """
+        Finds the frame of every camera that was grabbed closest to timestamp,
+        so the streams can be played side by side in sync even if they
+        started at different times or dropped frames.
+
+        Inputs:
+            - camera_id_index_dict <dict>: see load_recording_indexes()
+            - timestamp <float>: time.time() value
+
+        Returns:
+            - camera_id_frame_dict <dict>: The frame number of each camera id
+    """
+    camera_id_frame_dict = {}
+    for camera_id in camera_id_index_dict:
+        frame_number = camera_id_index_dict[camera_id].find_nearest_frame(timestamp)
+        if frame_number is not None:
+            camera_id_frame_dict[camera_id] = frame_number
+    return camera_id_frame_dict
+
+
+def get_session_start(camera_id_index_dict):
+    """
+        Returns:
+            - start <float>: time.time() value of the first frame of any
+                camera, or None if no camera has a frame
+    """
+    starts = [
+        index.timestamps[0] for index in camera_id_index_dict.values()
+        if len(index) > 0
+    ]
+    if len(starts) == 0:
+        return None
+    return float(min(starts))
@@ -0,0 +1,120 @@
+import cv2
+import numpy as np
+
+class Rectifier(object):
+    """
+        A Rectifier undistorts camera frames with remap tables that are built
+        once per camera and per resolution. cv2.undistort() rebuilds the same
+        maps on every call, but mtx, dist_coeff and new_camera_mtx never change
+        after MocapSystem.load_cameras, so we only need to build them once.
+
+        - mtx <np.array>: the camera matrix to undistort the image
+
+        - dist_coeff <np.array>: the distance coeffs to undistort the image
+
+        - new_camera_mtx <np.array>: the new camera matrix to undistort img
+
+        - roi <tuple>: (x, y, w, h) region of interest returned from
+            cv2.getOptimalNewCameraMatrix
+
+        - use_roi <bool>: determines if we crop the undistorted image to the roi
+
+        - maps_dict <dict>: Cached remap tables, keyed by the (w, h) of the frame.
+            Starts with camera_meta["maps"] if the CalibrationStore already has
+            them, so they aren't built at startup
+            {
+                (640, 480): (
+                    <np.array(h,w,2) int16> fixed-point pixel coordinates,
+                    <np.array(h,w) uint16> interpolation table index
+                )
+            }
+    """
+    def __init__(self, camera_meta, use_roi=True):
+        self.mtx = camera_meta["mtx"]
+        self.dist_coeff = camera_meta["dist_coeff"]
+        self.new_camera_mtx = camera_meta["new_camera_mtx"]
+        self.roi = camera_meta["roi"]
+        self.use_roi = use_roi
+        self.maps_dict = dict(camera_meta.get("maps", {}))
+
+
+    def get_maps(self, w, h):
+        """
+            Gets the remap tables for a frame size, building them the first time
+            that size is seen. The maps are stored as CV_16SC2, which is the
+            compact fixed-point format that cv2.remap() reads fastest.
+
+            Inputs:
+                - w <int>: width of the frame in pixels
+                - h <int>: height of the frame in pixels
+
+            Returns:
+                - maps <tuple>: (map1, map2) to be passed into cv2.remap()
+        """
+        if (w, h) not in self.maps_dict:
+            self.maps_dict[(w, h)] = cv2.initUndistortRectifyMap(
+                self.mtx,
+                self.dist_coeff,
+                None,
+                self.new_camera_mtx,
+                (w, h),
+                cv2.CV_16SC2
+            )
+        return self.maps_dict[(w, h)]
+
+
+    def undistort(self, img):
+        """
+            Undistorts an image using the cached remap tables. This gives the
+            same result as cv2.undistort(), which also uses bilinear
+            interpolation over CV_16SC2 maps internally.
+
+            Inputs:
+                - img <np.array>: the raw image from the camera
+
+            Returns:
+                - undistorted_img <np.array>: The image, undistorted. If use_roi
+                    is True, this image is cropped.
+        """
+        h, w = img.shape[:2]
+        map1, map2 = self.get_maps(w, h)
+        undistorted_img = cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+        # region of interest
+        if self.use_roi == True:
+            x, y, w, h = self.roi
+            undistorted_img = undistorted_img[y:y+h, x:x+w]
+        return undistorted_img
+
+
+    def undistort_corners(self, corners):
+        """
+            Undistorts only the corner points of detected aruco markers, rather
+            than every pixel of the frame. The points end up in the same pixel
+            coordinates as if we had detected them on the undistorted (and
+            cropped, if use_roi is True) image, so they can be passed straight
+            into aruco.estimatePoseSingleMarkers with new_camera_mtx.
+
+            Inputs:
+                - corners <list<np.array(1,4,2)>>: corners from aruco.detectMarkers
+                    on the raw image
+
+            Returns:
+                - undistorted_corners <list<np.array(1,4,2)>>: the corners in
+                    undistorted image coordinates
+        """
+        if len(corners) == 0:
+            return corners
+        pts = np.concatenate(corners).reshape(-1, 1, 2).astype(np.float32)
+        pts = cv2.undistortPoints(
+            pts,
+            self.mtx,
+            self.dist_coeff,
+            None,
+            self.new_camera_mtx
+        )
+        if self.use_roi == True:
+            x, y, w, h = self.roi
+            pts = pts - np.array([x, y], dtype=np.float32)
+        pts = pts.reshape(-1, 1, 4, 2)
+        return [pts[i] for i in range(0, len(pts))]
@@ -0,0 +1,433 @@
+import os
+import time
+import json
+import heapq
+
+import cv2
+import numpy as np
+
+from multiprocessing import Pool
+
+from .constants import constants as C
+
+from .VideoStreamWidget import VideoStreamWidget
+from .MarkerTracker import MarkerTracker
+from .FrameSynchronizer import FrameSynchronizer
+from .MultiViewFusion import MultiViewFusion
+from .PoseHistoryWriter import PoseHistoryWriter
+from .CalibrationStore import CalibrationStore
+from .RecordingIndex import load_recording_indexes, get_session_start
+
+def get_camera_meta(camera_id, src):
+    """
+        Gets the camera meta of a recorded video from the CalibrationStore,
+        the same way MocapSystem.load_video_history() does.
+
+        Inputs:
+            - camera_id <int>: the camera id in the real world
+            - src <string>: path to the .avi file
+
+        Returns:
+            - camera_meta <dict>: Described in the MocapSystem comment, or None
+                if the video can't be read
+    """
+    cap = cv2.VideoCapture(src)
+    test, frame = cap.read()
+    cap.release()
+    if not test:
+        return None
+
+    h, w = frame.shape[:2]
+    calibration_store = CalibrationStore()
+    camera_meta = calibration_store.get_camera_meta(
+        calibration_store.get_identity(camera_id),
+        camera_id,
+        (w, h),
+        save=False
+    )
+    camera_meta["src"] = src
+    # Replays don't need to watch for new calibrations
+    camera_meta["identity"] = None
+    return camera_meta
+
+
+def init_worker():
+    # Each worker decodes one video, so OpenCV's own threads would only
+    # fight the other workers for the same cores
+    cv2.setNumThreads(1)
+
+
+def detect_video(job):
+    """
+        Decodes every frame of one camera's video and detects the aruco markers
+        in it, without sleeping between frames. This is run in a Pool worker,
+        one video per worker.
+
+        Inputs:
+            - job <tuple>: (camera_id <int>, src <string>, first_frame <int>,
+                timestamps <np.array>, end <float>)
+                - first_frame: the frame to start from. The video is sought
+                    to it instead of decoding every frame before it
+                - timestamps: seconds from the start of the session of every
+                    frame to read from first_frame on, from the recording's
+                    index. None for old recordings without an index
+                - end: seconds, where to stop reading if timestamps is None.
+                    None reads to the end of the video
+
+        Returns:
+            - result <dict>:
+                {
+                    "camera_id": <int>,
+                    "num_frames": <int> how many frames were read,
+                    "seconds": <float> how long decoding and detecting took,
+                    "from_index": <bool> False, the frames were detected again
+                    "batches": <list<dict>> a DetectionQueue batch of every
+                        frame. The timestamp is seconds from the start of the
+                        session.
+                }
+    """
+    camera_id, src, first_frame, timestamps, end = job
+    result = {
+        "camera_id": camera_id,
+        "num_frames": 0,
+        "seconds": 0.,
+        "from_index": False,
+        "batches": []
+    }
+    camera_meta = get_camera_meta(camera_id, src)
+    if camera_meta is None:
+        print("Could not read", src)
+        return result
+
+    start = time.perf_counter()
+    v = VideoStreamWidget(camera_id, camera_meta, 0, start=False)
+    if first_frame > 0:
+        v.capture.set(cv2.CAP_PROP_POS_FRAMES, first_frame)
+    frame_number = first_frame
+    while True:
+        if timestamps is not None:
+            if frame_number - first_frame >= len(timestamps):
+                break
+            timestamp = timestamps[frame_number - first_frame]
+        else:
+            # Without an index, assume the video was written at exactly
+            # C.CAMERA_FRAME_RATE, so the frame number gives the time
+            timestamp = frame_number / C.CAMERA_FRAME_RATE
+            if end is not None and timestamp >= end:
+                break
+        status, img_raw = v.capture.read()
+        if not status:
+            break
+        frame_number = frame_number + 1
+        result["num_frames"] = result["num_frames"] + 1
+        # Frames without detections are kept too, so the FrameSynchronizer
+        # knows this camera's slot is done
+        result["batches"].append({
+            "camera_id": camera_id,
+            "timestamp": float(timestamp),
+            "detected_aruco_ids_dict": v.process_frame(img_raw)
+        })
+    v.capture.release()
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+class ReplayEngine(object):
+    """
+        A ReplayEngine reprocesses a recorded session (the *_camera_N.avi files
+        saved by VideoStreamWidget) as fast as the CPU allows, instead of at
+        the camera frame rate like MocapSystem.load_video_history(). Each
+        video is decoded and detected in its own worker process, then the
+        detections are merged in time order and fused with a MarkerTracker at
+        every output tick, exactly like the live MocapPublisher would.
+
+        Recordings with an index (see RecordingIndex) are timed by the capture
+        time of each frame, so the cameras line up even if they started at
+        different times or dropped frames. A part of a long session can be
+        replayed by seeking straight to start, and with use_index the
+        detections saved while recording are fused without decoding anything.
+
+        - video_path <string>: Path of the videos up to the camera number,
+            i.e. ".../2022_2_17_14_57_camera_"
+
+        - camera_id_src_dict <dict>: The video file of each camera id
+
+        - pose_history_file_name <string>: Where the fused pose history is
+            written. The throughput stats are written next to it, as
+            <name>_stats.json
+
+        - format <string>: "csv" or "binary", see PoseHistoryWriter
+
+        - num_workers <int>: How many processes decode and detect the videos.
+            Defaults to one per camera, up to the number of cores.
+
+        - frame_rate <float>: How many fused poses per second are written.
+            Defaults to C.MOCAP_OUT_FRAME_RATE, like the live system.
+
+        - num_cameras <int>: Camera numbers 1 to num_cameras are looked for
+
+        - start, end <float>: Seconds from the start of the session to replay
+            from and up to. None replays from the start or to the end
+
+        - use_index <bool>: If True, fuse the detections saved in each
+            camera's index instead of detecting the markers again. They were
+            detected with the calibration the cameras had while recording.
+
+        - camera_id_index_dict <dict>: The RecordingIndex of each camera that
+            has one
+
+        - session_start <float>: time.time() value of the first frame of any
+            indexed camera, or None if no camera has an index. Timestamps of
+            indexed frames are counted from it.
+    """
+    def __init__(
+        self,
+        video_path,
+        pose_history_file_name,
+        format=C.POSE_HISTORY_FORMAT,
+        num_workers=None,
+        frame_rate=C.MOCAP_OUT_FRAME_RATE,
+        num_cameras=C.NUM_CAMERAS,
+        start=None,
+        end=None,
+        use_index=False
+    ):
+        self.video_path = video_path
+        self.pose_history_file_name = pose_history_file_name
+        self.format = format
+        self.frame_rate = frame_rate
+        self.start = start
+        self.end = end
+        self.use_index = use_index
+
+        self.camera_id_index_dict = load_recording_indexes(video_path, num_cameras)
+        self.session_start = get_session_start(self.camera_id_index_dict)
+
+        self.camera_id_src_dict = {}
+        for i in range(1, num_cameras + 1):
+            src = video_path + str(i) + ".avi"
+            if os.path.exists(src):
+                self.camera_id_src_dict[i] = src
+            elif use_index and i in self.camera_id_index_dict:
+                # i.e. a raw recording that isn't encoded yet
+                self.camera_id_src_dict[i] = None
+            else:
+                print(src, "not found. Skipping camera", i)
+
+        self.num_workers = num_workers
+        if self.num_workers is None:
+            self.num_workers = min(len(self.camera_id_src_dict), os.cpu_count())
+
+
+    def run(self):
+        """
+            Replays the whole session and writes the pose history and stats.
+
+            Inputs: None
+
+            Returns:
+                - stats <dict>: throughput of each camera and of the fusion
+        """
+        start = time.perf_counter()
+        results = self.detect_all()
+        detect_seconds = time.perf_counter() - start
+
+        fuse_start = time.perf_counter()
+        num_ticks, num_rows, fusion_stats = self.fuse(results)
+        fuse_seconds = time.perf_counter() - fuse_start
+        total_seconds = time.perf_counter() - start
+
+        start_seconds, end_seconds = self.get_time_range(results)
+        video_seconds = end_seconds - start_seconds
+        stats = {
+            "video_path": self.video_path,
+            "pose_history_file_name": self.pose_history_file_name,
+            "session_start": self.session_start,
+            "start_seconds": start_seconds,
+            "num_workers": self.num_workers,
+            "cameras": {},
+            "video_seconds": video_seconds,
+            "detect_seconds": detect_seconds,
+            "fuse_seconds": fuse_seconds,
+            "total_seconds": total_seconds,
+            "speedup": video_seconds / total_seconds if total_seconds > 0 else 0,
+            "num_ticks": num_ticks,
+            "num_rows": num_rows,
+            "fusion": fusion_stats
+        }
+        for result in results:
+            stats["cameras"][str(result["camera_id"])] = {
+                "indexed": result["camera_id"] in self.camera_id_index_dict,
+                "from_index": result["from_index"],
+                "num_frames": result["num_frames"],
+                "num_detections": int(sum(
+                    [len(batch["detected_aruco_ids_dict"]) for batch in result["batches"]]
+                )),
+                "seconds": result["seconds"],
+                "fps": (result["num_frames"] / result["seconds"]
+                    if result["seconds"] > 0 else 0)
+            }
+
+        stats_file_name = os.path.splitext(self.pose_history_file_name)[0] + "_stats.json"
+        with open(stats_file_name, "w") as f:
+            json.dump(stats, f, indent=4)
+        return stats
+
+
+    def detect_all(self):
+        """
+            Detects the markers in every camera's video, one worker process
+            per video. With use_index, the indexed cameras are read from
+            their index instead.
+
+            Inputs: None
+
+            Returns:
+                - results <list<dict>>: detect_video() result of each camera
+        """
+        results = []
+        jobs = []
+        for camera_id in sorted(self.camera_id_src_dict):
+            src = self.camera_id_src_dict[camera_id]
+            index = self.camera_id_index_dict.get(camera_id)
+            if index is None:
+                first_frame = 0
+                if self.start is not None:
+                    first_frame = int(np.ceil(self.start * C.CAMERA_FRAME_RATE))
+                jobs.append((camera_id, src, first_frame, None, self.end))
+                continue
+
+            # Look up the frames to replay in the index, so the video can be
+            # sought straight to the first one
+            timestamps = index.timestamps - self.session_start
+            first_frame = 0
+            last_frame = len(index)
+            if self.start is not None:
+                first_frame = int(np.searchsorted(timestamps, self.start))
+            if self.end is not None:
+                last_frame = int(np.searchsorted(timestamps, self.end))
+            if self.use_index or src is None:
+                results.append(self.read_index(camera_id))
+            else:
+                jobs.append((
+                    camera_id,
+                    src,
+                    first_frame,
+                    timestamps[first_frame:last_frame],
+                    None
+                ))
+
+        if len(jobs) == 0:
+            return results
+        if self.num_workers <= 1:
+            return results + [detect_video(job) for job in jobs]
+        with Pool(min(self.num_workers, len(jobs)), initializer=init_worker) as pool:
+            return results + pool.map(detect_video, jobs)
+
+
+    def read_index(self, camera_id):
+        """
+            Makes a detect_video() result from the detections saved in a
+            camera's index from start to end, without decoding its video.
+
+            Inputs:
+                - camera_id <int>: a camera in camera_id_index_dict
+
+            Returns:
+                - result <dict>: see detect_video()
+        """
+        start = time.perf_counter()
+        batches = self.camera_id_index_dict[camera_id].get_batches(
+            None if self.start is None else self.session_start + self.start,
+            None if self.end is None else self.session_start + self.end
+        )
+        for batch in batches:
+            batch["timestamp"] = batch["timestamp"] - self.session_start
+        return {
+            "camera_id": camera_id,
+            "num_frames": len(batches),
+            "seconds": time.perf_counter() - start,
+            "from_index": True,
+            "batches": batches
+        }
+
+
+    def get_time_range(self, results):
+        """
+            Inputs:
+                - results <list<dict>>: detect_video() result of each camera
+
+            Returns:
+                - start_seconds, end_seconds <float>: the part of the session
+                    that was replayed, in seconds from its start
+        """
+        start_seconds = self.start if self.start is not None else 0.
+        end_seconds = start_seconds
+        for result in results:
+            if len(result["batches"]) > 0:
+                # The last frame lasts until the one after it would have come
+                end_seconds = max(
+                    end_seconds,
+                    result["batches"][-1]["timestamp"] + 1. / C.CAMERA_FRAME_RATE
+                )
+        if self.end is not None:
+            end_seconds = min(end_seconds, self.end)
+        return start_seconds, end_seconds
+
+
+    def fuse(self, results):
+        """
+            Merges the detections of every camera in time order, groups them
+            into time slots with a FrameSynchronizer, fuses each slot with a
+            MultiViewFusion and pushes them into a MarkerTracker. Every
+            1/frame_rate seconds of video, the expected poses are written to
+            the pose history.
+
+            Inputs:
+                - results <list<dict>>: detect_video() result of each camera
+
+            Returns:
+                - num_ticks <int>: how many output ticks were fused
+                - num_rows <int>: how many poses were written
+                - fusion_stats <dict>: FrameSynchronizer.get_stats() and
+                    MultiViewFusion.get_stats()
+        """
+        marker_tracker = MarkerTracker()
+        frame_synchronizer = FrameSynchronizer(
+            camera_ids=[result["camera_id"] for result in results]
+        )
+        fusion = MultiViewFusion()
+        writer = PoseHistoryWriter(
+            self.pose_history_file_name,
+            format=self.format
+        )
+        # Each camera's batches are already in time order
+        batches = heapq.merge(
+            *[result["batches"] for result in results],
+            key=lambda batch: batch["timestamp"]
+        )
+        start_seconds, end_seconds = self.get_time_range(results)
+
+        num_ticks = 0
+        num_rows = 0
+        batch = next(batches, None)
+        period = 1. / self.frame_rate
+        while start_seconds + num_ticks * period < end_seconds:
+            tick = start_seconds + num_ticks * period
+            slots = []
+            while batch is not None and batch["timestamp"] <= tick:
+                slots = slots + frame_synchronizer.push(batch)
+                batch = next(batches, None)
+            slots = slots + frame_synchronizer.flush(tick)
+            for slot_batches in slots:
+                aruco_ids, poses, sigmas, timestamps = fusion.fuse_slot(slot_batches)
+                if len(aruco_ids) != 0:
+                    marker_tracker.push_many(aruco_ids, poses, timestamps, sigmas)
+            aruco_ids, poses = marker_tracker.get_expected_poses(now=tick)
+            writer.push(aruco_ids, poses, tick, block=True)
+            num_ticks = num_ticks + 1
+            num_rows = num_rows + len(aruco_ids)
+        writer.close()
+        fusion_stats = frame_synchronizer.get_stats()
+        fusion_stats.update(fusion.get_stats())
+        return num_ticks, num_rows, fusion_stats
@@ -0,0 +1,245 @@
+from cv2 import aruco
+import numpy as np
+
+from .constants import constants as C
+
+# The counters of a RoiDetector, in the order of get_counters()
+COUNTER_NAMES = [
+    "frames",
+    "full_scans",
+    "tracked",
+    "hits",
+    "searched_pixels",
+    "pixels"
+]
+
+class RoiDetector(object):
+    """
+        A RoiDetector finds aruco markers in a frame by only searching windows
+        around where the markers were in the frame before, instead of running
+        aruco.detectMarkers on the whole frame every time. Most of a classroom
+        frame is empty floor, so the windows are a small part of it.
+
+        The whole frame is still searched:
+            - every full_scan_interval frames, to find markers that just came
+                into view
+            - when there are no markers to track
+            - when a tracked marker isn't found in its window. The frame is
+                searched again right away, so the marker isn't lost for a frame.
+
+        - padding <float>: How much bigger than a marker's bounding box its
+            window is, in marker sizes on each side. Corresponds to
+            C.ROI_PADDING
+
+        - min_window_size <int>: Pixels. Windows are at least this wide and
+            tall. Corresponds to C.ROI_MIN_WINDOW_SIZE
+
+        - full_scan_interval <int>: Corresponds to C.ROI_FULL_SCAN_INTERVAL
+
+        - tracked_corners <dict>: The corners of each marker found in the last
+            frame, keyed by aruco id
+
+        - frames_since_full_scan <int>: How many frames were searched in
+            windows since the whole frame was last searched
+
+        - frame_count, full_scan_count, tracked_count, hit_count,
+            searched_pixel_count, pixel_count <int>: How many frames were
+            searched, how many of those needed the whole frame, how many
+            markers were looked for in windows and found there, and how many
+            pixels were searched out of how many there were
+    """
+    def __init__(
+        self,
+        padding=C.ROI_PADDING,
+        min_window_size=C.ROI_MIN_WINDOW_SIZE,
+        full_scan_interval=C.ROI_FULL_SCAN_INTERVAL
+    ):
+        self.padding = padding
+        self.min_window_size = min_window_size
+        self.full_scan_interval = full_scan_interval
+        self.tracked_corners = {}
+        self.frames_since_full_scan = 0
+        self.frame_count = 0
+        self.full_scan_count = 0
+        self.tracked_count = 0
+        self.hit_count = 0
+        self.searched_pixel_count = 0
+        self.pixel_count = 0
+
+
+    def reset(self):
+        """
+            Forgets the tracked markers, i.e. when the frames change size
+            because the calibration changed. The next frame is searched whole.
+        """
+        self.tracked_corners = {}
+
+
+    def get_windows(self, w, h):
+        """
+            Pads the bounding box of every tracked marker, and merges the
+            windows that overlap so no pixel is searched twice.
+
+            Inputs:
+                - w, h <int>: size of the frame
+
+            Returns:
+                - windows <list<list>>: [x0, y0, x1, y1] of every window
+        """
+        windows = []
+        for corners in self.tracked_corners.values():
+            x0, y0 = corners.min(axis=0)
+            x1, y1 = corners.max(axis=0)
+            pad = self.padding * max(x1 - x0, y1 - y0)
+            pad_x = max(pad, (self.min_window_size - (x1 - x0)) / 2)
+            pad_y = max(pad, (self.min_window_size - (y1 - y0)) / 2)
+            windows.append([
+                int(max(0, np.floor(x0 - pad_x))),
+                int(max(0, np.floor(y0 - pad_y))),
+                int(min(w, np.ceil(x1 + pad_x))),
+                int(min(h, np.ceil(y1 + pad_y)))
+            ])
+
+        merged = True
+        while merged:
+            merged = False
+            for i in range(0, len(windows)):
+                for j in range(i + 1, len(windows)):
+                    a = windows[i]
+                    b = windows[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        windows[i] = [
+                            min(a[0], b[0]), min(a[1], b[1]),
+                            max(a[2], b[2]), max(a[3], b[3])
+                        ]
+                        del windows[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return windows
+
+
+    def detect_full(self, img_gray):
+        self.full_scan_count = self.full_scan_count + 1
+        self.frames_since_full_scan = 0
+        self.searched_pixel_count = self.searched_pixel_count + img_gray.size
+        corners, detected_aruco_ids, rejected_pts = aruco.detectMarkers(
+            img_gray,
+            C.ARUCO_DICT,
+            parameters=C.ARUCO_PARAMS
+        )
+        return corners, detected_aruco_ids
+
+
+    def detect_windows(self, img_gray):
+        """
+            Searches the window around each tracked marker.
+
+            Returns:
+                - corners <list<np.array(1,4,2)>>, detected_aruco_ids
+                    <np.array(n,1)>: same as aruco.detectMarkers()
+        """
+        h, w = img_gray.shape[:2]
+        corners = []
+        detected_aruco_ids = []
+        for x0, y0, x1, y1 in self.get_windows(w, h):
+            self.searched_pixel_count = self.searched_pixel_count + (x1 - x0) * (y1 - y0)
+            window_corners, window_ids, rejected_pts = aruco.detectMarkers(
+                img_gray[y0:y1, x0:x1],
+                C.ARUCO_DICT,
+                parameters=C.ARUCO_PARAMS
+            )
+            if window_ids is None:
+                continue
+            offset = np.array([x0, y0], dtype=np.float32)
+            for i in range(0, len(window_ids)):
+                corners.append(window_corners[i] + offset)
+                detected_aruco_ids.append(window_ids[i])
+        if len(detected_aruco_ids) == 0:
+            return [], None
+        return corners, np.array(detected_aruco_ids, dtype=np.int32).reshape(-1, 1)
+
+
+    def detect(self, img_gray):
+        """
+            Finds the aruco markers in a frame, searching only the windows
+            around the tracked markers when it can.
+
+            Inputs:
+                - img_gray <np.array>: the grayscale frame
+
+            Returns:
+                - corners <list<np.array(1,4,2)>>: same as aruco.detectMarkers()
+                - detected_aruco_ids <np.array(n,1)>: same as
+                    aruco.detectMarkers(), None if nothing was found
+        """
+        self.frame_count = self.frame_count + 1
+        self.pixel_count = self.pixel_count + img_gray.size
+
+        if (len(self.tracked_corners) == 0 or
+            self.frames_since_full_scan + 1 >= self.full_scan_interval):
+            corners, detected_aruco_ids = self.detect_full(img_gray)
+        else:
+            self.frames_since_full_scan = self.frames_since_full_scan + 1
+            corners, detected_aruco_ids = self.detect_windows(img_gray)
+            found_ids = set()
+            if detected_aruco_ids is not None:
+                found_ids = set(detected_aruco_ids[:, 0].tolist())
+            num_found = len(found_ids.intersection(self.tracked_corners))
+            self.tracked_count = self.tracked_count + len(self.tracked_corners)
+            self.hit_count = self.hit_count + num_found
+            if num_found < len(self.tracked_corners):
+                # A marker moved out of its window (or out of view), so
+                # search the whole frame for it
+                corners, detected_aruco_ids = self.detect_full(img_gray)
+
+        self.tracked_corners = {}
+        if detected_aruco_ids is not None:
+            for i, aruco_id in enumerate(detected_aruco_ids[:, 0]):
+                self.tracked_corners[int(aruco_id)] = np.asarray(corners[i]).reshape(4, 2)
+        return corners, detected_aruco_ids
+
+
+    def get_counters(self):
+        """
+            Returns:
+                - counters <list<int>>: in the order of COUNTER_NAMES
+        """
+        return [
+            self.frame_count,
+            self.full_scan_count,
+            self.tracked_count,
+            self.hit_count,
+            self.searched_pixel_count,
+            self.pixel_count
+        ]
+
+
+    def get_stats(self):
+        return get_roi_stats(self.get_counters())
+
+
+def get_roi_stats(counters):
+    """
+        Makes the stats of a RoiDetector from its counters. Counters can come
+        from another process, i.e. a CaptureWorker.
+
+        Inputs:
+            - counters <list>: from RoiDetector.get_counters()
+
+        Returns:
+            - stats <dict>: the counters, plus
+                "hit_rate": how often a tracked marker was found in its window,
+                "searched_fraction": how much of each frame was searched
+    """
+    stats = dict([
+        (name, int(counters[i])) for i, name in enumerate(COUNTER_NAMES)
+    ])
+    stats["hit_rate"] = (
+        stats["hits"] / stats["tracked"] if stats["tracked"] > 0 else 0.
+    )
+    stats["searched_fraction"] = (
+        stats["searched_pixels"] / stats["pixels"] if stats["pixels"] > 0 else 0.
+    )
+    return stats
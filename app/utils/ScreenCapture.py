@@ -1,104 +1,163 @@
-import os
-import datetime
 import time
+import atexit
 
 import cv2
+import mss
 import numpy as np
-import pyscreenshot as ImageGrab
-from multiprocessing import Process
+from multiprocessing import Process, Value
 
 from .constants import constants as C
+from .FrameRecorder import FrameRecorder
+
+def get_screen_region(region=C.SCREEN_CAPTURE_REGION):
+    """
+        Turns a region of the screen into the monitor dict mss grabs.
+
+        Inputs:
+            - region <tuple>: (left, top, width, height) in pixels, or None for
+                the whole primary monitor
+
+        Returns:
+            - monitor <dict>: {"left", "top", "width", "height"}
+    """
+    if region is not None:
+        left, top, width, height = region
+        return {"left": left, "top": top, "width": width, "height": height}
+    with mss.mss() as sct:
+        monitor = sct.monitors[1]
+    return {
+        "left": monitor["left"],
+        "top": monitor["top"],
+        "width": monitor["width"],
+        "height": monitor["height"]
+    }
+
+
+def run_screen_grabber(frame_queue, monitor, frame_rate, record_start_time, running):
+    """
+        Grabs monitor frame_rate times a second and puts each screenshot into
+        frame_queue, until running is False. This is run in the grab process
+        of a ScreenCapture.
+
+        One mss grabber is made for the whole run, instead of one per
+        screenshot. mss gives BGRA pixels, which are turned into BGR straight
+        into the frame_queue's shared memory, so the screenshot is only copied
+        once.
+
+        Inputs:
+            - frame_queue <FrameQueue>: where the screenshots go
+            - monitor <dict>: the region of the screen to grab
+            - frame_rate <float>: screenshots per second
+            - record_start_time <float>: time.time() value to start grabbing at
+            - running <Value>: set to False to stop
+
+        Returns: None
+    """
+    period = 1. / frame_rate
+    shape = (monitor["height"], monitor["width"], 3)
+    next_time = max(record_start_time, time.time())
+    with mss.mss() as sct:
+        while running.value:
+            # Sleep until the next screenshot is due instead of polling the
+            # clock, so this process only uses CPU to grab
+            wait = next_time - time.time()
+            if wait > 0:
+                time.sleep(min(wait, 1.))
+                continue
+            timestamp = time.time()
+            screenshot = sct.grab(monitor)
+            bgra = np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(
+                screenshot.height, screenshot.width, 4
+            )
+            slot = frame_queue.get_free_slot()
+            if slot is not None:
+                cv2.cvtColor(
+                    bgra,
+                    cv2.COLOR_BGRA2BGR,
+                    dst=frame_queue.get_frame(slot, shape)
+                )
+                frame_queue.put(slot, timestamp, shape)
+            # If a screenshot took longer than period, skip the ones we
+            # missed instead of grabbing them all at once
+            next_time = max(next_time + period, time.time())
+
 
 class ScreenCapture(object):
     """
         ScreenCapture handles all the screen capturing capability of the MocapSystem
         When MocapSystem.save_video is True, we save the Screen Capture.
 
-        - video_result <cv2.VideoWriter>: VideoWriter object which handles
-            saving a .avi file on the file system
+        The screen is grabbed in one process and encoded by a FrameRecorder in
+        another, with the screenshots handed over in shared memory. The
+        FrameRecorder's index has the time of every screenshot, so the screen
+        can be lined up with the camera recordings.
 
         - record_start_time <float>: A value from time.time() which indicates
             when to start recording the screen.
 
-        - update_process <Process>: Throws saving the video saving into a new
-            process to optimize runtime.
+        - monitor <dict>: The region of the screen being grabbed, i.e. just the
+            Desmos canvas. Corresponds to C.SCREEN_CAPTURE_REGION
+
+        - frame_recorder <FrameRecorder>: Encodes the screenshots into the
+            .avi file and writes its index
+
+        - running <Value>: Set to False to stop update_process
+
+        - update_process <Process>: Runs run_screen_grabber
     """
-    def __init__(self, record_start_time):
-        self.video_result = self.get_video_result()
+    def __init__(
+        self,
+        record_start_time,
+        file_name,
+        region=C.SCREEN_CAPTURE_REGION,
+        frame_rate=C.SCREEN_CAPTURE_FRAME_RATE
+    ):
         self.record_start_time = record_start_time
-
-        self.update_process = Process(target=self.update, args=())
+        self.monitor = get_screen_region(region)
+        self.frame_recorder = FrameRecorder(
+            "screen",
+            file_name,
+            frame_size=(self.monitor["width"], self.monitor["height"]),
+            raw=False,
+            frame_rate=frame_rate
+        )
+        self.running = Value("b", True, lock=False)
+
+        self.update_process = Process(
+            target=run_screen_grabber,
+            args=(
+                self.frame_recorder.frame_queue,
+                self.monitor,
+                frame_rate,
+                record_start_time,
+                self.running
+            )
+        )
         self.update_process.daemon = True
         self.update_process.start()
 
+        # Registered after the FrameRecorder's, so this runs first at exit
+        atexit.register(self.stop)
 
-    def get_video_result(self):
-        """
-            Creates the folder and the .avi file for screen recording.
-
-            Inputs: None
 
-            Returns:
-                - video_result <cv2.VideoWriter> VideoWriter object which handles
-                    saving a .avi file on the file system
+    def get_stats(self):
         """
-        current_datetime = datetime.datetime.now()
-        current_year = current_datetime.year
-        current_month = current_datetime.month
-        current_day = current_datetime.day
-        current_hour = current_datetime.hour
-        current_minute = current_datetime.minute
-
-        YY_MM_DD_FOLDER = (
-            str(current_year) + "_" +
-            str(current_month) + "_" +
-            str(current_day) + "/"
-        )
-
-        try:
-            os.mkdir(C.SAVE_SCREEN_STREAM_FILE_PATH + YY_MM_DD_FOLDER)
-        except OSError as error:
-            print(error)
-            print("Skipping")
-
-        video_file_name = (C.SAVE_SCREEN_STREAM_FILE_PATH +
-            YY_MM_DD_FOLDER +
-            str(current_year) + "_" +
-            str(current_month) + "_" +
-            str(current_day) + "_" +
-            str(current_hour) + "_" +
-            str(current_minute) + "_screen.avi"
-        )
-
-        video_result = cv2.VideoWriter(video_file_name,
-            cv2.VideoWriter_fourcc(*'MJPG'),
-            C.SCREEN_CAPTURE_FRAME_RATE,
-            C.SCREEN_CAPTURE_SIZE
-        )
+            Same as FrameRecorder.get_stats()
+        """
+        return self.frame_recorder.get_stats()
 
-        return video_result
 
-    def update(self):
+    def stop(self):
         """
-            Grabs a screenshot from the display and then writes it to the
-            video_result object. This function is being run on a separate
-            Proces and has limited access to variables.
+            Stops grabbing, then lets the FrameRecorder finish the video.
 
             Inputs: None
 
             Returns: None
         """
-        prev = 0
-        while True:
-            if time.time() > self.record_start_time:
-                time_elapsed = time.time() - prev
-                # ImageGrab uses PIL, which saves as RGB, OpenCV uses BGR.
-                if time_elapsed >= 1./C.SCREEN_CAPTURE_FRAME_RATE:
-                    prev = time.time()
-                    screenshot = np.array(
-                        ImageGrab.grab(
-                            backend="mss", childprocess=False
-                        )
-                    )
-                    cv_img = cv2.cvtColor(screenshot, cv2.COLOR_RGB2BGR)
-                    self.video_result.write(cv_img)
+        self.running.value = False
+        self.update_process.join(C.RECORD_STOP_TIMEOUT)
+        if self.update_process.is_alive():
+            self.update_process.terminate()
+            self.update_process.join()
+        self.frame_recorder.stop()
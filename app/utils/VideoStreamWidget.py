@@ -1,7 +1,5 @@
 import time
 import numpy as np
-import datetime
-import os
 
 import cv2
 from cv2 import aruco
@@ -10,6 +8,9 @@ from multiprocessing import Process
 from threading import Thread
 
 from .constants import constants as C
+from .Rectifier import Rectifier
+from .RoiDetector import RoiDetector
+from .CalibrationStore import CalibrationStore
 
 class VideoStreamWidget(object):
     """
@@ -17,7 +18,7 @@ class VideoStreamWidget(object):
             - reading the camera
             - undistoring images
             - detecting aruco markers
-            - saving video #FIXME: cannot record multiple streams right now
+            - pushing the raw frames to a FrameRecorder, to save them
 
         - id <int>: the camera id in the real world
 
@@ -27,16 +28,45 @@ class VideoStreamWidget(object):
                 "mtx": np.array, the camera matrix to undistort the image
                 "dist_coeff": np.array, the distance coeffs to undistort the image
                 "new_camera_mtx": np.array, the new camera matrix to undistort img
-                "save_video" : bool, if we should save video or not
+                "identity": string, optional. The camera identity in the
+                    CalibrationStore, to reload the calibration from
+                "extrinsic_matrix": np.array(4,4), optional. Camera to world
+                "start_frame": int, optional. The frame of a video to start
+                    reading from
             }
 
         - capture <cv2.VideoCapture>: the VideoCapture object for reading the camera
 
         - status <bool>: Status of the camera, returned from cv2.VideoCapture.read()
 
-        - use_roi <bool>: When calling cv2.undistort(), we get a region of interest (ROI)
+        - use_roi <bool>: When undistorting, we get a region of interest (ROI)
             box. use_roi determines if we want to crop our image based on that ROI
 
+        - rectifier <Rectifier>: Holds the precomputed undistortion remap tables
+            for this camera so we don't rebuild them on every frame
+
+        - cam_rot_mat <np.array(3,3)>, cam_tra_mat <np.array(3)>: The
+            rotation and translation from this camera to the world, from
+            C.CAMERA_EXTRINSIC_MATRIX_DICT. None if the camera isn't calibrated.
+
+        - last_warning_time <float>: time.time() value of the last warning
+            about a missing extrinsic matrix, so we don't print every frame
+
+        - calibration_store <CalibrationStore>: Where this camera's calibration
+            is reloaded from when it changes. None if camera_meta has no identity
+
+        - last_reload_check_time <float>: time.time() value of the last time
+            we checked calibration_store
+
+        - detect_on_raw <bool>: If True, aruco markers are detected on the raw
+            frame and only their corners are undistorted, instead of
+            undistorting every pixel of every frame. img_gray and
+            undistorted_img then hold the raw (distorted) image.
+
+        - roi_detector <RoiDetector>: Searches for the aruco markers near where
+            they were in the frame before. None if C.USE_ROI_DETECTION is False,
+            then every frame is searched whole
+
         - img_raw <np.array>: the raw image from the camera, without any processing done
 
         - img_gray <np.array>: the raw image turned into gray scale
@@ -47,12 +77,18 @@ class VideoStreamWidget(object):
         - img_with_aruco <np.array>: The image with drawn boxes around aruco
             markers
 
-        - video_result <cv2.VideoWriter>: The VideoWriter object which is used
-            for saving video #FIXME: cannot record multiple streams right now
+        - annotated_frame <tuple>: (frame_timestamp, undistorted_img) of the
+            latest frame, set only once the markers are drawn on it, so a
+            reader (i.e. the PreviewPublisher) never gets a half finished
+            frame. None before the first frame
 
         - record_start_time <float>: time.time() value which determines when
             to start saving video
 
+        - frame_queue <FrameQueue>: Optional queue of a FrameRecorder, that
+            every raw frame after record_start_time is pushed into, with its
+            detections
+
         - detected_aruco_ids_dict <dict>: Dictionary gives the detected
             id position, based on the camera. This is an intrinsic camera value.
             {
@@ -60,110 +96,85 @@ class VideoStreamWidget(object):
                    "camera_id": <int> the camera_id
                    "rvec": <np.array(3,1)> rotation vector
                    "tvec": <np.array(3,1)> translation vector
+                   "tvec_sigma": <float> cm, estimated error of tvec
+                   "camera_center": <np.array(3)> where the camera is in the
+                        world, or None if the camera isn't calibrated
+                   "corner_rays": <np.array(4,3)> world directions from the
+                        camera through each corner, or None
+                   "ray_sigma": <float> radians, estimated error of each ray
+                        direction, or None
                 }
             }
 
-        - update_thread <Thread>: Thread to handle reading the cameras, undistorting
-            the image, and detecting aruco markers. # TODO: Is there value in
-            putting this in a Process instead of a Thread?
+        - frame_timestamp <float>: time.time() value of when img_raw was
+            grabbed from the camera
+
+        - detection_queue <DetectionQueue>: Optional queue that the detections
+            of every frame are pushed into, for MocapSystem to fuse
 
-        - save_video_thread <Thread>: Handles saving video in a separate thread
+        - on_frame <function>: Optional callback, called with this
+            VideoStreamWidget after every frame is processed. CaptureWorker
+            uses this to publish detections out of its process.
+
+        - update_thread <Thread>: Thread to handle reading the cameras, undistorting
+            the image, and detecting aruco markers. To run this in its own
+            Process instead, see CaptureWorker. Not started if start is False,
+            so that ReplayEngine can read frames as fast as it can.
     """
-    def __init__ (self, id, camera_meta, record_start_time):
+    def __init__ (
+        self,
+        id,
+        camera_meta,
+        record_start_time,
+        detection_queue=None,
+        on_frame=None,
+        start=True,
+        frame_queue=None
+    ):
         self.id = id # camera id
         self.camera_meta = camera_meta # meta info (see MocapSystem)
         self.src = camera_meta["src"] # cv2 camera source id or video history location
         self.capture = cv2.VideoCapture(self.src)
+        if isinstance(self.src, int):
+            # Only keep the newest frame, so the frame we read (and its
+            # timestamp) isn't one that waited in the driver's buffer
+            self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        elif camera_meta.get("start_frame", 0) > 0:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, camera_meta["start_frame"])
         self.status = None # Status of the camera
         self.use_roi = True # roi = Region of Interest
+        self.rectifier = Rectifier(camera_meta, self.use_roi)
+        self.detect_on_raw = C.DETECT_ON_RAW_FRAME
+        self.roi_detector = RoiDetector() if C.USE_ROI_DETECTION else None
+        self.cam_rot_mat, self.cam_tra_mat = self.get_extrinsic_matrix()
+        self.last_warning_time = 0
+        self.calibration_store = None
+        if camera_meta.get("identity") is not None:
+            self.calibration_store = CalibrationStore()
+            self.calibration_store.get(camera_meta["identity"])
+        self.last_reload_check_time = time.time()
         self.img_raw = None # save for data collection
+        self.frame_timestamp = None
         self.img_gray = None # img_gray is undistorted
         self.undistorted_img = None # If use_roi is True, crop the img
         self.img_with_aruco = None
-        self.video_result = self.get_video_result()
+        self.annotated_frame = None
         self.record_start_time = record_start_time
+        self.frame_queue = frame_queue
+        self.detection_queue = detection_queue
+        self.on_frame = on_frame
 
         self.detected_aruco_ids_dict = {}
 
+        # Offline tools (i.e. ReplayEngine) read self.capture and call
+        # process_frame themselves
+        if not start:
+            return
+
         self.update_thread = Thread(target=self.update, args=())
         self.update_thread.daemon = True
         self.update_thread.start()
 
-        # Saving video on all cameras is too intensive for my computer.
-        # Default is going to be false and I'll try to capture just 1 for data collection
-        if camera_meta["save_video"]:
-            self.save_video_thread = Thread(target=self.save_video, args=())
-            self.save_video_thread.daemon = True
-            self.save_video_thread.start()
-
-
-    def get_video_result(self):
-        """
-            Creates the folder and the .avi file for video recording.
-
-            Inputs: None
-
-            Returns:
-                - video_result <cv2.VideoWriter> VideoWriter object which handles
-                    saving a .avi file on the file system
-        """
-        if self.camera_meta["save_video"]:
-            current_datetime = datetime.datetime.now()
-            current_year = current_datetime.year
-            current_month = current_datetime.month
-            current_day = current_datetime.day
-            current_hour = current_datetime.hour
-            current_minute = current_datetime.minute
-
-            YY_MM_DD_FOLDER = (
-                str(current_year) + "_" +
-                str(current_month) + "_" +
-                str(current_day) + "/"
-            )
-
-            try:
-                os.mkdir(C.SAVE_VIDEO_STREAM_FILE_PATH + YY_MM_DD_FOLDER)
-            except OSError as error:
-                print(error)
-                print("Skipping")
-
-            video_file_name = (C.SAVE_VIDEO_STREAM_FILE_PATH +
-                YY_MM_DD_FOLDER +
-                str(current_year) + "_" +
-                str(current_month) + "_" +
-                str(current_day) + "_" +
-                str(current_hour) + "_" +
-                str(current_minute) + "_camera_" +
-                str(self.id) + ".avi"
-            )
-            print(video_file_name)
-            return cv2.VideoWriter(video_file_name,
-                cv2.VideoWriter_fourcc(*'MJPG'),
-                C.CAMERA_FRAME_RATE,
-                C.CAMERA_FRAME_SIZE
-            )
-        else:
-            return None
-
-
-    def save_video(self):
-        """
-            Handles writing the raw image into a video file. This function is
-            run in save_video_thread for optimization.
-
-            Inputs: None
-
-            Returns: None
-        """
-        prev = 0
-        while True:
-            if time.time() > self.record_start_time:
-                time_elapsed = time.time() - prev
-                if time_elapsed >= 1./C.CAMERA_FRAME_RATE:
-                    # print(time_elapsed)
-                    prev = time.time()
-                    self.video_result.write(self.img_raw)
-
 
     def save_image(self, file_path, type="RAW"):
         """
@@ -196,46 +207,101 @@ class VideoStreamWidget(object):
         return success
 
 
-    def transform_to_world(self, rvec, tvec):
+    def get_extrinsic_matrix(self):
+        """
+            Looks up this camera's extrinsic matrix once, so that
+            transform_to_world doesn't need to on every frame. The
+            CalibrationStore's matrix is used if camera_meta has one.
+
+            Inputs: None
+
+            Returns:
+                - cam_rot_mat <np.array(3,3)>: Rotation from camera to world, or
+                    None if the camera isn't calibrated
+                - cam_tra_mat <np.array(3)>: Translation from camera to world, or
+                    None if the camera isn't calibrated
+        """
+        CAM_MAT = self.camera_meta.get("extrinsic_matrix")
+        if CAM_MAT is None:
+            if self.id not in C.CAMERA_EXTRINSIC_MATRIX_DICT:
+                return None, None
+            CAM_MAT = C.CAMERA_EXTRINSIC_MATRIX_DICT[self.id]
+        return CAM_MAT[0:3, 0:3].copy(), CAM_MAT[0:3, 3].copy()
+
+
+    def reload_calibration(self):
+        """
+            Checks the CalibrationStore every C.CALIBRATION_RELOAD_INTERVAL
+            seconds, and switches to the new calibration if it changed. This
+            is called between frames in update(), so process_frame never sees
+            half of a calibration.
+
+            Inputs: None
+
+            Returns:
+                - reloaded <bool>: True if the calibration changed
+        """
+        if self.calibration_store is None:
+            return False
+        if time.time() - self.last_reload_check_time < C.CALIBRATION_RELOAD_INTERVAL:
+            return False
+        self.last_reload_check_time = time.time()
+        calibration = self.calibration_store.reload(self.camera_meta["identity"])
+        if calibration is None:
+            return False
+
+        camera_meta = dict(calibration)
+        camera_meta["src"] = self.camera_meta["src"]
+        self.camera_meta = camera_meta
+        self.rectifier = Rectifier(camera_meta, self.use_roi)
+        self.cam_rot_mat, self.cam_tra_mat = self.get_extrinsic_matrix()
+        if self.roi_detector is not None:
+            # The ROI of the new calibration may crop the frame differently
+            self.roi_detector.reset()
+        print("Camera", self.id, "reloaded calibration version", camera_meta["version"])
+        return True
+
+
+    def transform_to_world(self, rvecs, tvecs):
         """
             Applies a matrix transformation to convert from the camera's
-            intrinsic position to the world's extrinsic position. These
-            matrices are held in constants.py and are calculated through
-            Guoxiang's Posegraph.jl.
+            intrinsic position to the world's extrinsic position, for every
+            detected marker in a frame at once. These matrices are held in
+            constants.py and are calculated through Guoxiang's Posegraph.jl,
+            or loaded from the files written by solve_extrinsics.py.
 
             Inputs:
-                - rvec <np.array> Intrinsic Rotation vector
-                - tvec <np.array> Intrinsic Translation vector
+                - rvecs <np.array(n,3)> Intrinsic Rotation vectors
+                - tvecs <np.array(n,3)> Intrinsic Translation vectors
 
             Returns:
-                - rvec <np.array> The same input rotation vector
+                - rvecs <np.array(n,3)> The same input rotation vectors
                     # TODO: Will we ever need to calculate the new rotation vec?
-                - new_tvec <np.array> Extrinsic translation vector
+                - new_tvecs <np.array(n,3)> Extrinsic translation vectors
         """
-        # Matrix Multiply to calculate the tvec of where the aruco marker is in
-        # the world.
-        CAM_MAT = None
-        if self.id in list(C.CAMERA_EXTRINSIC_MATRIX_DICT):
-            CAM_MAT = C.CAMERA_EXTRINSIC_MATRIX_DICT[self.id]
-        else:
-            print("""
-                WARNING: Camera Matrix not found in Dict.
-                Using camera coordinates.
-            """)
-            return rvec, tvec
+        if self.cam_rot_mat is None:
+            # Only warn every so often, printing on every frame can stall
+            # update_thread
+            if time.time() - self.last_warning_time >= C.WARNING_INTERVAL:
+                self.last_warning_time = time.time()
+                print("WARNING: Camera " + str(self.id) + " Matrix not found" +
+                    " in Dict. Using camera coordinates."
+                )
+            return rvecs, tvecs
 
-        CAM_ROT_MAT = CAM_MAT[:,0:3][0:3]
-        CAM_TRA_MAT = CAM_MAT[:,3][0:3]
-        new_tvec = CAM_ROT_MAT @ tvec + CAM_TRA_MAT
-        return rvec, new_tvec
+        # Matrix Multiply to calculate the tvecs of where the aruco markers are
+        # in the world. Each row is a tvec, so R @ tvec becomes tvecs @ R.T
+        new_tvecs = tvecs @ self.cam_rot_mat.T + self.cam_tra_mat
+        return rvecs, new_tvecs
 
 
     def update(self):
         """
             Reads the VideoCapture object to get the most recent camera image,
             processes the image, and updates detected_aruco_ids_dict for
-            any new detected aruco_ids. This function is ran on update_thread
-            for optimization.
+            any new detected aruco_ids. The detections are pushed into
+            detection_queue and on_frame is called after every frame.
+            This function is ran on update_thread for optimization.
 
             Inputs: None
 
@@ -247,92 +313,224 @@ class VideoStreamWidget(object):
             # This could be an interesting idea to study to see if it makes
             # pedagogical differences
             marker_id_pose_dict = {}
+            self.reload_calibration()
 
             if self.capture.isOpened():
-                self.status, self.img_raw = self.capture.read()
-
-                # undistort the image using the pre-loaded calibration file
-                self.undistorted_img = cv2.undistort(
-                    self.img_raw,
-                    self.camera_meta["mtx"],
-                    self.camera_meta["dist_coeff"],
-                    None,
-                    self.camera_meta["new_camera_mtx"]
-                )
-
-                # region of interest
-                if self.use_roi == True:
-                    x, y, w, h = self.camera_meta['roi']
-                    self.undistorted_img = self.undistorted_img[y:y+h, x:x+w]
-                self.img_gray = cv2.cvtColor(
-                    self.undistorted_img, cv2.COLOR_RGB2GRAY
-                )
-                # Detect any AruCo Markers
-                corners, detected_aruco_ids, rejected_pts = aruco.detectMarkers(
-                    self.img_gray,
-                    C.ARUCO_DICT,
-                    parameters=C.ARUCO_PARAMS
-                )
-                if len(corners) != 0:
-                    # estimate the position of aruco markers in the image frame
-                    # https://docs.opencv.org/4.5.3/d9/d6a/group__aruco.html#ga84dd2e88f3e8c3255eb78e0f79571bd1
-                    # this returns a list of rotation vectors and a list of
-                    # translation vectors of where each id is located.
-                    rvecs, tvecs, _objPoints = aruco.estimatePoseSingleMarkers(
-                        corners,
-                        C.MARKER_LENGTH,
-                        self.camera_meta["new_camera_mtx"],
-                        self.camera_meta["dist_coeff"],
-                        None,
-                        None
+                # Take the timestamp as soon as the frame is grabbed, before
+                # it is decoded, so it is as close to the capture as we can get
+                self.status = self.capture.grab()
+                self.frame_timestamp = time.time()
+                if self.status:
+                    self.status, self.img_raw = self.capture.retrieve()
+
+                if self.status:
+                    marker_id_pose_dict = self.process_frame(self.img_raw)
+                    self.annotated_frame = (self.frame_timestamp, self.undistorted_img)
+
+                if (self.status and self.frame_queue is not None and
+                    self.frame_timestamp >= self.record_start_time):
+                    # Only copies the frame, the FrameRecorder's process
+                    # encodes it and indexes it with its detections
+                    self.frame_queue.push(
+                        self.img_raw,
+                        self.frame_timestamp,
+                        marker_id_pose_dict
                     )
-                    # If frame is read correctly and we have detected some ids
-                    if self.status != 0 and detected_aruco_ids is not None:
-                        # Draw the markers onto the image (axis on image)
-                        self.undistorted_img = aruco.drawDetectedMarkers(
-                            self.undistorted_img,
-                            corners,
-                            detected_aruco_ids,
-                            (0,255,0)
-                        )
-
-                        # Go through the detected aruco_ids and assign their
-                        # rvec, tvec as a dictionary.
-                        # Save that dictionary as a class variable so that
-                        # MocapSystem can aggregate across all VideoStreams
-                        # to prep for JSON Transfer
-                        for i, aruco_id in enumerate(detected_aruco_ids):
-                            # Putting [0] here assumes that we only have one
-                            # of each aruco marker. For my classroom, this
-                            # should be a safe assumption to make.
-                            # i.e. we should see at most 1 unique aruco id
-                            # per camera.
-                            rvec_world, tvec_world = self.transform_to_world(
-                                rvecs[i][0],
-                                tvecs[i][0]
-                            )
-                            marker_id_pose_dict[aruco_id[0]] = {
-                                "camera_id": self.id,
-                                "rvec": rvec_world,
-                                "tvec": tvec_world
-                            }
 
             # if len(marker_id_pose_dict) != 0:
             self.detected_aruco_ids_dict = marker_id_pose_dict
+            if self.detection_queue is not None and self.status:
+                self.detection_queue.push(
+                    self.id,
+                    self.frame_timestamp,
+                    marker_id_pose_dict
+                )
+            if self.on_frame is not None:
+                self.on_frame(self)
             time.sleep(1./C.CAMERA_FRAME_RATE)
 
 
-    def show_frame(self):
+    def process_frame(self, img_raw):
         """
-            Shows the frame using cv2 UI. This function needs to be updated into
-            a front-end application instead. #TODO
+            Undistorts an image, detects any aruco markers in it and estimates
+            their world position. Updates img_gray and undistorted_img along
+            the way. This is the per-frame work of update(), split out so
+            that it can also be run outside of update_thread.
 
-            Inputs: None
+            Inputs:
+                - img_raw <np.array>: the raw image from the camera
 
-            Returns: None
+            Returns:
+                - marker_id_pose_dict <dict>: the detected aruco ids and their
+                    poses, in the same format as detected_aruco_ids_dict
+        """
+        marker_id_pose_dict = {}
+
+        if self.detect_on_raw == True:
+            # Detect on the raw image, then only undistort the
+            # corners of the markers that we found. Copy the raw image
+            # so drawing the markers doesn't change img_raw.
+            self.undistorted_img = img_raw.copy()
+            self.img_gray = cv2.cvtColor(img_raw, cv2.COLOR_RGB2GRAY)
+            raw_corners, detected_aruco_ids = self.detect_markers(self.img_gray)
+            corners = self.rectifier.undistort_corners(raw_corners)
+        else:
+            # undistort the image using the precomputed remap tables,
+            # and crop to the region of interest if use_roi is True
+            self.undistorted_img = self.rectifier.undistort(img_raw)
+            self.img_gray = cv2.cvtColor(
+                self.undistorted_img, cv2.COLOR_RGB2GRAY
+            )
+            # Detect any AruCo Markers
+            corners, detected_aruco_ids = self.detect_markers(self.img_gray)
+            raw_corners = corners
+        if len(corners) != 0:
+            # estimate the position of aruco markers in the image frame
+            # https://docs.opencv.org/4.5.3/d9/d6a/group__aruco.html#ga84dd2e88f3e8c3255eb78e0f79571bd1
+            # this returns a list of rotation vectors and a list of
+            # translation vectors of where each id is located.
+            rvecs, tvecs, _objPoints = aruco.estimatePoseSingleMarkers(
+                corners,
+                C.MARKER_LENGTH,
+                self.camera_meta["new_camera_mtx"],
+                self.camera_meta["dist_coeff"],
+                None,
+                None
+            )
+            # If we have detected some ids
+            if detected_aruco_ids is not None:
+                # Draw the markers onto the image (axis on image)
+                self.undistorted_img = aruco.drawDetectedMarkers(
+                    self.undistorted_img,
+                    raw_corners,
+                    detected_aruco_ids,
+                    (0,255,0)
+                )
+
+                # Transform every detected marker into the world at once
+                rvecs_world, tvecs_world = self.transform_to_world(
+                    rvecs[:, 0],
+                    tvecs[:, 0]
+                )
+                # The world rays through each corner, for MultiViewFusion to
+                # triangulate with the other cameras
+                corner_rays = self.get_corner_rays(corners)
+                tvec_sigmas = self.get_tvec_sigmas(corners, tvecs[:, 0])
+                ray_sigma = (
+                    C.CORNER_PIXEL_SIGMA / self.camera_meta["new_camera_mtx"][0, 0]
+                )
+
+                # Go through the detected aruco_ids and assign their
+                # rvec, tvec as a dictionary.
+                # Save that dictionary as a class variable so that
+                # MocapSystem can aggregate across all VideoStreams
+                # to prep for JSON Transfer
+                for i, aruco_id in enumerate(detected_aruco_ids[:, 0]):
+                    # This assumes that we only have one
+                    # of each aruco marker. For my classroom, this
+                    # should be a safe assumption to make.
+                    # i.e. we should see at most 1 unique aruco id
+                    # per camera.
+                    marker_id_pose_dict[int(aruco_id)] = {
+                        "camera_id": self.id,
+                        "rvec": rvecs_world[i],
+                        "tvec": tvecs_world[i],
+                        "tvec_sigma": tvec_sigmas[i],
+                        "camera_center": None,
+                        "corner_rays": None,
+                        "ray_sigma": None
+                    }
+                    if corner_rays is not None:
+                        marker_id_pose_dict[int(aruco_id)].update({
+                            "camera_center": self.cam_tra_mat,
+                            "corner_rays": corner_rays[i],
+                            "ray_sigma": ray_sigma
+                        })
+
+        return marker_id_pose_dict
+
+
+    def detect_markers(self, img_gray):
+        """
+            Detects the aruco markers in a frame, with the roi_detector if
+            there is one.
+
+            Inputs:
+                - img_gray <np.array>: the grayscale frame
+
+            Returns:
+                - corners <list<np.array(1,4,2)>>: the corners of each marker
+                - detected_aruco_ids <np.array(n,1)>: the aruco ids, or None
         """
-        cv2.imshow("camera " + str(self.id), self.undistorted_img)
-        if cv2.waitKey(25) & 0xFF == ord('q'):
-            self.capture.release()
-            cv2.destroyAllWindows()
-            exit(1)
+        if self.roi_detector is not None:
+            return self.roi_detector.detect(img_gray)
+        corners, detected_aruco_ids, rejected_pts = aruco.detectMarkers(
+            img_gray,
+            C.ARUCO_DICT,
+            parameters=C.ARUCO_PARAMS
+        )
+        return corners, detected_aruco_ids
+
+
+    def get_detection_stats(self):
+        """
+            Returns:
+                - stats <dict>: RoiDetector.get_stats(), or None if the
+                    roi_detector isn't used
+        """
+        if self.roi_detector is None:
+            return None
+        return self.roi_detector.get_stats()
+
+
+    def get_corner_rays(self, corners):
+        """
+            Finds the direction in the world of the ray from the camera through
+            each corner of each detected marker. The corners go through the
+            same camera model (new_camera_mtx and dist_coeff) that
+            estimatePoseSingleMarkers uses, so the rays agree with the tvecs
+            and a marker doesn't jump between triangulated and PnP positions.
+
+            Inputs:
+                - corners <list<np.array(1,4,2)>>: the undistorted corners of
+                    the detected markers, from aruco.detectMarkers()
+
+            Returns:
+                - corner_rays <np.array(n,4,3)>: unit vectors in the world, or
+                    None if the camera isn't calibrated
+        """
+        if self.cam_rot_mat is None:
+            return None
+        pixels = np.asarray(corners, dtype=np.float64).reshape(-1, 1, 2)
+        # The normalized image coordinates (x, y, 1) of every corner
+        points = cv2.undistortPoints(
+            pixels,
+            self.camera_meta["new_camera_mtx"],
+            self.camera_meta["dist_coeff"]
+        ).reshape(-1, 4, 2)
+        points = np.concatenate([points, np.ones(points.shape[:2] + (1,))], axis=2)
+        # Each row is a point, so R @ point becomes points @ R.T
+        rays = points @ self.cam_rot_mat.T
+        return rays / np.linalg.norm(rays, axis=2, keepdims=True)
+
+
+    def get_tvec_sigmas(self, corners, tvecs):
+        """
+            Estimates how far off each marker's tvec could be. PnP gets the
+            distance to a marker from how big it looks, so the error grows with
+            the distance and shrinks with the marker's size in pixels.
+
+            Inputs:
+                - corners <list<np.array(1,4,2)>>: the corners of the markers
+                - tvecs <np.array(n,3)>: the tvecs in the camera's coordinates
+
+            Returns:
+                - tvec_sigmas <np.array(n)>: cm, 1 sigma of each tvec
+        """
+        pixels = np.asarray(corners, dtype=np.float64).reshape(-1, 4, 2)
+        side_length = np.linalg.norm(
+            np.roll(pixels, -1, axis=1) - pixels, axis=2
+        ).mean(axis=1)
+        distance = np.linalg.norm(tvecs, axis=1)
+        return distance * C.CORNER_PIXEL_SIGMA / np.maximum(side_length, 1.)
+
@@ -0,0 +1,134 @@
+import json
+import struct
+from threading import Lock
+
+# Version 1 of the /echo wire protocol. Clients pick a format with the query
+# string, i.e. /echo?format=binary&delta=1
+#
+# JSON:
+#   {"v": 1, "type": "full" or "delta", "seq": <int>,
+#    "points": {"<aruco id>": {"x": <float>, "y": <float>}, ...},
+#    "removed": ["<aruco id>", ...]}
+#
+# Binary (little endian):
+#   header: version <uint8>, type <uint8> (0 full, 1 delta),
+#           number of points <uint16>, seq <uint32>
+#   then for each point: aruco id <uint16>, x <float32>, y <float32>
+#   A removed point is sent with x and y as NaN.
+#
+# A "full" frame holds every point. A "delta" frame only holds the points whose
+# rounded x or y changed since the frame before it (seq - 1), plus the points
+# that disappeared.
+WIRE_PROTOCOL_VERSION = 1
+FRAME_TYPE_FULL = 0
+FRAME_TYPE_DELTA = 1
+BINARY_HEADER = struct.Struct("<BBHI")
+BINARY_POINT = struct.Struct("<Hff")
+
+class WireFrame(object):
+    """
+        A WireFrame is one frame published by the MocapPublisher. It works out
+        which points changed since the previous frame and serializes itself
+        lazily, once per format, no matter how many clients ask for it.
+
+        - seq <int>: The frame number, same as MocapPublisher.frame_count
+
+        - data <dict>: Every point in this frame
+            {
+                "1": {"x": <float>, "y": <float>}
+            }
+
+        - changed <dict>: The points in data that are new or moved since the
+            previous frame
+
+        - removed <list<string>>: The points in the previous frame that are
+            not in this one
+
+        - keyframe <bool>: If True, every client gets the full frame, so that
+            clients can recover from any missed frame
+
+        - payload_dict <dict>: Cached payloads, keyed by (format, delta)
+    """
+    def __init__(self, seq, data, prev_data=None, keyframe=False):
+        self.seq = seq
+        self.data = data
+        self.keyframe = keyframe
+        prev_data = prev_data if prev_data is not None else {}
+        self.changed = {}
+        for point_key in data:
+            if prev_data.get(point_key) != data[point_key]:
+                self.changed[point_key] = data[point_key]
+        self.removed = [point_key for point_key in prev_data if point_key not in data]
+        self.payload_dict = {}
+        self.lock = Lock()
+
+
+    def get_payload(self, format="json", delta=False):
+        """
+            Gets this frame serialized in a format.
+
+            Inputs:
+                - format <string>: "json" or "binary"
+                - delta <bool>: If True, only send what changed since the
+                    previous frame. The caller must only ask for a delta if the
+                    client was sent frame seq - 1.
+
+            Returns:
+                - payload <string or bytes>: the frame to send over the websocket
+        """
+        delta = delta and not self.keyframe
+        with self.lock:
+            if (format, delta) not in self.payload_dict:
+                if format == "binary":
+                    payload = self.encode_binary(delta)
+                else:
+                    payload = self.encode_json(delta)
+                self.payload_dict[(format, delta)] = payload
+            return self.payload_dict[(format, delta)]
+
+
+    def encode_json(self, delta):
+        frame = {
+            "v": WIRE_PROTOCOL_VERSION,
+            "type": "delta" if delta else "full",
+            "seq": self.seq,
+            "points": self.changed if delta else self.data,
+            "removed": self.removed if delta else []
+        }
+        return json.dumps(frame, separators=(",", ":"))
+
+
+    def encode_binary(self, delta):
+        points = self.changed if delta else self.data
+        removed = self.removed if delta else []
+        payload = bytearray(BINARY_HEADER.size +
+            BINARY_POINT.size * (len(points) + len(removed))
+        )
+        BINARY_HEADER.pack_into(
+            payload,
+            0,
+            WIRE_PROTOCOL_VERSION,
+            FRAME_TYPE_DELTA if delta else FRAME_TYPE_FULL,
+            len(points) + len(removed),
+            self.seq % (2 ** 32)
+        )
+        offset = BINARY_HEADER.size
+        for point_key in points:
+            BINARY_POINT.pack_into(
+                payload,
+                offset,
+                int(point_key),
+                points[point_key]["x"],
+                points[point_key]["y"]
+            )
+            offset = offset + BINARY_POINT.size
+        for point_key in removed:
+            BINARY_POINT.pack_into(
+                payload,
+                offset,
+                int(point_key),
+                float("nan"),
+                float("nan")
+            )
+            offset = offset + BINARY_POINT.size
+        return bytes(payload)
@@ -1,3 +1,5 @@
+import os
+import json
 import numpy as np
 from cv2 import aruco
 
@@ -7,20 +9,103 @@ SAVE_VIDEO_STREAM_FILE_PATH = "/media/mighty/research-1/collected_data_from_came
 SAVE_POSE_HISTORY_FILE_PATH = "/media/mighty/research-1/collected_data_from_cameras/pose_history/"
 SAVE_SCREEN_STREAM_FILE_PATH = "/media/mighty/research-1/collected_data_from_cameras/screen/"
 
+# The pose history can be saved as "csv" or a compact columnar "binary" file.
+# Either can be read with utils.PoseHistoryWriter.load_pose_history
+POSE_HISTORY_FORMAT = "csv"
+# Most seconds between flushing (and fsync'ing) the pose history to the disk
+POSE_HISTORY_FLUSH_INTERVAL = 1
+# How many ticks of poses can wait to be written before they're dropped
+POSE_HISTORY_QUEUE_LENGTH = 1000
+
+# How many frames of each camera can wait to be encoded before new frames are
+# dropped. Each one takes a frame of shared memory.
+RECORD_QUEUE_LENGTH = 30
+# If True, recordings are dumped as raw frames (.raw) instead of being encoded,
+# so recording takes almost no CPU. Encode them later with encode_recording.py
+RECORD_RAW = False
+# The codec of recorded videos
+RECORD_FOURCC = "MJPG"
+# Seconds to wait for a recorder to write the frames still in its queue when
+# the system stops
+RECORD_STOP_TIMEOUT = 5
+# Most seconds between flushing a recording's index to the disk, so a crashed
+# recorder still leaves an index of the frames it wrote
+RECORD_INDEX_FLUSH_INTERVAL = 1
+
 # Frame Rate needs to be set manually
 # https://stackoverflow.com/a/54444910
 # Determines the frame rate for saving the video and taking new pictures
 CAMERA_FRAME_RATE = 10
-# Only use about 10 FPS for screen capture because pyscreenshot can't take
-# screenshots that fast
+# Screen capture only needs to be about as fast as the cameras
 SCREEN_CAPTURE_FRAME_RATE = 10
+# (left, top, width, height) in pixels of the part of the screen to record,
+# i.e. the Desmos canvas. None records the whole primary monitor
+SCREEN_CAPTURE_REGION = None
 
 # The frame rate of web socket data so that we don't overload Desmos
 MOCAP_OUT_FRAME_RATE = 15
+# Every this many frames, websocket clients asking for deltas get a full frame
+WIRE_KEYFRAME_INTERVAL = 30
+
+# The camera previews at /preview/<camera id> (see utils/PreviewPublisher.py)
+# Most times per second each camera's preview is encoded. Viewers can ask for
+# fewer with ?fps=
+PREVIEW_FRAME_RATE = 10
+PREVIEW_JPEG_QUALITY = 70
+# Size of a preview thumbnail (?thumbnail=1) compared to the camera's frame
+PREVIEW_THUMBNAIL_SCALE = 0.25
+
+# Minimum number of seconds between repeated warnings, so printing doesn't
+# stall the camera threads
+WARNING_INTERVAL = 10
+
+# How many detection batches can wait for MocapSystem to fuse them before the
+# oldest are dropped. Every camera pushes one batch per frame.
+DETECTION_QUEUE_LENGTH = 64
+
+# Seconds. The FrameSynchronizer groups the frames of every camera into time
+# slots this long, and each slot is fused together
+SYNC_PERIOD = 1. / CAMERA_FRAME_RATE
+# Seconds to wait for a slow camera after a slot ends before fusing without it
+SYNC_LATENCY = 0.05
+# Seconds. A camera that hasn't sent a frame in this long isn't waited for
+SYNC_ACTIVE_TIME = 1
+# Seconds. Only frames this close in time are triangulated together
+SYNC_MAX_SKEW = 0.04
+# How many slots the skew between cameras is measured over
+SYNC_STATS_LENGTH = 100
+# pixels, how far a detected aruco corner is from the true corner (1 sigma)
+CORNER_PIXEL_SIGMA = 1
+# degrees. Rays closer to parallel than this can't fix the depth of a marker,
+# so the PnP positions are used instead
+FUSION_MIN_RAY_ANGLE = 5
+# cm. If a triangulated corner is further than this from the rays it came
+# from, the cameras disagree and the PnP positions are used instead
+FUSION_MAX_RAY_DISTANCE = 30
+
+# The MarkerTracker follows each marker with a constant velocity Kalman filter
+# cm, the least error a fused position is trusted to have (1 sigma). Even
+# triangulated positions are off by about this much when the calibrations of
+# the cameras don't quite agree
+TRACKER_MEASUREMENT_SIGMA = 5
+# cm/s^2, how quickly a student can change speed (1 sigma)
+TRACKER_ACCELERATION_SIGMA = 200
+# cm/s, how fast a marker might be moving when it is first seen (1 sigma)
+TRACKER_INITIAL_VELOCITY_SIGMA = 100
+# A position further than this (squared, in sigmas) from where the marker
+# was predicted to be is an outlier. 16.3 keeps 99.9% of good positions
+TRACKER_GATE = 16.3
+# After this many outliers in a row, the marker must have really moved, so
+# its track is started over from the latest position
+TRACKER_MAX_REJECTS = 5
+# Seconds a marker is still sent after it was last seen
+TRACKER_MAX_AGE = 1.5
+# Seconds. Most a position is predicted forward in time, so a marker that is
+# no longer seen doesn't fly away
+TRACKER_MAX_PREDICTION = 0.25
 
 # 640 x 480 pixels
 CAMERA_FRAME_SIZE = (640, 480)
-SCREEN_CAPTURE_SIZE = (1680,1050)
 
 # The default bounds in real world in cm
 DEFAULT_BOUNDS = [-300, 300, -200, 200]
@@ -30,6 +115,8 @@ DEFAULT_ORIGIN = [0, 0, 0]
 # These need to be changed if you swap out the type of camera.
 # I make the assumption here that all cameras will be the same, but if they are not
 # they need to be separated.
+# These are only the defaults for a camera the CalibrationStore hasn't seen yet.
+# Give a camera its own intrinsics with calibrations.py
 CAMERA_CALIBRATION_MATRIX = np.array([
     [589.2678740465893, 0.0, 360.7562954333174],
     [0.0, 588.3283124033934, 229.65330113945927],
@@ -45,10 +132,32 @@ CAMERA_CALIBRATION_DISTANCE_COEFF = np.array([[
 MARKER_LENGTH = 18 # cm
 
 ARUCO_DICT = aruco.getPredefinedDictionary(aruco.DICT_6X6_1000)
+# How many aruco ids are in ARUCO_DICT (1000)
+NUM_ARUCO_IDS = ARUCO_DICT.bytesList.shape[0]
 ARUCO_PARAMS = aruco.DetectorParameters_create()
 
+# If True, detect aruco markers on the raw camera frame and only undistort the
+# detected corners, instead of undistorting the whole frame before detection.
+# Compare the two with compare_detection_paths.py before turning this on.
+DETECT_ON_RAW_FRAME = False
+
+# If True, a RoiDetector only searches windows around the markers found in the
+# frame before, and searches the whole frame every ROI_FULL_SCAN_INTERVAL
+# frames or when a marker is lost. Replay recorded sessions with
+# replay_session.py with this on and off, and compare the poses before
+# turning it on.
+USE_ROI_DETECTION = False
+ROI_FULL_SCAN_INTERVAL = 5
+# How much bigger than a marker each window is, in marker sizes on each side
+ROI_PADDING = 1
+# Pixels. Windows are at least this wide and tall, so a far marker that moves
+# a little is still in its window
+ROI_MIN_WINDOW_SIZE = 64
+
 # Dictionary of extrinsic matrices so that we can calculate the world position
-# based on the camera id. These are generated using Guoxiang's Posegraph julia code
+# based on the camera id. These are generated using Guoxiang's Posegraph julia code.
+# A camera_N_extrinsic.json in EXTRINSIC_CALIBRATION_PATH (written by
+# solve_extrinsics.py) replaces that camera's matrix below.
 CAMERA_EXTRINSIC_MATRIX_DICT = {
     1: (np.array([
             -0.9989347040720827, -0.02170560509265326, -0.04072252089424574, -169.04591654142874,
@@ -79,3 +188,55 @@ CAMERA_EXTRINSIC_MATRIX_DICT = {
         ]).reshape(4,4)
     )
 }
+
+# Where the CalibrationStore keeps one calibration per camera identity
+CALIBRATION_STORE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "camera_calibrations"
+)
+# Seconds between checking the CalibrationStore for new calibrations
+CALIBRATION_RELOAD_INTERVAL = 2
+
+# Where CameraDiscovery remembers the camera id of each physical camera
+CAMERA_PROFILE_FILE_NAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "camera_profile.json"
+)
+# Most seconds to wait for every camera to give its first frame
+CAMERA_PROBE_TIMEOUT = 5
+# Without /dev/video*, how many cv2.VideoCapture sources to try
+CAMERA_PROBE_MAX_SOURCES = 10
+
+# Where solve_extrinsics.py writes camera_N_extrinsic.json
+EXTRINSIC_CALIBRATION_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "camera_world_calibration"
+)
+# cm. A calibration sample further than this from the fit is an outlier
+EXTRINSIC_RANSAC_THRESHOLD = 60
+# How many random sets of 3 samples RANSAC tries
+EXTRINSIC_RANSAC_ITERATIONS = 500
+# cm. Samples with a larger error count less when refining the fit
+EXTRINSIC_HUBER_DELTA = 30
+
+for camera_id in range(1, NUM_CAMERAS + 1):
+    extrinsic_file_name = os.path.join(
+        EXTRINSIC_CALIBRATION_PATH, "camera_" + str(camera_id) + "_extrinsic.json"
+    )
+    if os.path.exists(extrinsic_file_name):
+        with open(extrinsic_file_name) as f:
+            CAMERA_EXTRINSIC_MATRIX_DICT[camera_id] = np.array(
+                json.load(f)["extrinsic_matrix"]
+            ).reshape(4,4)
+
+# Sigmas of the residuals in calibrate_all_cameras.py's joint calibration.
+# These were tuned on the checked-in camera_N_data.csv, so that every camera's
+# world error improves on solve_extrinsics.py's fit. Check the printed errors
+# again after collecting new data.
+# pixels, between where a marker position projects and where it was detected.
+# About the median reprojection error of each camera's own fit
+BA_REPROJECTION_SIGMA = 10
+# cm, between the distance to a marker position and the detected distance
+BA_RANGE_SIGMA = 10
+# cm, between a marker position and its surveyed position. The taped positions
+# are only off by a few cm, so the markers can't drift far to fit the cameras
+BA_PRIOR_SIGMA = 3
+# Observations with a larger normalized residual count less
+BA_HUBER_DELTA = 3
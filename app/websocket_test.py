@@ -5,11 +5,14 @@ import argparse
 import sys
 
 
-from flask import Flask
+from flask import Flask, request
 from flask_sock import Sock
 
 import random
 
+from utils.WireFrame import WireFrame
+from utils.constants import constants as C
+
 app = Flask(__name__)
 sock = Sock(app)
 
@@ -17,6 +20,9 @@ sock = Sock(app)
 @sock.route("/echo")
 def echo(sock):
     print("Connected!")
+    # Same query string as app.py's /echo, see utils/WireFrame.py
+    wire_format = request.args.get("format", "json")
+    use_delta = request.args.get("delta", "0") == "1"
     # update these with student points from webcam
     data = {
         "0": {
@@ -29,13 +35,24 @@ def echo(sock):
         }
     }
     prev = 0
+    seq = 0
+    prev_data = {}
     while True:
         # send the data of the points over the websocket
         # print(data)
         time_elapsed = time.time() - prev # time.time() returns seconds
         if time_elapsed >= 1./10:
             prev = time.time()
-            sock.send(data)
+            seq = seq + 1
+            wire_frame = WireFrame(
+                seq,
+                data,
+                prev_data,
+                seq % C.WIRE_KEYFRAME_INTERVAL == 0
+            )
+            # Every frame is sent, so a delta always follows the frame before
+            sock.send(wire_frame.get_payload(wire_format, use_delta and seq > 1))
+            prev_data = data
             data = {
                 "0": {
                     "x": data["0"]["x"] + 10 * random.random() - 5,
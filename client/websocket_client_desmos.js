@@ -18,9 +18,44 @@ function getColor(id) {
   return color;
 }
 
+// Decodes a frame of the /echo wire protocol (version 1, see
+// app/utils/WireFrame.py) into {type, seq, points, removed}
+function decodeFrame(data) {
+  if (typeof data === "string") {
+    return JSON.parse(data);
+  }
+  var view = new DataView(data);
+  var frame = {
+    "v": view.getUint8(0),
+    "type": view.getUint8(1) == 1 ? "delta" : "full",
+    "seq": view.getUint32(4, true),
+    "points": {},
+    "removed": [],
+  };
+  var numPoints = view.getUint16(2, true);
+  for (var i = 0; i < numPoints; i++) {
+    var offset = 8 + i * 10;
+    var id = view.getUint16(offset, true);
+    var x = view.getFloat32(offset + 2, true);
+    var y = view.getFloat32(offset + 6, true);
+    if (isNaN(x)) {
+      frame.removed.push(String(id));
+    }
+    else {
+      // float32 can't hold every rounded decimal exactly, i.e. 0.1
+      frame.points[id] = {"x": Math.round(x * 1000) / 1000, "y": Math.round(y * 1000) / 1000};
+    }
+  }
+  return frame;
+}
+
 function create_web_socket_connection() {
   // This code is run on the client end
-  var ws = new WebSocket("ws://localhost:5000/echo");
+  // Ask for compact binary frames that only hold the points that moved
+  var ws = new WebSocket("ws://localhost:5000/echo?format=binary&delta=1");
+  ws.binaryType = "arraybuffer";
+  // Every student point we're currently showing
+  var points = {};
 
   ws.onopen = function() {
      // Web Socket is connected, send data using send()
@@ -42,23 +77,46 @@ function create_web_socket_connection() {
   };
 
   ws.onmessage = function (evt) {
-    var received_msg = evt.data;
-    // Python sends single quotes, JS needs double quotes
-    // Convert string to Array of Objects
-    received_msg = received_msg.replaceAll("'", "\"");
-    var parsed = JSON.parse(received_msg);
-    keys = Object.keys(parsed)
-    s_list_latex = `S=\\left[`
-    // Update the position of each individual point
+    var frame = decodeFrame(evt.data);
+    var pointsChanged = false;
+    if (frame.type == "full") {
+      // Anything we're showing that isn't in a full frame has disappeared
+      for (var key in points) {
+        if (!(key in frame.points)) {
+          frame.removed.push(key);
+        }
+      }
+    }
+    for (var i = 0; i < frame.removed.length; i++) {
+      if (frame.removed[i] in points) {
+        delete points[frame.removed[i]];
+        Calc.removeExpression({id: `P_{${frame.removed[i]}}`});
+        pointsChanged = true;
+      }
+    }
+    // Only update the points that moved
+    keys = Object.keys(frame.points)
     for (var i = 0; i < keys.length; i++) {
+      if (!(keys[i] in points)) {
+        pointsChanged = true;
+      }
+      points[keys[i]] = frame.points[keys[i]];
       color = getColor(keys[i]);
       Calc.setExpression({
         "id": `P_{${keys[i]}}`,
-        "latex": `P_{${keys[i]}}=(${parsed[keys[i]].x}, ${parsed[keys[i]].y})`,
+        "latex": `P_{${keys[i]}}=(${points[keys[i]].x}, ${points[keys[i]].y})`,
         "dragMode": Desmos.DragModes.NONE,
         "color": color,
         "folderId": "student_points",
       })
+    }
+    if (!pointsChanged) {
+      return;
+    }
+    // Update the list of student points -- handles if a kid disappears or comes back
+    s_list_latex = `S=\\left[`
+    keys = Object.keys(points)
+    for (var i = 0; i < keys.length; i++) {
       if (i == 0) {
         s_list_latex = s_list_latex + `P_{${keys[i]}}`
       }
@@ -67,7 +125,6 @@ function create_web_socket_connection() {
       }
     }
     s_list_latex = s_list_latex + `\\right]`
-    // Update the list of student points -- handles if a kid disappears or comes back
     Calc.setExpression({
       "type": "expression",
       "id": "s_list",
@@ -1,6 +1,10 @@
 // This code is run on the client end
-var ws = new WebSocket("ws://localhost:5000/echo");
+// Ask for JSON frames that only hold the points that moved.
+// See app/utils/WireFrame.py for the wire protocol.
+var ws = new WebSocket("ws://localhost:5000/echo?format=json&delta=1");
 var app = ggbApplet;
+// Every student point we're currently showing
+var points = {};
 
 ws.onopen = function() {
    // Web Socket is connected, send data using send()
@@ -8,17 +12,30 @@ ws.onopen = function() {
 };
 
 ws.onmessage = function (evt) {
-   var received_msg = evt.data;
-   // fken python sends single quotes, JS needs double quotes
-   // Convert string to Array of Objects
-   received_msg = received_msg.replaceAll("'", "\"");
-   var parsed = JSON.parse(received_msg);
-   console.log(parsed)
-   keys = Object.keys(parsed)
+   var frame = JSON.parse(evt.data);
+   console.log(frame)
+   if (frame.type == "full") {
+     // Anything we're showing that isn't in a full frame has disappeared
+     for (var key in points) {
+       if (!(key in frame.points)) {
+         frame.removed.push(key);
+       }
+     }
+   }
+   // Points that disappeared since the last frame
+   for (var i = 0; i < frame.removed.length; i++) {
+     if (frame.removed[i] in points) {
+       delete points[frame.removed[i]];
+       app.deleteObject(`P_{${frame.removed[i]}}`)
+     }
+   }
+   keys = Object.keys(frame.points)
 
    for (var i = 0; i < keys.length; i++) {
-     console.log(`P_{${keys[i]}}=(${parsed[keys[i]].x},${parsed[keys[i]].y})`)
-     app.evalCommand(`P_{${keys[i]}}=(${parsed[keys[i]].x},${parsed[keys[i]].y})`)
+     var point = frame.points[keys[i]];
+     points[keys[i]] = point;
+     console.log(`P_{${keys[i]}}=(${point.x},${point.y})`)
+     app.evalCommand(`P_{${keys[i]}}=(${point.x},${point.y})`)
    }
 };
 